@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""Measures the time necessary to set up connections between subdomains.
+
+This covers the host-side work done before the simulation starts: computing
+the connection details for every pair of subdomains and building the index
+tables used to collect and distribute data in the subdomain runners.  No
+compute device is necessary -- the dummy backend is used for all buffers.
+
+The default geometry is a fully periodic D3Q19 lattice split along the X
+axis into two subdomains, with faces of 512x512 nodes.
+"""
+
+import argparse
+import time
+
+from sailfish.backend_dummy import DummyBackend
+from sailfish.config import LBConfig
+from sailfish.controller import LBGeometryProcessor
+from sailfish.geo import LBGeometry3D
+from sailfish.lb_base import LBSim
+from sailfish.subdomain import SubdomainSpec3D
+from sailfish.subdomain_runner import SubdomainRunner
+
+
+class _Logger(object):
+    def debug(self, msg):
+        pass
+
+
+def make_config(args):
+    config = LBConfig()
+    config.lat_nx = 2 * args.depth
+    config.lat_ny = args.face
+    config.lat_nz = args.face
+    config.periodic_x = True
+    config.periodic_y = True
+    config.periodic_z = True
+    config.grid = 'D3Q19'
+    config.precision = 'single'
+    config.access_pattern = args.access_pattern
+    config.block_size = 64
+    config.mem_alignment = 32
+    config.init_iters = 0
+    config.seed = 0
+    config.geometry_slab_size = 0
+    config.logger = _Logger()
+    return config
+
+
+def run(args):
+    config = make_config(args)
+    geo = LBGeometry3D(config)
+    face = args.face
+    subdomains = [
+        SubdomainSpec3D((0, 0, 0), (args.depth, face, face), envelope_size=1, id_=0),
+        SubdomainSpec3D((args.depth, 0, 0), (args.depth, face, face),
+                        envelope_size=1, id_=1)]
+
+    t0 = time.time()
+    LBGeometryProcessor(subdomains, 3, geo)._connect_subdomains(config)
+    t_connect = time.time() - t0
+
+    backend = DummyBackend()
+    t0 = time.time()
+    for spec in subdomains:
+        runner = SubdomainRunner(LBSim(config), spec, output=None,
+                                 backend=backend, quit_event=None)
+        runner._init_shape()
+        runner._init_buffers()
+    t_buffers = time.time() - t0
+    return t_connect, t_buffers
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--face', type=int, default=512,
+                        help='size of the subdomain faces')
+    parser.add_argument('--depth', type=int, default=8,
+                        help='size of the subdomains along the X axis')
+    parser.add_argument('--access_pattern', default='AB', choices=['AB', 'AA'])
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of measurements')
+    args = parser.parse_args()
+
+    print '# face depth connect[s] buffers[s]'
+    for i in range(args.repeat):
+        t_connect, t_buffers = run(args)
+        print '%d %d %.4f %.4f' % (args.face, args.depth, t_connect, t_buffers)
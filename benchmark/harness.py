@@ -0,0 +1,113 @@
+"""Common code for benchmark harnesses.
+
+Simulations are run in benchmark mode via LBSimulationController, and their
+throughput is summarized with confidence intervals computed from repeated
+samples.
+"""
+
+import math
+import platform
+import time
+
+import numpy as np
+
+from sailfish.controller import LBSimulationController
+
+# Two-sided 95% critical values of Student's t distribution, indexed by the
+# number of degrees of freedom.
+_T95 = {1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447,
+        7: 2.365, 8: 2.306, 9: 2.262, 10: 2.228, 12: 2.179, 15: 2.131,
+        20: 2.086, 25: 2.060, 30: 2.042, 40: 2.021, 60: 2.000, 120: 1.980}
+
+
+def t_critical(dof):
+    """Returns the two-sided 95% critical value of the t distribution.
+
+    For degrees of freedom not in the table, the value for the closest
+    smaller tabulated number is used, which makes the interval slightly
+    wider than necessary.
+    """
+    if dof < 1:
+        return float('inf')
+    if dof > max(_T95):
+        return 1.960
+    return _T95[max(k for k in _T95 if k <= dof)]
+
+
+def run(sim_cls, geo_cls, settings):
+    """Runs a simulation in benchmark mode.
+
+    :param settings: dict of config settings; command line arguments are
+        ignored
+    :rvalue: tuple of: list of TimingInfo objects, list of subdomains
+    """
+    settings = dict(settings)
+    settings.update({'mode': 'benchmark', 'quiet': True})
+    ctrl = LBSimulationController(sim_cls, geo_cls, settings)
+    timing_infos, _, _, subdomains = ctrl.run(ignore_cmdline=True)
+    return timing_infos, subdomains
+
+
+def throughput(timing_infos, subdomains):
+    """Returns the total throughput of all subdomains, in MLUPS."""
+    ids = dict((s.id, s) for s in subdomains)
+    return sum(ids[ti.subdomain_id].num_nodes / ti.total * 1e-6 for ti in
+               timing_infos)
+
+
+def summarize(samples):
+    """Summarizes repeated measurements.
+
+    :param samples: list of values
+    :rvalue: dict with the samples, their mean, standard deviation and 95%
+        confidence interval for the mean
+    """
+    samples = [float(x) for x in samples]
+    n = len(samples)
+    mean = float(np.mean(samples))
+    stdev = float(np.std(samples, ddof=1)) if n > 1 else 0.0
+    half = t_critical(n - 1) * stdev / math.sqrt(n) if n > 1 else 0.0
+    return {'samples': samples, 'mean': mean, 'stdev': stdev,
+            'ci': [mean - half, mean + half]}
+
+
+def compare(current, baseline, threshold):
+    """Compares throughput with a baseline.
+
+    The confidence interval for the relative change of the mean is computed
+    with Welch's method.  A regression is only reported if the whole interval
+    lies below -threshold, i.e. when the throughput is lower than the baseline
+    by more than the threshold with 95% confidence.  With a single sample,
+    the point estimate is used instead.
+
+    :param current: dict returned by summarize()
+    :param baseline: dict returned by summarize()
+    :param threshold: max tolerated relative drop of throughput
+    :rvalue: dict with the relative change, its confidence interval, and
+        a 'regression' flag
+    """
+    m1, m2 = current['mean'], baseline['mean']
+    n1, n2 = len(current['samples']), len(baseline['samples'])
+    v1 = current['stdev'] ** 2 / n1
+    v2 = baseline['stdev'] ** 2 / n2
+    diff = m1 - m2
+
+    if n1 > 1 and n2 > 1 and v1 + v2 > 0:
+        # Welch-Satterthwaite approximation of the degrees of freedom.
+        dof = (v1 + v2) ** 2 / (v1 ** 2 / (n1 - 1) + v2 ** 2 / (n2 - 1))
+        half = t_critical(int(dof)) * math.sqrt(v1 + v2)
+    else:
+        half = 0.0
+
+    ci = [(diff - half) / m2, (diff + half) / m2]
+    return {'change': diff / m2, 'ci': ci, 'regression': ci[1] < -threshold}
+
+
+def metadata(settings=None):
+    """Returns a dict describing the environment of a benchmark run."""
+    ret = {'host': platform.node(), 'platform': platform.platform(),
+           'python': platform.python_version(), 'numpy': np.__version__,
+           'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+    if settings:
+        ret['settings'] = settings
+    return ret
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""Measures the time necessary to detect unused nodes.
+
+Compares Subdomain._postprocess_nodes with the previous implementation,
+which used np.roll copies of the type map in 2D and a convolution in 3D.
+No compute device is necessary -- the dummy backend is used.
+"""
+
+import argparse
+import time
+
+import numpy as np
+from scipy.ndimage import filters
+
+from sailfish import util
+from sailfish.backend_dummy import DummyBackend
+from sailfish.config import LBConfig
+from sailfish.lb_base import LBSim
+from sailfish.node_type import NTFullBBWall
+import sailfish.node_type as nt
+from sailfish.subdomain import Subdomain2D, Subdomain3D, SubdomainSpec2D, SubdomainSpec3D
+from sailfish.subdomain_runner import SubdomainRunner
+
+
+class _Logger(object):
+    def debug(self, msg):
+        pass
+
+
+class PorousSubdomain2D(Subdomain2D):
+    def boundary_conditions(self, hx, hy):
+        self.set_node(((hx / 16 + hy / 16) % 2 == 0) |
+                      (np.random.random(hx.shape) > 0.9), NTFullBBWall)
+
+
+class PorousSubdomain3D(Subdomain3D):
+    def boundary_conditions(self, hx, hy, hz):
+        self.set_node(((hx / 16 + hy / 16 + hz / 16) % 2 == 0) |
+                      (np.random.random(hx.shape) > 0.9), NTFullBBWall)
+
+
+def legacy_postprocess_nodes(type_map, grid):
+    """Reference implementation used before the shared neighbor count kernel."""
+    uniq_types = set(np.unique(type_map))
+    dry_types = list(set(nt.get_dry_node_type_ids()) & uniq_types)
+    dry_types = type_map.dtype.type(dry_types)
+
+    if grid.dim == 2:
+        cnt = np.zeros_like(type_map).astype(np.uint32)
+        for i, vec in enumerate(grid.basis):
+            a = np.roll(type_map, int(-vec[0]), axis=1)
+            a = np.roll(a, int(-vec[1]), axis=0)
+            cnt[util.in_anyd_fast(a, dry_types)] += 1
+        where = (cnt == grid.Q)
+    else:
+        dry_map = util.in_anyd_fast(type_map, dry_types).astype(np.uint8)
+        neighbors = np.zeros((3, 3, 3), dtype=np.uint8)
+        neighbors[1,1,1] = 1
+        for ei in grid.basis:
+            neighbors[1 + ei[2], 1 + ei[1], 1 + ei[0]] = 1
+        where = (filters.convolve(dry_map, neighbors, mode='wrap') == grid.Q)
+
+    type_map[where] = nt._NTUnused.id
+
+
+def make_subdomain(args):
+    config = LBConfig()
+    config.precision = 'single'
+    config.block_size = 64
+    config.mem_alignment = 32
+    config.init_iters = 0
+    config.seed = 0
+    config.geometry_slab_size = args.slab_size
+    config.logger = _Logger()
+    if args.dim == 2:
+        config.grid = 'D2Q9'
+        config.lat_nx, config.lat_ny = args.size, args.size
+        size = (args.size, args.size)
+        spec = SubdomainSpec2D((0, 0), size, envelope_size=1, id_=0)
+        cls = PorousSubdomain2D
+    else:
+        config.grid = 'D3Q19'
+        config.lat_nx = config.lat_ny = config.lat_nz = args.size
+        size = (args.size, args.size, args.size)
+        spec = SubdomainSpec3D((0, 0, 0), size, envelope_size=1, id_=0)
+        cls = PorousSubdomain3D
+
+    sim = LBSim(config)
+    spec.runner = SubdomainRunner(sim, spec, output=None,
+                                  backend=DummyBackend(), quit_event=None)
+    spec.runner._init_shape()
+    sub = cls(list(reversed(size)), spec, sim.grid)
+    sub.boundary_conditions(*sub._get_mgrid())
+    return sub
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dim', type=int, default=2, choices=[2, 3])
+    parser.add_argument('--size', type=int, default=4096,
+                        help='size of the (square/cubic) subdomain')
+    parser.add_argument('--slab_size', type=int, default=0,
+                        help='value of --geometry_slab_size to use')
+    parser.add_argument('--legacy', action='store_true', default=False,
+                        help='also run the previous implementation and verify '
+                        'that the results are the same')
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    sub = make_subdomain(args)
+    type_map = sub._type_map.base
+    if args.legacy:
+        legacy_map = type_map.copy()
+
+    t0 = time.time()
+    sub._postprocess_nodes()
+    print 'current: %.3f s' % (time.time() - t0)
+
+    if args.legacy:
+        t0 = time.time()
+        legacy_postprocess_nodes(legacy_map, sub.grid)
+        print 'legacy:  %.3f s' % (time.time() - t0)
+        np.testing.assert_equal(type_map, legacy_map)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""
+Weak and strong scaling on a single machine.
+
+Runs a simulation split along one axis into 1..N subdomains, all of which
+are handled by subdomain runners on the local machine.  Any backend can be
+used (e.g. OpenCL on the CPU), so changes to the communication path can be
+validated without reserving time on a cluster.
+
+In weak scaling runs, every subdomain has the size given by --size.  In
+strong scaling runs, the whole domain has that size and is split between
+the subdomains.  For every run, the following is reported:
+
+ - total throughput in MLUPS, with a 95% confidence interval,
+ - parallel efficiency: throughput(n) / (n * throughput(1)),
+ - communication fraction: the part of the step time spent sending and
+   receiving data (including waiting for the neighbors), averaged over all
+   subdomains, and its maximum over the subdomains.
+
+Usage:
+    ./local.py [--case C] [--subdomains 1,2,4] [--scaling weak,strong]
+               [--connectors ipc,tcp,compressed] [--size 512x512]
+               [--output scaling.json]
+"""
+
+import argparse
+import json
+import sys
+
+import numpy as np
+
+from examples import ldc_2d, ldc_3d
+from examples.binary_fluid import sc_separation_2d
+from sailfish.geo import EqualSubdomainsGeometry2D, EqualSubdomainsGeometry3D
+
+from benchmark import harness
+
+# name -> (simulation class, geometry class, axis along which the subdomains
+# are connected, default size)
+CASES = {
+    'single_2d': (ldc_2d.LDCSim, EqualSubdomainsGeometry2D, 'y', (512, 512)),
+    'single_3d': (ldc_3d.LDCSim, EqualSubdomainsGeometry3D, 'z',
+                  (64, 64, 64)),
+    'binary_2d': (sc_separation_2d.SeparationSCSim, EqualSubdomainsGeometry2D,
+                  'y', (256, 256)),
+}
+
+# connector type -> settings
+CONNECTORS = {
+    'ipc': {'local_connector': 'ipc'},
+    'tcp': {'local_connector': 'tcp'},
+    'compressed': {'local_connector': 'tcp',
+                   'compress_intersubdomain_data': True},
+}
+
+
+def lattice_size(size, axis, num_subdomains, scaling):
+    """Returns the lattice size settings for a run.
+
+    :param size: tuple of the size of a single subdomain (weak scaling) or
+        of the whole domain (strong scaling)
+    :param axis: axis along which the subdomains are connected
+    """
+    ret = dict(zip(['lat_nx', 'lat_ny', 'lat_nz'], size))
+    if scaling == 'weak':
+        ret['lat_n' + axis] *= num_subdomains
+    return ret
+
+
+def comm_fractions(timing_infos):
+    """Returns a list of the fractions of the step time spent on
+    communication, for every subdomain."""
+    return [(ti.send + ti.recv) / ti.total for ti in timing_infos]
+
+
+def efficiency(runs):
+    """Computes the parallel efficiency of runs with the same scaling mode
+    and connector type, relative to the run with the fewest subdomains.
+
+    :param runs: list of dicts returned by run_point()
+    """
+    base = min(runs, key=lambda r: r['subdomains'])
+    per_subdomain = base['throughput']['mean'] / base['subdomains']
+    for r in runs:
+        r['efficiency'] = (r['throughput']['mean'] / r['subdomains'] /
+                           per_subdomain)
+
+
+def run_point(case, num_subdomains, scaling, connector, size, repeats,
+              settings):
+    sim_cls, geo_cls, axis, _ = CASES[case]
+    s = dict(settings)
+    s.update(CONNECTORS[connector])
+    s.update(lattice_size(size, axis, num_subdomains, scaling))
+    s.update({'subdomains': num_subdomains, 'conn_axis': axis})
+
+    samples = []
+    comm = []
+    for i in range(repeats):
+        timing_infos, subdomains = harness.run(sim_cls, geo_cls, s)
+        samples.append(harness.throughput(timing_infos, subdomains))
+        comm.append(comm_fractions(timing_infos))
+
+    return {'scaling': scaling, 'connector': connector,
+            'subdomains': num_subdomains,
+            'throughput': harness.summarize(samples),
+            'comm_fraction': float(np.mean(comm)),
+            'comm_fraction_max': float(np.max(comm))}
+
+
+def format_table(runs):
+    lines = ['{0:<7} {1:<11} {2:>4} {3:>10} {4:>21} {5:>6} {6:>6} '
+             '{7:>8}'.format('scaling', 'connector', 'subs', 'MLUPS',
+                             '95% CI', 'eff', 'comm', 'comm max')]
+    for r in runs:
+        t = r['throughput']
+        lines.append('{0:<7} {1:<11} {2:>4} {3:>10.2f} [{4:>9.2f}, {5:>9.2f}] '
+                     '{6:>6.2f} {7:>6.2f} {8:>8.2f}'.format(
+                         r['scaling'], r['connector'], r['subdomains'],
+                         t['mean'], t['ci'][0], t['ci'][1], r['efficiency'],
+                         r['comm_fraction'], r['comm_fraction_max']))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Single-machine scaling '
+                                     'benchmark.')
+    parser.add_argument('--case', type=str, default='single_2d',
+                        choices=sorted(CASES))
+    parser.add_argument('--subdomains', type=str, default='1,2,4',
+                        help='comma-separated list of subdomain counts')
+    parser.add_argument('--scaling', type=str, default='weak,strong',
+                        help='scaling modes to run: weak, strong or both')
+    parser.add_argument('--connectors', type=str, default='ipc,tcp',
+                        help='comma-separated list of connector types: '
+                        '{0}'.format(', '.join(sorted(CONNECTORS))))
+    parser.add_argument('--size', type=str, default='',
+                        help='lattice size as NXxNY[xNZ], per subdomain for '
+                        'weak scaling, and in total for strong scaling')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='number of samples for every run')
+    parser.add_argument('--iters', type=int, default=1000,
+                        help='number of iterations of every sample')
+    parser.add_argument('--sample_from', type=int, default=200,
+                        help='iteration from which performance is measured')
+    parser.add_argument('--backends', type=str, default='cuda,opencl',
+                        help='compute backends to use')
+    parser.add_argument('--precision', type=str, default='single',
+                        choices=['single', 'double'])
+    parser.add_argument('--output', type=str, default='scaling.json',
+                        help='name of the results file')
+    args = parser.parse_args()
+
+    counts = sorted(int(x) for x in args.subdomains.split(','))
+    modes = args.scaling.split(',')
+    connectors = args.connectors.split(',')
+    for mode in modes:
+        if mode not in ('weak', 'strong'):
+            parser.error('Unknown scaling mode: {0}'.format(mode))
+    for connector in connectors:
+        if connector not in CONNECTORS:
+            parser.error('Unknown connector type: {0}'.format(connector))
+
+    dim = len(CASES[args.case][3])
+    if args.size:
+        size = tuple(int(x) for x in args.size.split('x'))
+        if len(size) != dim:
+            parser.error('--size has to specify {0} dimensions'.format(dim))
+    else:
+        size = CASES[args.case][3]
+
+    settings = {'max_iters': args.iters,
+                'benchmark_sample_from': args.sample_from,
+                'every': args.iters, 'backends': args.backends,
+                'precision': args.precision}
+
+    runs = []
+    # With a single subdomain, there is no communication and the lattice
+    # size is the same in both scaling modes, so the run is only done once.
+    single = None
+    for mode in modes:
+        for connector in connectors:
+            group = []
+            for n in counts:
+                print 'Running {0} scaling, {1}, {2} subdomain(s)...'.format(
+                    mode, connector, n),
+                sys.stdout.flush()
+                if n == 1 and single is not None:
+                    res = dict(single, scaling=mode, connector=connector)
+                else:
+                    res = run_point(args.case, n, mode, connector, size,
+                                    args.repeats, settings)
+                    if n == 1:
+                        single = res
+                print '{0:.2f} MLUPS'.format(res['throughput']['mean'])
+                group.append(res)
+            efficiency(group)
+            runs.extend(group)
+
+    print
+    print format_table(runs)
+
+    meta = harness.metadata(settings)
+    meta.update({'case': args.case, 'size': size})
+    with open(args.output, 'w') as f:
+        json.dump({'meta': meta, 'runs': runs}, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
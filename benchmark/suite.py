@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+Performance regression suite.
+
+Runs a set of benchmark cases covering single- and binary-fluid models in
+2D and 3D, both memory access patterns and multiple subdomains.  Every case
+is run several times and the throughput (MLUPS) is summarized with a 95%
+confidence interval.  Results are saved as JSON.
+
+Usage:
+    ./suite.py [--cases C1,C2] [--repeats N] [--output results.json]
+               [--baseline baseline.json] [--threshold 0.05] [--backends B]
+               [--host_overhead]
+
+With --host_overhead, all kernels are replaced with no-ops, so that the
+throughput measures the host-side cost of the simulation step (see the
+--host_overhead option of the controller).
+
+When a baseline (a results file from an earlier run) is given, the
+throughput of every case is compared to it, and the script exits with
+status 1 if any case is slower than the baseline by more than the threshold
+with 95% confidence.
+"""
+
+import argparse
+import json
+import sys
+
+from examples import ldc_2d, ldc_3d
+from examples.binary_fluid import sc_separation_2d, sc_separation_3d
+from sailfish.geo import LBGeometry2D, LBGeometry3D
+
+from benchmark import harness
+
+# name -> (simulation class, geometry class, settings)
+CASES = {
+    'ldc_2d': (ldc_2d.LDCSim, ldc_2d.LDCGeometry,
+               {'lat_nx': 512, 'lat_ny': 512}),
+    'ldc_2d_aa': (ldc_2d.LDCSim, ldc_2d.LDCGeometry,
+                  {'lat_nx': 512, 'lat_ny': 512, 'access_pattern': 'AA'}),
+    'ldc_2d_4sub': (ldc_2d.LDCSim, ldc_2d.LDCGeometry,
+                    {'lat_nx': 512, 'lat_ny': 512, 'ldc_subdomains': 4}),
+    'ldc_3d': (ldc_3d.LDCSim, ldc_3d.LDCGeometry,
+               {'lat_nx': 64, 'lat_ny': 64, 'lat_nz': 64}),
+    'ldc_3d_aa': (ldc_3d.LDCSim, ldc_3d.LDCGeometry,
+                  {'lat_nx': 64, 'lat_ny': 64, 'lat_nz': 64,
+                   'access_pattern': 'AA'}),
+    'ldc_3d_8sub': (ldc_3d.LDCSim, ldc_3d.LDCGeometry,
+                    {'lat_nx': 64, 'lat_ny': 64, 'lat_nz': 64,
+                     'ldc_subdomains': 8}),
+    'sc_2d': (sc_separation_2d.SeparationSCSim, LBGeometry2D,
+              {'lat_nx': 256, 'lat_ny': 256}),
+    'sc_3d': (sc_separation_3d.SeparationSCSim, LBGeometry3D,
+              {'lat_nx': 64, 'lat_ny': 64, 'lat_nz': 64}),
+}
+
+
+def run_case(name, repeats, settings):
+    sim_cls, geo_cls, case_settings = CASES[name]
+    s = dict(settings)
+    s.update(case_settings)
+    samples = []
+    for i in range(repeats):
+        timing_infos, subdomains = harness.run(sim_cls, geo_cls, s)
+        samples.append(harness.throughput(timing_infos, subdomains))
+    return harness.summarize(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Performance regression '
+                                     'suite.')
+    parser.add_argument('--cases', type=str, default='',
+                        help='comma-separated list of cases to run; '
+                        'all cases are run by default')
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='number of samples for every case')
+    parser.add_argument('--iters', type=int, default=1000,
+                        help='number of iterations of every sample')
+    parser.add_argument('--sample_from', type=int, default=200,
+                        help='iteration from which performance is measured')
+    parser.add_argument('--backends', type=str, default='cuda,opencl',
+                        help='compute backends to use')
+    parser.add_argument('--precision', type=str, default='single',
+                        choices=['single', 'double'])
+    parser.add_argument('--host_overhead', action='store_true',
+                        default=False,
+                        help='measure the host overhead of the simulation '
+                        'step instead of the performance of the kernels')
+    parser.add_argument('--output', type=str, default='benchmark.json',
+                        help='name of the results file')
+    parser.add_argument('--baseline', type=str, default='',
+                        help='results file to compare with')
+    parser.add_argument('--threshold', type=float, default=0.05,
+                        help='max tolerated relative drop of throughput')
+    args = parser.parse_args()
+
+    names = args.cases.split(',') if args.cases else sorted(CASES)
+    for name in names:
+        if name not in CASES:
+            parser.error('Unknown case: {0}'.format(name))
+
+    settings = {'max_iters': args.iters,
+                'benchmark_sample_from': args.sample_from,
+                'every': args.iters, 'backends': args.backends,
+                'precision': args.precision,
+                'host_overhead': args.host_overhead}
+    results = {'meta': harness.metadata(settings), 'cases': {}}
+    for name in names:
+        print 'Running {0}...'.format(name),
+        sys.stdout.flush()
+        res = run_case(name, args.repeats, settings)
+        results['cases'][name] = res
+        print '{0:.2f} MLUPS [{1:.2f}, {2:.2f}]'.format(res['mean'],
+                                                       *res['ci'])
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    if not args.baseline:
+        return 0
+
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)['cases']
+
+    failed = []
+    print
+    print 'Comparison with {0}:'.format(args.baseline)
+    for name in names:
+        if name not in baseline:
+            print '  {0:<14} not in baseline'.format(name)
+            continue
+        cmp = harness.compare(results['cases'][name], baseline[name],
+                              args.threshold)
+        results['cases'][name]['comparison'] = cmp
+        print '  {0:<14} {1:+7.2f}% [{2:+.2f}%, {3:+.2f}%]  {4}'.format(
+            name, cmp['change'] * 100, cmp['ci'][0] * 100, cmp['ci'][1] * 100,
+            'REGRESSION' if cmp['regression'] else 'ok')
+        if cmp['regression']:
+            failed.append(name)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    if failed:
+        print 'Performance regressions in: {0}'.format(', '.join(failed))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
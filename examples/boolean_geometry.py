@@ -1,13 +1,17 @@
 #!/usr/bin/env python -u
-"""Demonstrates how to load geometry from a boolean numpy array."""
+"""Demonstrates how to load geometry from a boolean numpy array.
 
-import numpy as np
+The geometry file can be a .npy file (e.g. generated by utils/voxelizer) or a
+packed voxel file (see utils/pack_voxels.py).  The file is memory-mapped, and
+every subdomain only reads the part of the geometry that it covers.
+"""
 
 from sailfish.geo import LBGeometry3D
 from sailfish.subdomain import Subdomain3D
 from sailfish.node_type import NTFullBBWall
 from sailfish.controller import LBSimulationController
 from sailfish.lb_single import LBFluidSim, LBForcedSim
+from sailfish.voxel import VoxelGeometry
 
 
 class BoolSubdomain(Subdomain3D):
@@ -17,16 +21,9 @@ class BoolSubdomain(Subdomain3D):
 
     def boundary_conditions(self, hx, hy, hz):
         wall_bc = NTFullBBWall
-        if hasattr(self.config, 'wall_map'):
-            x0 = np.min(hx)
-            x1 = np.max(hx)
-            y0 = np.min(hy)
-            y1 = np.max(hy)
-            z0 = np.min(hz)
-            z1 = np.max(hz)
-
-            partial_wall_map = self.config.wall_map[z0:z1+1, y0:y1+1, x0:x1+1]
-            self.set_node(partial_wall_map, wall_bc)
+        if self.config.geometry:
+            wall_map = VoxelGeometry(self.config.geometry)
+            self.set_node(wall_map.get_mask(hx, hy, hz), wall_bc)
 
 
 class BoolSimulation(LBFluidSim, LBForcedSim):
@@ -45,10 +42,10 @@ class BoolSimulation(LBFluidSim, LBForcedSim):
         if not config.geometry:
             return
 
-        # Override lattice size based on the geometry file.
-        wall_map = np.load(config.geometry)
+        # Override lattice size based on the geometry file.  Only the file
+        # header is read here.
+        wall_map = VoxelGeometry(config.geometry)
         config.lat_nz, config.lat_ny, config.lat_nx = wall_map.shape
-        config._wall_map = wall_map
 
 
 if __name__ == '__main__':
@@ -0,0 +1,137 @@
+"""Persistent database of tuned block sizes and memory alignments.
+
+The optimal block size (--block_size) and memory alignment (--mem_alignment)
+depend on the size of the subdomain, the simulation, the LB model, the
+precision, the memory access pattern and the compute device.  With
+--autotune, the controller benchmarks all candidate combinations for a few
+hundred steps each, and saves the fastest one for every subdomain in the
+tuning database (--autotune_db).  In normal runs, the subdomain runners look
+up their configuration in the database and use the tuned values, unless the
+block size or memory alignment were set explicitly (on the command line, in
+the simulation script or in .sailfishrc).
+
+The database is a JSON file mapping keys (see make_key()) to dicts with the
+best block size, memory alignment and throughput, as well as the throughput
+of all benchmarked candidates.  When running on a cluster, the database is
+written on the controller host, and looked up on the hosts where the
+subdomains are simulated.
+"""
+
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'LGPL3'
+
+import json
+import os
+import tempfile
+import time
+
+BLOCK_SIZES = [32, 64, 96, 128, 192, 256]
+ALIGNMENTS = [32, 64, 128]
+
+
+def candidates(block_sizes, alignments):
+    """Returns a list of (block size, memory alignment) tuples to benchmark.
+
+    The block size has to be at least as large as the memory alignment.
+    """
+    return [(bs, align) for bs in sorted(block_sizes) for align in
+            sorted(alignments) if bs >= align]
+
+
+def make_key(config, spec, sim, backend):
+    """Returns the database key for a subdomain.
+
+    :param spec: SubdomainSpec of the subdomain
+    :param sim: LBSim instance
+    :param backend: compute backend instance
+    """
+    return '/'.join([backend.name, backend.info or '?',
+                     sim.__class__.__name__, config.grid,
+                     getattr(config, 'model', '-'), config.precision,
+                     config.access_pattern,
+                     'x'.join(str(x) for x in spec.size)])
+
+
+class TuningDB(object):
+    """Tuning database stored in a JSON file."""
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    def load(self):
+        """Returns a dict with the contents of the database.  A missing or
+        unreadable file is treated as an empty database."""
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, key):
+        """Returns the entry for key, or None if there is none."""
+        return self.load().get(key)
+
+    def update(self, entries):
+        """Adds entries to the database, replacing existing ones with the
+        same keys.
+
+        The file is re-read before writing and replaced atomically, so that
+        concurrent updates of different keys are less likely to be lost.
+
+        :param entries: dict mapping keys to entries
+        """
+        dirname = os.path.dirname(self.path) or '.'
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        data = self.load()
+        data.update(entries)
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.autotune')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.path)
+
+
+def best_entries(results):
+    """Selects the best candidate for every key.
+
+    :param results: list of (key, block size, memory alignment, MLUPS)
+        tuples; multiple results for the same key and candidate (e.g. from
+        subdomains of the same size) are averaged
+    :rvalue: dict mapping keys to database entries
+    """
+    samples = {}
+    for key, bs, align, mlups in results:
+        samples.setdefault(key, {}).setdefault((bs, align), []).append(mlups)
+
+    ret = {}
+    now = time.strftime('%Y-%m-%d %H:%M:%S')
+    for key, cands in samples.iteritems():
+        mean = dict((c, sum(v) / len(v)) for c, v in cands.iteritems())
+        bs, align = max(mean, key=mean.get)
+        ret[key] = {'block_size': bs, 'mem_alignment': align,
+                    'mlups': mean[(bs, align)], 'time': now,
+                    'candidates': dict(('{0}/{1}'.format(*c), m) for c, m in
+                                       mean.iteritems())}
+    return ret
+
+
+def apply_tuned(config, key):
+    """Sets the block size and memory alignment in config to the tuned
+    values for key, if any.
+
+    The two values are tuned jointly, so neither is changed if any of them
+    was set explicitly.
+
+    :rvalue: the database entry that was applied, or None
+    """
+    if (not config.autotune_db or config.is_explicit('block_size') or
+        config.is_explicit('mem_alignment')):
+        return None
+
+    entry = TuningDB(config.autotune_db).get(key)
+    if entry is None:
+        return None
+    config.block_size = entry['block_size']
+    config.mem_alignment = entry['mem_alignment']
+    return entry
@@ -107,6 +107,24 @@ class CUDABackend(object):
     def total_memory(self):
         return self._device.total_memory()
 
+    @property
+    def peak_bandwidth(self):
+        """Theoretical peak memory bandwidth of the device in bytes/s, or
+        None if it cannot be determined."""
+        attr = cuda.device_attribute
+        if not hasattr(attr, 'MEMORY_CLOCK_RATE'):
+            return None
+        # Clock rate is in kHz, bus width in bits.  The factor of 2
+        # accounts for double data rate memory.
+        clock = self._device.get_attribute(attr.MEMORY_CLOCK_RATE)
+        width = self._device.get_attribute(attr.GLOBAL_MEMORY_BUS_WIDTH)
+        return 2.0 * clock * 1e3 * width / 8
+
+    @property
+    def allocated_memory(self):
+        """Number of bytes of device memory allocated with alloc_buf()."""
+        return self._total_memory_bytes
+
     def set_iteration(self, it):
         for kernel in self._iteration_kernels:
             kernel.args[-1] = it
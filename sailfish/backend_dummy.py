@@ -1,4 +1,5 @@
-"""A dummy Sailfish backend.  Used for testing."""
+"""A dummy Sailfish backend.  Used for testing and for measuring the host
+overhead of simulations (--host_overhead), where all kernels are no-ops."""
 
 __author__ = 'Michal Januszewski'
 __email__ = 'sailfish-cfd@googlegroups.com'
@@ -7,15 +8,28 @@ __license__ = 'LGPL3'
 import numpy as np
 
 class DummyBackend(object):
+    name = 'dummy'
+    info = 'dummy backend'
+    supports_printf = False
+
+    FatalError = RuntimeError
 
     @classmethod
     def add_options(cls, group):
         return 0
 
-    def __init__(self, options=None):
+    def __init__(self, options=None, gpu_id=None):
         self.buffers = {}
         self.arrays = {}
 
+    @property
+    def allocated_memory(self):
+        return 0
+
+    @property
+    def peak_bandwidth(self):
+        return None
+
     def alloc_buf(self, size=None, like=None, wrap_in_array=True):
         return like
 
@@ -31,10 +45,11 @@ class DummyBackend(object):
     def build(self, source):
         pass
 
-    def get_kernel(self, prog, name, block, args, args_format, shared=None, fields=[]):
+    def get_kernel(self, prog, name, block, args, args_format, shared=None,
+            needs_iteration=False):
         return None
 
-    def run_kernel(self, kernel, grid_size):
+    def run_kernel(self, kernel, grid_size, stream=None):
         return None
 
     def get_reduction_kernel(self, reduce_expr, map_expr, neutral, *args):
@@ -43,6 +58,9 @@ class DummyBackend(object):
     def sync(self):
         pass
 
+    def set_iteration(self, it):
+        pass
+
     def to_buf_async(self, *args):
         pass
 
@@ -69,7 +87,11 @@ class DummyStream(object):
     def synchronize(self):
         pass
 
+    def wait_for_event(self, event):
+        pass
+
 class DummyEvent(object):
-    pass
+    def time_since(self, event):
+        return 0.0
 
 backend=DummyBackend
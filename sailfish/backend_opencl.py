@@ -46,10 +46,21 @@ class OpenCLBackend(object):
         self.buffers = {}
         self.arrays = {}
         self._iteration_kernels = []
+        self._total_memory_bytes = 0
 
     @property
     def info(self):
-        return ''
+        return self.ctx.devices[0].name.strip()
+
+    @property
+    def peak_bandwidth(self):
+        # OpenCL does not provide a way to query the memory bandwidth.
+        return None
+
+    @property
+    def allocated_memory(self):
+        """Number of bytes of device memory allocated with alloc_buf()."""
+        return self._total_memory_bytes
 
     @property
     def supports_printf(self):
@@ -69,11 +80,13 @@ class OpenCLBackend(object):
                 hbuf = like
 
             buf = cl.Buffer(self.ctx, mf.READ_WRITE | mf.COPY_HOST_PTR, hostbuf=hbuf)
+            self._total_memory_bytes += hbuf.nbytes
             self.buffers[buf] = hbuf
             self.to_buf(buf)
             if wrap_in_array:
                 self.arrays[buf] = clarray.Array(self.ctx, like.shape, like.dtype, data=buf)
         else:
+            self._total_memory_bytes += size
             buf = cl.Buffer(self.ctx, mf.READ_WRITE, size)
 
         return buf
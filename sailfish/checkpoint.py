@@ -0,0 +1,301 @@
+"""Checkpoint files.
+
+A checkpoint is an .npz file with the following entries:
+ - 'state': pickled simulation state (see LBSim.get_state()),
+ - 'meta': pickled dict describing the checkpoint,
+ - 'dist<i>': compressed distributions for the i-th grid.
+
+Only the live copy of the distributions is stored (after a simulation step,
+this is the only copy that is read in the next step).  The data is
+compressed with one of the codecs from sailfish.codec.
+
+A checkpoint can be incremental, in which case it only stores planes
+(along the slowest-varying spatial axis) of the distributions which changed
+since a reference (full) checkpoint.  The reference checkpoint has to be
+located in the same directory.  A checksum of the reference distributions
+is stored in the incremental checkpoint, so that it cannot be applied to
+a different reference (e.g. one which was overwritten by a newer full
+checkpoint).
+
+Every subdomain saves its own checkpoint file, which records the placement
+of the subdomain within the global domain.  This makes it possible to
+restore a simulation using a different subdomain decomposition (see
+load_region()).
+"""
+
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'LGPL3'
+
+import cPickle as pickle
+import glob
+import operator
+import os
+import struct
+import zipfile
+import zlib
+import numpy as np
+
+from sailfish import codec
+
+FORMAT_VERSION = 2
+
+
+def _to_bytes(arr):
+    if arr.dtype == np.uint8:
+        return arr.tostring()
+    # Older checkpoints store pickled data as numpy strings.
+    return str(arr)
+
+
+def changed_planes(dist, reference, tolerance=0.0):
+    """Returns indices of planes in which dist and reference differ.
+
+    :param dist: distributions array, with the slowest-varying spatial axis
+        as axis 1
+    :param reference: distributions array to compare against
+    :param tolerance: max allowed absolute difference for planes which are
+        considered unchanged
+    """
+    ret = []
+    for i in xrange(dist.shape[1]):
+        # Written in a way that makes NaNs always count as a change.
+        if not np.all(np.abs(dist[:, i] - reference[:, i]) <= tolerance):
+            ret.append(i)
+    return ret
+
+
+def checksum(dists):
+    """Returns a CRC32 checksum of a list of distribution arrays."""
+    crc = 0
+    for dist in dists:
+        crc = zlib.crc32(np.ascontiguousarray(dist).data, crc)
+    return crc & 0xffffffff
+
+
+def write(fname, state, dists, codec_spec='zlib:1', reference=None,
+          tolerance=0.0, placement=None):
+    """Writes a checkpoint file.
+
+    The file is first written under a temporary name and then renamed, so
+    that an interrupted write never leaves a corrupted checkpoint behind.
+
+    :param fname: checkpoint file name
+    :param state: pickled simulation state
+    :param dists: list of distribution arrays, one for every grid
+    :param codec_spec: codec used to compress the distributions
+    :param reference: if not None, a (file name, dists) tuple for a full
+        checkpoint; only planes which changed relative to it will be saved
+    :param tolerance: see changed_planes()
+    :param placement: dict describing the location of the subdomain within
+        the global domain, with the following keys: location, size (in
+        natural order, i.e. x, y, [z]; non-ghost nodes only), envelope_size
+        (number of ghost nodes on every side of the subdomain)
+    """
+    c = codec.get_codec(codec_spec)
+    meta = {'version': FORMAT_VERSION, 'codec': codec_spec, 'grids': [],
+            'reference': None, 'placement': placement}
+    data = {'state': np.frombuffer(state, dtype=np.uint8)}
+
+    for i, dist in enumerate(dists):
+        grid = {'shape': dist.shape, 'dtype': dist.dtype.str}
+        if reference is not None:
+            planes = changed_planes(dist, reference[1][i], tolerance)
+            grid['planes'] = planes
+            dist = dist[:, planes]
+        data['dist{0}'.format(i)] = np.frombuffer(c.encode(dist), dtype=np.uint8)
+        meta['grids'].append(grid)
+
+    if reference is not None:
+        meta['reference'] = os.path.basename(reference[0])
+        meta['reference_checksum'] = checksum(reference[1])
+
+    data['meta'] = np.frombuffer(pickle.dumps(meta, -1), dtype=np.uint8)
+
+    tmp = fname + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **data)
+    os.rename(tmp, fname)
+
+
+def remove(fname):
+    """Removes a checkpoint file, if it exists."""
+    try:
+        os.unlink(fname)
+    except OSError:
+        pass
+
+
+def read(fname):
+    """Reads a checkpoint file.
+
+    :param fname: checkpoint file name
+    :rvalue: tuple of: simulation state, list of distribution arrays (one for
+        every grid), list of arrays for the secondary copy of the
+        distributions or None if not available
+    """
+    cpoint = np.load(fname)
+    try:
+        state = pickle.loads(_to_bytes(cpoint['state']))
+
+        # Legacy format: both copies of the distributions are stored
+        # uncompressed.
+        if 'meta' not in cpoint.files:
+            num_grids = len([k for k in cpoint.files if k.startswith('dist')]) / 2
+            return (state,
+                    [cpoint['dist{0}a'.format(i)] for i in range(num_grids)],
+                    [cpoint['dist{0}b'.format(i)] for i in range(num_grids)])
+
+        meta = pickle.loads(_to_bytes(cpoint['meta']))
+        if meta['version'] > FORMAT_VERSION:
+            raise ValueError('Unsupported checkpoint version: {0}'.format(
+                meta['version']))
+
+        if meta['reference'] is not None:
+            ref_fname = os.path.join(os.path.dirname(fname), meta['reference'])
+            _, ref_dists, _ = read(ref_fname)
+            if ('reference_checksum' in meta and
+                    checksum(ref_dists) != meta['reference_checksum']):
+                raise ValueError('Incremental checkpoint {0} does not match '
+                                 'its reference {1}, which was probably '
+                                 'overwritten by a newer checkpoint.'.format(
+                                     fname, ref_fname))
+
+        c = codec.get_codec(meta['codec'])
+        dists = []
+        for i, grid in enumerate(meta['grids']):
+            shape = list(grid['shape'])
+            values = c.decode(_to_bytes(cpoint['dist{0}'.format(i)]),
+                              grid['dtype'])
+            if 'planes' in grid:
+                dist = ref_dists[i]
+                shape[1] = len(grid['planes'])
+                dist[:, grid['planes']] = values.reshape(shape)
+            else:
+                dist = values.reshape(shape).copy()
+            dists.append(dist)
+
+        return state, dists, None
+    finally:
+        cpoint.close()
+
+
+def read_meta(fname):
+    """Returns the description of a checkpoint file.
+
+    :rvalue: tuple of: simulation state, dict describing the checkpoint (see
+        write()), or None for checkpoints in the legacy format
+    """
+    cpoint = np.load(fname)
+    try:
+        state = pickle.loads(_to_bytes(cpoint['state']))
+        if 'meta' not in cpoint.files:
+            return state, None
+        return state, pickle.loads(_to_bytes(cpoint['meta']))
+    finally:
+        cpoint.close()
+
+
+def piece_files(fname):
+    """Returns the names of checkpoint files saved by all subdomains, given
+    the name of a checkpoint file saved by any of them.
+
+    :param fname: checkpoint file name, as generated by
+        sailfish.io.checkpoint_filename()
+    """
+    dirname, name = os.path.split(fname)
+    parts = name.split('.')
+    # The name has the form: <base>.<subdomain_id>.<iteration>.cpoint[...]
+    idx = len(parts) - 1 - parts[::-1].index('cpoint') - 2
+    parts[idx] = '*'
+    return sorted(glob.glob(os.path.join(dirname, '.'.join(parts))))
+
+
+def _memmap_member(fname, name):
+    """Returns a read-only memory-mapped array for an uncompressed member
+    of an .npz file."""
+    zf = zipfile.ZipFile(fname)
+    try:
+        info = zf.getinfo(name + '.npy')
+    finally:
+        zf.close()
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+
+    with open(fname, 'rb') as f:
+        # Skip the local file header of the zip member.
+        f.seek(info.header_offset)
+        header = f.read(30)
+        name_len, extra_len = struct.unpack('<HH', header[26:30])
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        np.lib.format.read_magic(f)
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        offset = f.tell()
+
+    return np.memmap(fname, dtype=dtype, mode='r', offset=offset, shape=shape,
+                     order='F' if fortran_order else 'C')
+
+
+def _read_dists_region(fname, meta, selector):
+    """Returns a list of distribution arrays restricted to a region.
+
+    :param selector: list of slices selecting the region along the spatial
+        axes of the distribution arrays
+    """
+    selector = [slice(None)] + list(selector)
+    if meta['codec'] == 'none' and meta['reference'] is None:
+        # Uncompressed data is memory-mapped, so that only the selected
+        # region is read from disk.
+        ret = []
+        for i, grid in enumerate(meta['grids']):
+            data = _memmap_member(fname, 'dist{0}'.format(i))
+            if data is None:
+                break
+            ret.append(np.array(data.view(grid['dtype']).reshape(
+                grid['shape'])[selector]))
+        else:
+            return ret
+
+    _, dists, _ = read(fname)
+    return [dist[selector] for dist in dists]
+
+
+def load_region(fnames, start, stop, dists, dist_start):
+    """Copies distributions for a region of the global domain from a set of
+    checkpoint files.
+
+    Only the non-ghost nodes of every checkpointed subdomain are used, and
+    only files for subdomains overlapping the region are read.
+
+    :param fnames: checkpoint file names (see piece_files())
+    :param start: location of the first node of the region (inclusive),
+        slowest-varying axis first
+    :param stop: location of the last node of the region (exclusive)
+    :param dists: list of distribution arrays to fill, one for every grid
+    :param dist_start: location in the dists arrays (spatial axes only),
+        corresponding to start
+    :rvalue: number of nodes filled
+    """
+    filled = 0
+    for fname in fnames:
+        _, meta = read_meta(fname)
+        if meta is None or meta.get('placement') is None:
+            raise ValueError('Checkpoint {0} does not contain subdomain '
+                             'placement information.'.format(fname))
+        placement = meta['placement']
+        c0 = list(reversed(placement['location']))
+        c1 = [a + n for a, n in zip(c0, reversed(placement['size']))]
+        lo = [max(a, b) for a, b in zip(start, c0)]
+        hi = [min(a, b) for a, b in zip(stop, c1)]
+        if any(a >= b for a, b in zip(lo, hi)):
+            continue
+
+        es = placement['envelope_size']
+        src = [slice(a - c + es, b - c + es) for a, b, c in zip(lo, hi, c0)]
+        dst = [slice(a - s + d, b - s + d) for a, b, s, d in
+               zip(lo, hi, start, dist_start)]
+        for dist, data in zip(dists, _read_dists_region(fname, meta, src)):
+            dist[[slice(None)] + dst] = data
+        filled += reduce(operator.mul, [b - a for a, b in zip(lo, hi)])
+
+    return filled
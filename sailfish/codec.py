@@ -0,0 +1,124 @@
+"""Compression codecs for field data.
+
+Codecs are identified by specification strings:
+ - 'none': no compression,
+ - 'zlib[:level]': zlib, applied to byte-shuffled data,
+ - 'blosc:<compressor>[:level]': blosc with byte shuffling, using one of
+   the compressors supported by blosc (e.g. 'lz4', 'zstd'); requires the
+   blosc module.
+
+Byte shuffling groups together the n-th bytes of all array elements, which
+makes floating point data considerably more compressible.
+"""
+
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'LGPL3'
+
+import zlib
+
+try:
+    import blosc
+except ImportError:
+    pass
+
+import numpy as np
+
+
+def shuffle(arr):
+    """Returns the bytes of an array, grouped by their position within an
+    element."""
+    arr = np.ascontiguousarray(arr)
+    return np.ascontiguousarray(
+        arr.view(np.uint8).reshape((-1, arr.dtype.itemsize)).T).tostring()
+
+
+def unshuffle(data, dtype):
+    """Inverse of shuffle(); returns a 1D array."""
+    dtype = np.dtype(dtype)
+    buf = np.frombuffer(data, dtype=np.uint8).reshape((dtype.itemsize, -1))
+    return np.ascontiguousarray(buf.T).view(dtype).ravel()
+
+
+class RawCodec(object):
+    name = 'none'
+
+    def encode(self, arr):
+        return np.ascontiguousarray(arr).tostring()
+
+    def decode(self, data, dtype):
+        return np.frombuffer(data, dtype=dtype)
+
+
+class ZlibCodec(object):
+    name = 'zlib'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def encode(self, arr):
+        return zlib.compress(shuffle(arr), self.level)
+
+    def decode(self, data, dtype):
+        return unshuffle(zlib.decompress(data), dtype)
+
+
+class BloscCodec(object):
+    name = 'blosc'
+
+    def __init__(self, cname='lz4', level=5):
+        self.cname = cname
+        self.level = level
+
+    def encode(self, arr):
+        arr = np.ascontiguousarray(arr)
+        return blosc.compress(arr.tostring(), typesize=arr.dtype.itemsize,
+                              clevel=self.level, shuffle=blosc.SHUFFLE,
+                              cname=self.cname)
+
+    def decode(self, data, dtype):
+        return np.frombuffer(blosc.decompress(data), dtype=dtype)
+
+
+def get_codec(spec):
+    """Returns a codec object corresponding to a specification string.
+
+    :param spec: codec specification, see the module docstring
+    """
+    parts = spec.split(':')
+    name = parts[0]
+    try:
+        if name == 'none' and len(parts) == 1:
+            return RawCodec()
+        elif name == 'zlib' and len(parts) <= 2:
+            return ZlibCodec(*[int(x) for x in parts[1:]])
+        elif name == 'blosc' and 2 <= len(parts) <= 3:
+            if 'blosc' not in globals():
+                raise ValueError('The blosc module is required for codec '
+                                 '{0}.'.format(spec))
+            return BloscCodec(parts[1], *[int(x) for x in parts[2:]])
+    except (TypeError, ValueError) as e:
+        raise ValueError('Invalid codec specification {0}: {1}'.format(spec, e))
+    raise ValueError('Unknown codec: {0}'.format(spec))
+
+
+def quantize(arr, abs_error):
+    """Quantizes floating point data so that the absolute error does not
+    exceed abs_error.
+
+    :param arr: array to quantize; all values have to be finite
+    :param abs_error: max absolute error
+    :rvalue: integer array of the smallest type that can represent the
+        quantized values
+    """
+    q = np.round(np.asarray(arr, dtype=np.float64) / (2.0 * abs_error))
+    qmax = np.max(np.abs(q)) if q.size else 0
+    for dtype in (np.int8, np.int16, np.int32, np.int64):
+        if qmax <= np.iinfo(dtype).max:
+            return q.astype(dtype)
+    raise ValueError('Data range too large for quantization.')
+
+
+def dequantize(q, abs_error, dtype):
+    """Inverse of quantize()."""
+    return (q * (2.0 * abs_error)).astype(dtype)
@@ -24,6 +24,12 @@ class LBConfig(argparse.Namespace):
     def needs_iteration_num(self):
         return self.time_dependence or self.access_pattern == 'AA'
 
+    def is_explicit(self, option):
+        """Returns True if option was set on the command line, in a
+        .sailfishrc file or via LBConfigParser.set_defaults() (e.g. by the
+        simulation class)."""
+        return option in getattr(self, '_explicit', ())
+
 
 class LBConfigParser(object):
     def __init__(self, description=None):
@@ -39,6 +45,8 @@ class LBConfigParser(object):
                 action='store_true', default=False)
 
         self.config = LBConfig()
+        # Options with defaults overridden by set_defaults().
+        self._explicit = set()
 
     def add_group(self, name):
         return self._parser.add_argument_group(name)
@@ -47,6 +55,7 @@ class LBConfigParser(object):
         for option in defaults.iterkeys():
             assert self._parser.get_default(option) is not None,\
                     'Unknown option "{0}" specified in update_defaults()'.format(option)
+        self._explicit.update(defaults.iterkeys())
         return self._parser.set_defaults(**defaults)
 
     def parse(self, args, internal_defaults=None):
@@ -59,7 +68,9 @@ class LBConfigParser(object):
         # supported.
         self.config.incompressible = False
         try:
-            self._parser.set_defaults(**dict(config.items('main')))
+            rc_defaults = dict(config.items('main'))
+            self._parser.set_defaults(**rc_defaults)
+            self._explicit.update(rc_defaults.iterkeys())
         except ConfigParser.NoSectionError:
             pass
 
@@ -67,6 +78,7 @@ class LBConfigParser(object):
             self._parser.set_defaults(**internal_defaults)
 
         self._parser.parse_args(args=args, namespace=self.config)
+        self.config._explicit = self._explicit | self._cmdline_options(args)
 
         # Additional internal config options, not settable via
         # command line parameters.
@@ -82,6 +94,16 @@ class LBConfigParser(object):
         self.config.unit_test = False
         return self.config
 
+    def _cmdline_options(self, args):
+        """Returns the set of names of options specified in args."""
+        # argparse only sets the default value of an option if the namespace
+        # does not have the corresponding attribute yet.
+        unset = object()
+        namespace = argparse.Namespace(**dict(
+            (action.dest, unset) for action in self._parser._actions))
+        self._parser.parse_known_args(args=args, namespace=namespace)
+        return set(k for k, v in vars(namespace).iteritems() if v is not unset)
+
 
 class MachineSpec(object):
     """Declares information about a machine."""
@@ -12,7 +12,7 @@ import os
 import tempfile
 
 import numpy as np
-from multiprocessing import Array, Event
+from multiprocessing import Array, Event, RawArray
 
 # Note: this connector is currently slower than ZMQSubdomainConnector using
 # IPC.
@@ -67,6 +67,48 @@ class MPSubdomainConnector(object):
                 MPSubdomainConnector(array2, array1, ev2, ev1, ev4, ev3))
 
 
+class InMemorySubdomainConnector(object):
+    """Exchanges data between two subdomains on the same host through shared
+    memory, without any synchronization.
+
+    The receiver gets whatever was last written by the sender, so this
+    connector does not produce correct simulation results.  It is used to
+    measure the host overhead of the simulation (--host_overhead), where the
+    communication cost is to be excluded and every subdomain runner is to
+    proceed at its own pace."""
+
+    def __init__(self, send_array, recv_array):
+        self._send_array = send_array
+        self._recv_array = recv_array
+        self.port = None
+        self.ipc_file = None
+
+    def init_runner(self, ctx):
+        """Called from the block runner of the sender block."""
+        # Create the views in the runner process.
+        self._send = np.ctypeslib.as_array(self._send_array)
+        self._recv = np.ctypeslib.as_array(self._recv_array)
+
+    def send(self, data):
+        self._send[:] = data
+
+    def recv(self, data, quit_ev):
+        if quit_ev.is_set():
+            return False
+        data[:] = self._recv
+        return True
+
+    def is_ready(self):
+        return True
+
+    @classmethod
+    def make_pair(self, ctype, sizes, ids):
+        array1 = RawArray(ctype, sizes[0])
+        array2 = RawArray(ctype, sizes[1])
+        return (InMemorySubdomainConnector(array1, array2),
+                InMemorySubdomainConnector(array2, array1))
+
+
 class ZMQSubdomainConnector(object):
     """Handles directed data exchange between two subdomains using 0MQ."""
 
@@ -140,6 +182,8 @@ class ZMQRemoteSubdomainConnector(ZMQSubdomainConnector):
 
     def get_addr(self):
         iface = self._addr.replace('tcp://', '')
+        if iface == '127.0.0.1':
+            return iface
         # Local import so that other connectors can work without this module.
         import netifaces
         if iface in netifaces.interfaces():
@@ -25,7 +25,7 @@ from multiprocessing import Process
 
 import execnet
 import zmq
-from sailfish import codegen, config, io, util
+from sailfish import autotune, codegen, config, diagnostics, io, metrics, overlap, profile, roofline, trace, util
 from sailfish.geo import LBGeometry2D, LBGeometry3D
 from sailfish.subdomain import SubdomainPair
 
@@ -290,6 +290,85 @@ class LBSimulationController(object):
         group.add_argument('--output_format',
             help='output format', type=str,
             choices=io.format_name_to_cls.keys(), default='npy')
+        group.add_argument('--output_region',
+            help='only save simulation results for nodes within a box; '
+            'the box is specified as x0:x1,y0:y1[,z0:z1], where any of the '
+            'bounds can be omitted, and a single number selects a plane',
+            type=str, default='')
+        group.add_argument('--output_stride',
+            help='only save simulation results for every N-th node; can '
+            'be specified separately for every axis', type=int, nargs='+',
+            metavar='N', default=[1])
+        group.add_argument('--output_fields',
+            help='names of the fields to save; all fields are saved if '
+            'not specified', type=str, nargs='+', metavar='FIELD',
+            default=[])
+        group.add_argument('--output_codec',
+            help='compression codec used for fields saved in the chunked '
+            'output format: none, zlib[:level], or blosc:<compressor>[:level] '
+            '(e.g. blosc:zstd)', type=str, default='zlib')
+        group.add_argument('--output_field_codecs',
+            help='compression codecs for specific fields, overriding '
+            '--output_codec', nargs='+', metavar='FIELD=CODEC', default=[])
+        group.add_argument('--output_abs_error',
+            help='quantizes specific fields in the chunked output format, '
+            'so that the absolute error of the saved values is not larger '
+            'than the specified value', nargs='+', metavar='FIELD=ERROR',
+            default=[])
+        group.add_argument('--output_chunk_size',
+            help='max size of the chunks into which every subdomain is split '
+            'in the chunked output format, in nodes; can be specified '
+            'separately for every axis, and 0 disables splitting along an '
+            'axis', type=int, nargs='+', metavar='N', default=[64])
+        group.add_argument('--output_queue_size',
+            help='if > 0, output files and checkpoints are written '
+            'asynchronously by a background thread, with at most N '
+            'snapshots waiting to be written; the simulation is paused when '
+            'the queue is full', metavar='N', type=int, default=0)
+        group.add_argument('--probes',
+            help='record time series of fields at probe locations listed '
+            'in FILE (one probe per line, as x y [z] global coordinates)',
+            metavar='FILE', type=str, default='')
+        group.add_argument('--probe_fields',
+            help='names of the fields to sample at probe locations; all '
+            'floating point fields are sampled if not specified',
+            type=str, nargs='+', metavar='FIELD', default=[])
+        group.add_argument('--probe_every',
+            help='sample fields at probe locations every N iterations',
+            metavar='N', type=int, default=1)
+        group.add_argument('--probe_buffer',
+            help='number of probe samples kept on the compute device '
+            'before they are saved', metavar='N', type=int, default=100)
+        group.add_argument('--probe_interpolate', action='store_true',
+            default=False, help='linearly interpolate fields at probe '
+            'locations instead of using the value at the nearest node')
+        group.add_argument('--reductions_every',
+            help='evaluate the reductions declared by the simulation (see '
+            'LBSim.get_reductions()) every N iterations; reductions are '
+            'disabled if 0', metavar='N', type=int, default=0)
+        group.add_argument('--reductions_file',
+            help='append values of the reductions to FILE, in addition to '
+            'logging them', metavar='FILE', type=str, default='')
+        group.add_argument('--trace_from',
+            help='first iteration to include in the timeline trace',
+            metavar='N', type=int, default=0)
+        group.add_argument('--trace_iters',
+            help='record a timeline trace of N iterations, which can be '
+            'viewed in chrome://tracing or Perfetto', metavar='N', type=int,
+            default=0)
+        group.add_argument('--trace_file',
+            help='name of the timeline trace file', metavar='FILE',
+            type=str, default='trace.json')
+        group.add_argument('--metrics_every',
+            help='publish live performance metrics of every subdomain every '
+            'N iterations (see utils/monitor.py); use 0 to disable',
+            metavar='N', type=int, default=0)
+        group.add_argument('--metrics_port',
+            help='TCP port on which live metrics are published; if 0, '
+            'a random port is used', type=int, default=0)
+        group.add_argument('--metrics_http_port',
+            help='if not 0, serve the latest live metrics in the Prometheus '
+            'text format on this TCP port', type=int, default=0)
         group.add_argument('--backends',
             type=str, default='cuda,opencl',
             help='computational backends to use; multiple backends '
@@ -346,6 +425,12 @@ class LBSimulationController(object):
                 default=True, help='If True, will terminate the simulation '
                 'when invalid values (inf, nan) are detected in the domain '
                 'during the simulation.')
+        group.add_argument('--local_connector', type=str, default='ipc',
+                choices=['ipc', 'tcp'], help='Type of connections between '
+                'subdomains handled by the same machine: 0MQ IPC sockets, '
+                'or TCP sockets on the loopback interface (as used between '
+                'machines, and compressed with '
+                '--compress_intersubdomain_data).')
         group.add_argument('--compress_intersubdomain_data',
                 action='store_true', default=False, help='Uses blosc to '
                 'compress data exchanged between subdomains. Can improve '
@@ -374,6 +459,17 @@ class LBSimulationController(object):
         group.add_argument('--checkpoint_from', type=int, default=0,
                 metavar='N', help='Starts generating checkpoints after N '
                 'steps of the simulation have been completed.')
+        group.add_argument('--checkpoint_codec', type=str, default='zlib:1',
+                help='Compression codec for checkpoint files (see '
+                '--output_codec).')
+        group.add_argument('--checkpoint_incremental', type=int, default=0,
+                metavar='N', help='If > 0, only every N-th checkpoint is a '
+                'full one. The others only store the parts of the '
+                'distributions which changed since the last full checkpoint.')
+        group.add_argument('--checkpoint_tolerance', type=float, default=0.0,
+                help='Max absolute change of the distributions for which '
+                'a part of the domain is considered unchanged in '
+                'incremental checkpoints.')
 
         group = self._config_parser.add_group('Benchmarking')
         group.add_argument('--benchmark_sample_from', type=int, default=1000,
@@ -382,6 +478,46 @@ class LBSimulationController(object):
         group.add_argument('--benchmark_minibatch', type=int, default=50,
                            help='Number of simulation steps used for batching '
                            'for purposes of standard deviation calculation.')
+        group.add_argument('--peak_bandwidth', type=float, default=0.0,
+                           metavar='GB/s', help='Peak memory bandwidth of the '
+                           'compute devices, used to evaluate the achieved '
+                           'bandwidth of the kernels. If 0, the value reported '
+                           'by the backend (if any) is used.')
+        group.add_argument('--bandwidth_file', type=str, default='',
+                           metavar='FILE', help='Save the achieved memory '
+                           'bandwidth of every kernel to FILE.')
+        group.add_argument('--profile_report', type=str, default='',
+                           metavar='FILE', help='Save a JSON report with '
+                           'statistics (including latency percentiles) of all '
+                           'profiling timers to FILE. Timers are sampled '
+                           'starting at --benchmark_sample_from.')
+        group.add_argument('--host_overhead', action='store_true',
+                           default=False, help='Measure the host-side cost '
+                           'of the simulation step. Implies --mode=benchmark. '
+                           'All kernels are replaced with no-ops (dummy '
+                           'backend) and subdomains exchange data through '
+                           'shared memory without synchronization, so the '
+                           'results of the simulation are meaningless.')
+        group.add_argument('--autotune', action='store_true', default=False,
+                           help='Benchmark all combinations of the candidate '
+                           'block sizes and memory alignments, and save the '
+                           'fastest one for every subdomain in the tuning '
+                           'database.')
+        group.add_argument('--autotune_db', type=str,
+                           default='~/.sailfish/autotune.json', metavar='FILE',
+                           help='Tuning database. Unless --block_size or '
+                           '--mem_alignment are set explicitly, the values '
+                           'found by --autotune for the simulated subdomains '
+                           'are used. Set to an empty string to disable.')
+        group.add_argument('--autotune_iters', type=int, default=300,
+                           metavar='N', help='Number of iterations to run '
+                           'for every candidate with --autotune.')
+        group.add_argument('--autotune_block_sizes', type=int, nargs='+',
+                           default=autotune.BLOCK_SIZES, metavar='N',
+                           help='Candidate block sizes for --autotune.')
+        group.add_argument('--autotune_alignments', type=int, nargs='+',
+                           default=autotune.ALIGNMENTS, metavar='N',
+                           help='Candidate memory alignments for --autotune.')
         group = self._config_parser.add_group('Simulation-specific settings')
 
         lb_class.add_options(group, self.dim)
@@ -397,6 +533,7 @@ class LBSimulationController(object):
 
         group = self._config_parser.add_group('Geometry settings')
         lb_geo.add_options(group)
+        lb_class.subdomain.add_options(group)
 
         group = self._config_parser.add_group('Code generator options')
         codegen.BlockCodeGenerator.add_options(group)
@@ -588,7 +725,17 @@ class LBSimulationController(object):
         else:
             self._start_local_simulation(subdomains)
 
-    def _wait_for_masters(self):
+    def _wait_for_masters(self, summaries, reduction_collector=None):
+        """Waits for all machine masters to finish.
+
+        Timing summaries and partial reduction results sent by the masters
+        in the meantime are processed as they arrive.
+
+        :param summaries: list to which (timing info, min timings, max
+            timings, report) tuples received from the masters are appended
+        :param reduction_collector: ReductionCollector merging the partial
+            reduction results from all machines
+        """
         done = set()
         while len(done) != len(self._cluster_channels):
             for i, ch in enumerate(self._cluster_channels):
@@ -606,7 +753,12 @@ class LBSimulationController(object):
                     execnet.default_group.terminate(timeout=5)
                     return
 
-                if data != 'FIN':
+                if type(data) is tuple and data[0] == 'reductions':
+                    if reduction_collector is not None:
+                        reduction_collector.add(data[1], data[2])
+                elif type(data) is tuple and data[0] == 'summary':
+                    summaries.append(data[1:])
+                elif data != 'FIN':
                     sys.stderr.write('Terminating simulation ("%s" received).\n' %
                             data)
                     sys.stderr.flush()
@@ -619,17 +771,26 @@ class LBSimulationController(object):
         timing_infos = []
         min_timings = []
         max_timings = []
+        reports = {}
+        need_summary = profile.summary_requested(self.config)
 
         if self.config.cluster_spec or self._is_pbs_cluster():
-            if self.config.mode == 'benchmark':
-                for ch, node_subdomains in zip(self._cluster_channels, self._node_subdomains):
-                    for sub in node_subdomains:
-                        ti, min_ti, max_ti = ch.receive()
-                        timing_infos.append(util.TimingInfo(*ti))
-                        min_timings.append(util.TimingInfo(*min_ti))
-                        max_timings.append(util.TimingInfo(*max_ti))
-
-            self._wait_for_masters()
+            # Every machine master only handles some of the subdomains, so
+            # reductions are merged here.
+            reduction_collector = None
+            reductions = self._lb_class(self.config).get_reductions()
+            if reductions and self.config.reductions_every > 0:
+                reduction_collector = diagnostics.ReductionCollector(
+                    reductions, len(subdomains), util.setup_logger(self.config),
+                    self.config.reductions_file)
+
+            summaries = []
+            self._wait_for_masters(summaries, reduction_collector)
+            for ti, min_ti, max_ti, report in summaries:
+                timing_infos.append(util.TimingInfo(*ti))
+                min_timings.append(util.TimingInfo(*min_ti))
+                max_timings.append(util.TimingInfo(*max_ti))
+                reports[timing_infos[-1].subdomain_id] = report
 
             for gw in self._cluster_gateways:
                 gw.exit()
@@ -638,18 +799,63 @@ class LBSimulationController(object):
                 for handler in self._pbs_handlers:
                     handler.terminate()
         else:
-            if self.config.mode == 'benchmark':
+            if need_summary:
                 # Collect timing information from all subdomains.
                 for i in range(len(subdomains)):
-                    ti, min_ti, max_ti = summary_receiver.recv_pyobj()
+                    ti, min_ti, max_ti, report = summary_receiver.recv_pyobj()
                     summary_receiver.send('ack')
                     timing_infos.append(ti)
                     min_timings.append(min_ti)
                     max_timings.append(max_ti)
+                    reports[ti.subdomain_id] = report
 
             if not self.config.debug_single_process:
                 self._simulation_process.join()
 
+        if self.config.trace_iters > 0:
+            merged = trace.merge(self.config.trace_file,
+                                 [s.id for s in subdomains])
+            if not self.config.quiet:
+                print 'Saved timeline trace for {0} subdomain(s) to {1}.'.format(
+                    len(merged), self.config.trace_file)
+
+        self._summary_reports = reports
+        timer_reports = dict((sid, r['timers']) for sid, r in
+                             reports.iteritems())
+        startup = dict((sid, r['startup']) for sid, r in reports.iteritems())
+        bandwidth = dict((sid, r['bandwidth']) for sid, r in
+                         reports.iteritems())
+        overlaps = dict((sid, r['overlap']) for sid, r in reports.iteritems())
+        if self.config.bandwidth_file:
+            roofline.save_bandwidth(self.config.bandwidth_file, bandwidth)
+        if need_summary and not self.config.quiet:
+            for line in profile.format_startup(self._startup.phases, startup):
+                print line
+            if startup:
+                # Runners on other hosts can have a different clock, so this
+                # is only approximate for clusters.
+                ready = max(p[-1]['start'] + p[-1]['time'] for p in
+                            startup.itervalues() if p)
+                print 'Time to first step: {0:.3f} s'.format(
+                    ready - self._startup.phases[0]['start'])
+
+        if self.config.profile_report:
+            profile.save_report(self.config.profile_report, timer_reports,
+                                {'startup': {
+                                    'controller': self._startup.phases,
+                                    'subdomains': dict(
+                                        (str(k), v) for k, v in
+                                        startup.iteritems())},
+                                 'bandwidth': dict(
+                                     (str(k), v) for k, v in
+                                     bandwidth.iteritems()),
+                                 'overlap': dict(
+                                     (str(k), v) for k, v in
+                                     overlaps.iteritems())})
+            if not self.config.quiet:
+                print 'Saved profiling report to {0}.'.format(
+                    self.config.profile_report)
+
         if self.config.mode == 'benchmark':
             mlups_total = 0.0
             mlups_comp = 0.0
@@ -657,7 +863,8 @@ class LBSimulationController(object):
             for ti in timing_infos:
                 subdomain = subdomains[ti.subdomain_id]
                 total = subdomain.num_nodes / ti.total * 1e-6
-                comp = subdomain.num_nodes / ti.comp * 1e-6
+                # No GPU time is measured with --host_overhead.
+                comp = subdomain.num_nodes / ti.comp * 1e-6 if ti.comp else 0.0
                 mlups_total += total
                 mlups_comp += comp
 
@@ -676,6 +883,22 @@ class LBSimulationController(object):
             if not self.config.quiet:
                 print ('Total MLUPS: eff:{0:.2f}  comp:{1:.2f}'.format(
                         mlups_total,  mlups_comp))
+                timers = profile.merge_reports(timer_reports)['timers']
+                print 'Timer percentiles (worst subdomain), ms:'
+                for name in sorted(timers):
+                    t = timers[name]
+                    print ('  {0:<18} p50:{1:8.3f}  p90:{2:8.3f}  p99:{3:8.3f}  '
+                           'max:{4:8.3f}'.format(name, t['p50'] * 1e3,
+                                                 t['p90'] * 1e3, t['p99'] * 1e3,
+                                                 t['max'] * 1e3))
+                if self.config.host_overhead:
+                    for line in profile.format_host_overhead(timer_reports):
+                        print line
+                else:
+                    for line in roofline.format_bandwidth(bandwidth):
+                        print line
+                    for line in overlap.format_overlap(overlaps):
+                        print line
             return timing_infos, min_timings, max_timings, subdomains
 
         return None, None
@@ -685,6 +908,55 @@ class LBSimulationController(object):
             pickle.dump(subdomains,
                     open(io.subdomains_filename(self.config.output), 'w'))
 
+    def _autotune(self):
+        """Benchmarks all candidate block sizes and memory alignments, and
+        saves the fastest combination for every subdomain in the tuning
+        database.
+
+        :rvalue: dict mapping database keys to the saved entries
+        """
+        quiet = self.config.quiet
+        self.config.quiet = True
+        self.config.mode = 'benchmark'
+        self.config.output = ''
+        self.config.max_iters = self.config.autotune_iters
+        # Skip the warm-up phase.
+        self.config.benchmark_sample_from = self.config.autotune_iters / 3
+        # Make sure the runners do not replace the candidate values with
+        # the ones already in the database.
+        self.config._explicit = self.config._explicit | set(
+            ['block_size', 'mem_alignment'])
+
+        results = []
+        for bs, align in autotune.candidates(self.config.autotune_block_sizes,
+                                             self.config.autotune_alignments):
+            self.config.block_size = bs
+            self.config.mem_alignment = align
+            self._startup = profile.StartupProfile()
+            timing_infos, _, _, subdomains = self._run_simulation()
+            mlups_total = 0.0
+            for ti in timing_infos:
+                mlups = subdomains[ti.subdomain_id].num_nodes / ti.total * 1e-6
+                mlups_total += mlups
+                results.append((
+                    self._summary_reports[ti.subdomain_id]['autotune_key'],
+                    bs, align, mlups))
+            if not quiet:
+                print ('Block size {0:>3}, memory alignment {1:>3}: '
+                       '{2:.2f} MLUPS'.format(bs, align, mlups_total))
+
+        entries = autotune.best_entries(results)
+        if self.config.autotune_db:
+            autotune.TuningDB(self.config.autotune_db).update(entries)
+        if not quiet:
+            for key, entry in sorted(entries.iteritems()):
+                print '{0}: block size {1}, memory alignment {2}'.format(
+                    key, entry['block_size'], entry['mem_alignment'])
+            if self.config.autotune_db:
+                print 'Saved tuned configuration to {0}.'.format(
+                    self.config.autotune_db)
+        return entries
+
     def run(self, ignore_cmdline=False):
         """Runs a simulation."""
 
@@ -695,28 +967,65 @@ class LBSimulationController(object):
         else:
             args = sys.argv[1:]
 
-        self.config = self._config_parser.parse(
-            args, internal_defaults={'quiet': True} if hasattr(
-                __builtin__, '__IPYTHON__') else None)
-        self._lb_class.modify_config(self.config)
-        self.geo = self._lb_geo(self.config)
-
+        self._startup = profile.StartupProfile()
+        phase = self._startup.phase
+        with phase('config'):
+            self.config = self._config_parser.parse(
+                args, internal_defaults={'quiet': True} if hasattr(
+                    __builtin__, '__IPYTHON__') else None)
+            self._lb_class.modify_config(self.config)
+            if self.config.host_overhead:
+                self.config.backends = 'dummy'
+                self.config.mode = 'benchmark'
+            self.geo = self._lb_geo(self.config)
+
+        if self.config.autotune:
+            return self._autotune()
+        return self._run_simulation()
+
+    def _run_simulation(self):
+        phase = self._startup.phase
         ctx = zmq.Context()
         summary_receiver = ctx.socket(zmq.REP)
         port = summary_receiver.bind_to_random_port('tcp://127.0.0.1')
         self.config._zmq_port = port
 
-        subdomains = self.geo.subdomains()
-        assert subdomains is not None, \
-                "Make sure the subdomain list is returned in geo_class.subdomains()"
-        assert len(subdomains) > 0, \
-                "Make sure at least one subdomain is returned in geo_class.subdomains()"
-
-        self._init_subdomain_envelope(self._lb_class, subdomains)
-
-        proc = LBGeometryProcessor(subdomains, self.dim, self.geo)
-        subdomains = proc.transform(self.config)
-        self.save_subdomain_config(subdomains)
-
-        self._start_simulation(subdomains)
-        return self._finish_simulation(subdomains, summary_receiver)
+        metrics_aggregator = None
+        self.config._metrics_addr = None
+        if self.config.metrics_every > 0:
+            metrics_aggregator = metrics.MetricsAggregator(
+                ctx, self.config.metrics_port, self.config.metrics_http_port)
+            if self.config.cluster_spec or self._is_pbs_cluster():
+                host = socket.getfqdn()
+            else:
+                host = '127.0.0.1'
+            self.config._metrics_addr = 'tcp://{0}:{1}'.format(
+                host, metrics_aggregator.collect_port)
+            metrics_aggregator.start()
+            if not self.config.quiet:
+                print 'Publishing live metrics on port {0}.'.format(
+                    metrics_aggregator.port)
+
+        with phase('subdomains'):
+            subdomains = self.geo.subdomains()
+            assert subdomains is not None, \
+                    "Make sure the subdomain list is returned in geo_class.subdomains()"
+            assert len(subdomains) > 0, \
+                    "Make sure at least one subdomain is returned in geo_class.subdomains()"
+
+            self._init_subdomain_envelope(self._lb_class, subdomains)
+
+        with phase('connections'):
+            proc = LBGeometryProcessor(subdomains, self.dim, self.geo)
+            subdomains = proc.transform(self.config)
+            self.save_subdomain_config(subdomains)
+
+        try:
+            # With --debug_single_process, this includes the whole
+            # simulation.
+            with phase('launch'):
+                self._start_simulation(subdomains)
+            return self._finish_simulation(subdomains, summary_receiver)
+        finally:
+            if metrics_aggregator is not None:
+                metrics_aggregator.stop()
@@ -0,0 +1,280 @@
+"""Integral diagnostics computed on the compute device.
+
+A simulation declares reductions by returning a list of Reduction objects
+from LBSim.get_reductions().  The reductions are evaluated on the device
+by every subdomain runner (without transferring the fields to the host),
+merged across subdomains by the machine master (or by the controller when
+the simulation runs on multiple machines) and logged.  Reductions are only
+evaluated if --reductions_every is set.
+
+Reductions are specified using C expressions in which macroscopic fields
+can be referenced by name.  Components of vector fields are referenced by
+the name of the field followed by x, y or z, e.g.::
+
+    Mean('kinetic_energy', '0.5f * (vx * vx + vy * vy + vz * vz)')
+    Max('max_rho', 'rho')
+
+By default, the expression is evaluated at all wet nodes of the simulation
+domain.  The set of nodes can be further restricted, and the nodes can be
+assigned weights, with a function of the global node coordinates.  This
+makes it possible to compute integrals over surfaces, e.g. the pressure
+force acting on an object::
+
+    Sum('fx', 'rho / 3.0f', weights=lambda hx, hy: normal_x(hx, hy))
+
+where normal_x returns the X component of the area-weighted outward normal
+of the object at fluid nodes adjacent to it, and 0 everywhere else.
+"""
+
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'LGPL3'
+
+import math
+import re
+
+import numpy as np
+
+_IDENTIFIER = re.compile(r'\b[A-Za-z_]\w*\b')
+
+
+def translate(expr, fields):
+    """Translates a reduction expression into the form used in the map
+    expression of a reduction kernel.
+
+    :param expr: C expression referencing fields by name
+    :param fields: iterable of names of all available fields
+    :rvalue: tuple of: C expression in which the i-th field is referenced as
+        x<i+1>[i] (x0 is reserved for node weights), list of names of
+        the referenced fields
+    """
+    used = []
+
+    def _replace(match):
+        name = match.group(0)
+        if name not in fields:
+            return name
+        if name not in used:
+            used.append(name)
+        return 'x{0}[i]'.format(used.index(name) + 1)
+
+    return _IDENTIFIER.sub(_replace, expr), used
+
+
+class Reduction(object):
+    """Base class for quantities computed by reducing an expression over
+    the nodes of the simulation domain."""
+
+    #: Reduction operator applied to values at different nodes, and its
+    #: neutral element.
+    reduce_expr = 'a+b'
+    neutral = '0'
+
+    def __init__(self, name, expr, weights=None):
+        """
+        :param name: name of the reduction, used in logs
+        :param expr: C expression to reduce, see the module docstring
+        :param weights: if not None, a function of global node coordinates
+            (hx, hy, [hz]) returning an array of node weights; only nodes with
+            non-zero weights are included in the reduction
+        """
+        self.name = name
+        self.expr = expr
+        self.weights = weights
+
+    def map_expr(self, expr):
+        """Returns the map expression for a reduction kernel.
+
+        :param expr: translated expression (see translate())
+        """
+        return 'x0[i] != 0 ? x0[i] * ({0}) : 0'.format(expr)
+
+    def merge(self, values):
+        """Combines partial results from multiple subdomains."""
+        return sum(values)
+
+    def finalize(self, value, norm):
+        """Returns the final value of the reduction.
+
+        :param value: merged value of the reduction
+        :param norm: sum of node weights over the whole domain
+        """
+        return value
+
+
+class Sum(Reduction):
+    """Weighted sum of an expression."""
+
+
+class Mean(Reduction):
+    """Weighted mean of an expression."""
+
+    def finalize(self, value, norm):
+        return value / norm if norm else float('nan')
+
+
+class Norm(Reduction):
+    """L-p norm of an expression."""
+
+    def __init__(self, name, expr, order=2, weights=None):
+        Reduction.__init__(self, name, expr, weights)
+        self.order = order
+
+    def map_expr(self, expr):
+        return Reduction.map_expr(self, 'pow(fabs({0}), {1})'.format(
+            expr, float(self.order)))
+
+    def finalize(self, value, norm):
+        return value ** (1.0 / self.order)
+
+
+class Max(Reduction):
+    """Maximum of an expression.  Node weights are only used to select
+    nodes."""
+    reduce_expr = 'fmax(a, b)'
+    neutral = '-INFINITY'
+
+    def map_expr(self, expr):
+        return 'x0[i] != 0 ? ({0}) : -INFINITY'.format(expr)
+
+    def merge(self, values):
+        return max(values)
+
+
+class Min(Reduction):
+    """Minimum of an expression.  Node weights are only used to select
+    nodes."""
+    reduce_expr = 'fmin(a, b)'
+    neutral = 'INFINITY'
+
+    def map_expr(self, expr):
+        return 'x0[i] != 0 ? ({0}) : INFINITY'.format(expr)
+
+    def merge(self, values):
+        return min(values)
+
+
+def kinetic_energy(dim):
+    """Returns a reduction computing the mean kinetic energy of the fluid
+    (cf. util.kinetic_energy)."""
+    return Mean('kinetic_energy', '0.5f * ({0})'.format(
+        ' + '.join('v{0} * v{0}'.format(c) for c in 'xyz'[:dim])))
+
+
+class ReductionCollector(object):
+    """Merges partial reduction results sent by subdomain runners."""
+
+    def __init__(self, reductions, num_subdomains, logger, fname=None):
+        """
+        :param reductions: list of Reduction objects
+        :param num_subdomains: number of subdomains from which partial results
+            are expected for every iteration
+        :param logger: logger object used to report results
+        :param fname: if not empty, name of a file to which results are
+            appended as tab-separated columns
+        """
+        self.reductions = reductions
+        self.num_subdomains = num_subdomains
+        self._logger = logger
+        self._fname = fname
+        # Maps iterations to lists of partial results.
+        self._pending = {}
+        self._header_written = False
+
+    def add(self, iteration, values):
+        """Records partial results from a single subdomain.
+
+        :param values: list of (value, norm) tuples, one for every reduction
+        :rvalue: list of final values if results from all subdomains are
+            available for the iteration, None otherwise
+        """
+        partial = self._pending.setdefault(iteration, [])
+        partial.append(values)
+        if len(partial) < self.num_subdomains:
+            return None
+
+        del self._pending[iteration]
+        ret = []
+        for i, r in enumerate(self.reductions):
+            value = r.merge([p[i][0] for p in partial])
+            norm = math.fsum(p[i][1] for p in partial)
+            ret.append(r.finalize(value, norm))
+        self._report(iteration, ret)
+        return ret
+
+    def _report(self, iteration, values):
+        self._logger.info('Iteration {0}: {1}'.format(iteration, ', '.join(
+            '{0}={1:.6e}'.format(r.name, v) for r, v in
+            zip(self.reductions, values))))
+
+        if not self._fname:
+            return
+        with open(self._fname, 'a') as f:
+            if not self._header_written:
+                f.write('# iteration\t{0}\n'.format(
+                    '\t'.join(r.name for r in self.reductions)))
+                self._header_written = True
+            f.write('{0}\t{1}\n'.format(iteration, '\t'.join(
+                repr(float(v)) for v in values)))
+
+
+class DeviceReductions(object):
+    """Evaluates reductions on the compute device for a single subdomain."""
+
+    def __init__(self, runner, reductions, fields):
+        """
+        :param runner: SubdomainRunner instance
+        :param reductions: list of Reduction objects
+        :param fields: list of (name, field) tuples with all fields available
+            for use in reductions
+        """
+        self._runner = runner
+        backend = runner.backend
+        spec = runner._spec
+
+        # Maps field names (and names of vector field components) to
+        # GPU buffers.
+        gpu_fields = {}
+        for name, field in fields:
+            if type(field) is list:
+                for suffix, component in zip('xyz', runner.gpu_field(field)):
+                    gpu_fields[name + suffix] = component
+            else:
+                gpu_fields[name] = runner.gpu_field(field)
+
+        wet = runner._subdomain.fluid_map()
+        self._kernels = []
+        self.norms = []
+        weight_bufs = {}
+        for r in reductions:
+            # Reductions are evaluated over the whole field arrays, including
+            # ghost nodes and padding, which are assigned 0 weight.
+            weights = np.zeros(runner._physical_size, dtype=runner.float)
+            if r.weights is None:
+                node_weights = wet
+            else:
+                node_weights = wet * r.weights(*runner._subdomain._get_mgrid())
+            weights[spec._nonghost_slice] = node_weights
+            self.norms.append(float(np.sum(node_weights, dtype=np.float64)))
+
+            key = id(r.weights)
+            if key not in weight_bufs:
+                weight_bufs[key] = backend.alloc_buf(like=weights,
+                                                     wrap_in_array=True)
+
+            expr, used = translate(r.expr, gpu_fields)
+            self._kernels.append(backend.get_reduction_kernel(
+                r.reduce_expr, r.map_expr(expr), r.neutral, weight_bufs[key],
+                *[gpu_fields[name] for name in used]))
+        self._timer = runner._profile.register_timer('reductions')
+
+    def evaluate(self):
+        """Returns a list of (value, norm) tuples with partial results of
+        all reductions for the subdomain."""
+        profile = self._runner._profile
+        profile.record_cpu_start(self._timer)
+        self._runner._calc_stream.synchronize()
+        ret = [(float(kernel()), norm) for kernel, norm in
+               zip(self._kernels, self.norms)]
+        profile.record_cpu_end(self._timer)
+        return ret
@@ -48,29 +48,60 @@ class GeoEncoder(object):
             return 0xfffffffe
 
     def detect_orientation(self, orientation):
-        # Limit dry and wet types to these that are actually used in the simulation.
-        uniq_types = set(np.unique(self._type_map.base))
-        dry_types = list(set(nt.get_dry_node_type_ids()) & uniq_types)
-        orient_types = list(set(nt.get_orientation_node_type_ids()) & uniq_types)
+        """Sets the orientation of nodes of types which require it.
+
+        The orientation is detected from a bitmask of fluid neighbors.  If
+        there is a fluid node along one of the primary directions, the
+        orientation is set to that direction.  Edge and corner nodes, which
+        only have fluid neighbors along diagonal directions, are left with an
+        undefined orientation (0), as the existing boundary conditions cannot
+        handle them correctly.  A warning is logged if any such nodes are
+        found.
+
+        :param orientation: numpy array with the same layout as the type map;
+            only nodes for which this array is 0 are processed
+        """
+        grid = self.subdomain.grid
+
+        # Limit orientation types to these that are actually used in the simulation.
+        orient_types = list(set(nt.get_orientation_node_type_ids()) &
+                            self.subdomain._seen_types)
+        if not orient_types:
+            return
 
         # Convert to a numpy array.
-        dry_types = self._type_map.dtype.type(dry_types)
         orient_types = self._type_map.dtype.type(orient_types)
-        orient_map = util.in_anyd_fast(self._type_map, orient_types)
-        l = len(list(self.subdomain.grid.basis[0])) - 1
-        for vec in self.subdomain.grid.basis:
-            # FIXME: we currently only process the primary directions
-            if vec.dot(vec) != 1:
+        primary = [(i, grid.vec_to_dir(list(vec))) for i, vec in
+                   enumerate(grid.basis) if vec.dot(vec) == 1]
+        unoriented = 0
+
+        # The type map is processed in slabs along the slowest-varying axis,
+        # with a 1-node halo so that all neighbors of the slab are available.
+        for slab in self.subdomain._slabs(self._type_map.shape[0]):
+            slab_orientation = orientation[slab]
+            undefined = (util.in_anyd_fast(self._type_map[slab], orient_types) &
+                         (slab_orientation == 0))
+            if not np.any(undefined):
                 continue
-            shifted_map = self._type_map
-            for j, shift in enumerate(vec):
-                if shift == 0:
-                    continue
-                shifted_map = np.roll(shifted_map, int(-shift), axis=l-j)
-
-            # Only set orientation where it's not already defined (=0).
-            idx = orient_map & (shifted_map == 0) & (orientation == 0)
-            orientation[idx] = self.subdomain.grid.vec_to_dir(list(vec))
+
+            fluid = (util.wrapped_slab(self._type_map, slab) == 0).astype(np.uint8)
+            fluid = util.periodic_halo(fluid, range(1, fluid.ndim))
+            bits = util.neighbor_bitmask(fluid, grid)[undefined]
+            del fluid
+            node_orientation = np.zeros(bits.shape, dtype=orientation.dtype)
+
+            for i, dir_ in primary:
+                sel = (node_orientation == 0) & ((bits & (1 << i)) != 0)
+                node_orientation[sel] = dir_
+
+            # Edge and corner nodes.
+            unoriented += np.sum((node_orientation == 0) & (bits != 0))
+            slab_orientation[undefined] = node_orientation
+
+        if unoriented:
+            self.subdomain.config.logger.warning(
+                '{0} edge/corner node(s) with only diagonal fluid neighbors '
+                'left without orientation.'.format(unoriented))
 
 class GeoEncoderConst(GeoEncoder):
     """Encodes node type and parameters into a single uint32.
@@ -4,13 +4,25 @@ __author__ = 'Michal Januszewski'
 __email__ = 'sailfish-cfd@googlegroups.com'
 __license__ = 'LGPL3'
 
+from collections import OrderedDict
+import cPickle as pickle
+import glob
+import itertools
+import json
 import math
 import numpy as np
 import operator
 import os
+import re
+import sys
+import threading
+import zlib
+import Queue
 import ctypes
 from ctypes import Structure, c_uint16, c_int32, c_uint8, c_bool
 
+from sailfish import codec
+
 class VisConfig(Structure):
     MAX_NAME_SIZE = 64
     _fields_ = [('iteration', c_int32), ('block', c_uint16), ('field', c_uint8),
@@ -23,6 +35,8 @@ class LBOutput(object):
         self._scalar_fields = {}
         self._vector_fields = {}
         self._fluid_map = None
+        self._location = None
+        self._selection = None
 
         # Additional scalar fields used for visualization.
         self._visualization_fields = {}
@@ -38,15 +52,53 @@ class LBOutput(object):
             else:
                 self._scalar_fields[name] = field
 
-    def mask_nonfluid_nodes(self):
+    def mask_nonfluid_nodes(self, scalar_fields=None, vector_fields=None):
+        """Sets all nonfluid nodes to NaN.
+
+        :param scalar_fields: dict of scalar fields to process; if None,
+            the registered fields are used
+        :param vector_fields: dict of vector fields to process; if None,
+            the registered fields are used
+        """
+        if scalar_fields is None:
+            scalar_fields = self._scalar_fields
+        if vector_fields is None:
+            vector_fields = self._vector_fields
+
         nonfluid = np.logical_not(self._fluid_map)
-        for f in self._scalar_fields.itervalues():
+        for f in scalar_fields.itervalues():
             f[nonfluid] = np.nan
-        for fv in self._vector_fields.itervalues():
+        for fv in vector_fields.itervalues():
             for f in fv:
                 f[nonfluid] = np.nan
 
     def save(self, i):
+        """Saves the registered fields for iteration i."""
+        pass
+
+    def write(self, i, scalar_fields, vector_fields):
+        """Writes fields to a file.
+
+        :param i: iteration number
+        :param scalar_fields: dict mapping names to scalar field arrays
+        :param vector_fields: dict mapping names to lists of component arrays
+        """
+        pass
+
+    def submit(self, func, *args, **kwargs):
+        """Runs a write operation.  Asynchronous outputs run it in the
+        background, while this implementation simply calls func."""
+        func(*args, **kwargs)
+
+    def flush(self):
+        """Waits for all pending write operations to complete."""
+        pass
+
+    def pending_writes(self):
+        """Returns the number of write operations waiting to be executed."""
+        return 0
+
+    def close(self):
         pass
 
     def dump_dists(self, dists, i):
@@ -62,6 +114,25 @@ class LBOutput(object):
         """
         self._fluid_map = fluid_map
 
+    def set_location(self, location):
+        """
+        :param location: location of the first non-ghost node of the
+            subdomain in the global coordinate system (x, y, [z])
+        """
+        self._location = location
+
+    def set_selection(self, region, stride):
+        """Marks the output as limited to a region of the domain sampled
+        with a stride (see --output_region and --output_stride).  The
+        location set with set_location() is then in the reduced output
+        lattice.
+
+        :param region: output region specification (see
+            parse_output_region())
+        :param stride: list of sampling strides in natural order
+        """
+        self._selection = (region, list(stride))
+
     def verify(self):
         fm = self._fluid_map
         return (all((np.all(np.isfinite(f[fm])) for f in
@@ -93,9 +164,27 @@ class VisualizationWrapper(LBOutput):
     def set_fluid_map(self, fluid_map):
         self._output.set_fluid_map(fluid_map)
 
+    def set_location(self, location):
+        self._output.set_location(location)
+
+    def set_selection(self, region, stride):
+        self._output.set_selection(region, stride)
+
     def verify(self):
         return self._output.verify()
 
+    def submit(self, func, *args, **kwargs):
+        self._output.submit(func, *args, **kwargs)
+
+    def flush(self):
+        self._output.flush()
+
+    def pending_writes(self):
+        return self._output.pending_writes()
+
+    def close(self):
+        self._output.close()
+
     def save(self, i):
         self._output.save(i)
 
@@ -169,7 +258,98 @@ def source_filename(filename, subdomain_id):
     return '{0}.{1}{2}'.format(base, subdomain_id, ext)
 
 def checkpoint_filename(base, digits, subdomain_id, it):
-    return ('{0}.{1:0' + str(digits) + 'd}.cpoint').format(base, it, subdomain_id)
+    return ('{0}.{1}.{2:0' + str(digits) + 'd}.cpoint').format(base,
+            subdomain_id, it)
+
+def parse_output_region(spec, dim):
+    """Parses an output region specification.
+
+    The specification has the form x0:x1,y0:y1[,z0:z1].  Any of the bounds
+    can be omitted, and a single number selects a plane (e.g. ':,:,10'
+    selects the z = 10 plane in 3D).
+
+    :param spec: region specification; an empty string selects the whole
+        domain
+    :param dim: dimensionality of the simulation
+    :rvalue: list of (start, stop) tuples in natural order (x, y, [z]);
+        missing bounds are represented as None
+    """
+    if not spec:
+        return [(None, None)] * dim
+
+    parts = spec.split(',')
+    if len(parts) != dim:
+        raise ValueError('Invalid output region: {0}'.format(spec))
+
+    ret = []
+    for part in parts:
+        start, sep, stop = part.partition(':')
+        start = int(start) if start.strip() else None
+        if sep:
+            stop = int(stop) if stop.strip() else None
+        elif start is None:
+            raise ValueError('Invalid output region: {0}'.format(spec))
+        else:
+            stop = start + 1
+        ret.append((start, stop))
+    return ret
+
+
+def parse_output_stride(stride, dim):
+    """Validates an output stride specification.
+
+    :param stride: list of sampling strides, either a single value used for
+        all axes, or one value per axis in natural order
+    :param dim: dimensionality of the simulation
+    :rvalue: list of dim sampling strides in natural order
+    """
+    if len(stride) == 1:
+        stride = list(stride) * dim
+    if len(stride) != dim:
+        raise ValueError('The output stride has to be specified for 1 or '
+                         '{0} axes.'.format(dim))
+    if any(x <= 0 for x in stride):
+        raise ValueError('Invalid output stride: {0}'.format(stride))
+    return list(stride)
+
+
+def output_selection(region, stride, location, size):
+    """Determines which nodes of a subdomain belong to an output region.
+
+    The output region is sampled every stride nodes, starting at the
+    beginning of the region.
+
+    :param region: list of (start, stop) tuples in natural order, see
+        parse_output_region()
+    :param stride: list of sampling strides in natural order
+    :param location: location of the subdomain (natural order)
+    :param size: size of the subdomain (natural order)
+    :rvalue: None if no nodes of the subdomain are selected, otherwise
+        a tuple of: list of slices selecting the nodes within the subdomain
+        (natural order, non-ghost nodes only), location of the first
+        selected node in the (reduced) output lattice
+    """
+    slices = []
+    out_location = []
+    for (start, stop), step, loc, n in zip(region, stride, location, size):
+        if start is None:
+            start = 0
+        if stop is None:
+            stop = loc + n
+        lo = max(start, loc)
+        hi = min(stop, loc + n)
+        # Index of the first sampled node >= lo.
+        k = (max(lo - start, 0) + step - 1) / step
+        first = start + k * step
+        if first >= hi:
+            return None
+        slices.append(slice(first - loc, hi - loc, step))
+        out_location.append(k)
+    return slices, out_location
+
+
+def chunked_dirname(base, digits, it):
+    return ('{0}.{1:0' + str(digits) + 'd}.chunks').format(base, it)
 
 class VTKOutput(LBOutput):
     """Saves simulation data in VTK files."""
@@ -181,13 +361,16 @@ class VTKOutput(LBOutput):
 
     def save(self, i):
         self.mask_nonfluid_nodes()
+        self.write(i, self._scalar_fields, self._vector_fields)
+
+    def write(self, i, scalar_fields, vector_fields):
         os.environ['ETS_TOOLKIT'] = 'null'
         from tvtk.api import tvtk
         idata = tvtk.ImageData(spacing=(1, 1, 1), origin=(0, 0, 0))
 
         first = True
         sample_field = None
-        for name, field in self._scalar_fields.iteritems():
+        for name, field in scalar_fields.iteritems():
             if first:
                 idata.point_data.scalars = field.flatten()
                 idata.point_data.scalars.name = name
@@ -200,7 +383,7 @@ class VTKOutput(LBOutput):
         idata.update()
         dim = len(sample_field.shape)
 
-        for name, field in self._vector_fields.iteritems():
+        for name, field in vector_fields.iteritems():
             if dim == 3:
                 tmp = idata.point_data.add_array(np.c_[field[0].flatten(),
                                                  field[1].flatten(), field[2].flatten()])
@@ -224,8 +407,16 @@ class VTKOutput(LBOutput):
         pass
 
 class NPYOutput(LBOutput):
-    """Saves simulation data as np arrays."""
+    """Saves simulation data as np arrays.
+
+    If the output is limited to a region of the domain (see
+    LBOutput.set_selection()), the location of the subdomain data in the
+    reduced output lattice (natural order), the output region specification
+    and the sampling strides are saved alongside the fields, under the keys
+    listed in SELECTION_KEYS.
+    """
     format_name = 'npy'
+    SELECTION_KEYS = ('output_location', 'output_region', 'output_stride')
 
     def __init__(self, config, subdomain_id):
         LBOutput.__init__(self, config, subdomain_id)
@@ -233,10 +424,18 @@ class NPYOutput(LBOutput):
 
     def save(self, i):
         self.mask_nonfluid_nodes()
+        self.write(i, self._scalar_fields, self._vector_fields)
+
+    def write(self, i, scalar_fields, vector_fields):
         fname = filename(self.basename, self.digits, self.subdomain_id, i, suffix='')
         data = {}
-        data.update(self._scalar_fields)
-        data.update(self._vector_fields)
+        data.update(scalar_fields)
+        data.update(vector_fields)
+        if self._selection is not None:
+            assert self._location is not None, 'Subdomain location not set.'
+            data['output_location'] = np.array(self._location)
+            data['output_region'] = np.array(self._selection[0])
+            data['output_stride'] = np.array(self._selection[1])
         np.savez(fname, **data)
 
     def dump_dists(self, dists, i):
@@ -247,6 +446,335 @@ class NPYOutput(LBOutput):
         fname = node_type_filename(self.basename, self.subdomain_id)
         np.save(fname, node_type_map)
 
+def _parse_field_map(items, conv=str):
+    """Parses a list of 'field=value' strings into a dict."""
+    ret = {}
+    for item in items or []:
+        name, sep, value = item.partition('=')
+        if not sep:
+            raise ValueError('Invalid field setting: {0}'.format(item))
+        ret[name] = conv(value)
+    return ret
+
+
+def chunk_ranges(location, shape, chunk_size):
+    """Splits a subdomain into chunks.
+
+    Chunk boundaries are placed at multiples of the chunk size in global
+    coordinates, so that chunks of neighboring subdomains are aligned.
+    All arguments use the numpy convention (slowest-varying axis first).
+
+    :param location: global location of the subdomain
+    :param shape: shape of the subdomain
+    :param chunk_size: chunk size along every axis; 0 means that the
+        subdomain is not split along that axis
+    :rvalue: list of lists of (start, stop) tuples in subdomain
+        coordinates, one for every chunk
+    """
+    axes = []
+    for a, n, c in zip(location, shape, chunk_size):
+        if c > 0:
+            edges = [a] + range(a - a % c + c, a + n, c) + [a + n]
+        else:
+            edges = [a, a + n]
+        axes.append([(lo - a, hi - a) for lo, hi in zip(edges[:-1], edges[1:])])
+    return [list(x) for x in itertools.product(*axes)]
+
+
+class ChunkedOutput(LBOutput):
+    """Saves simulation data as a single global dataset.
+
+    Every iteration is saved into a directory (see chunked_dirname()), in
+    which every subdomain writes its own files: one file per field, and
+    a JSON file describing the location and encoding of its data.  Every
+    subdomain is split into chunks of at most --output_chunk_size nodes
+    along every axis (see chunk_ranges()), which are encoded separately.
+    The data files are concatenations of the encoded chunks, and the JSON
+    file records the location of every chunk and, for every field, the
+    position of the chunk in the data file and its encoding.  All
+    subdomains can thus write their data in parallel without any
+    coordination, and any region of the global fields can be read chunk
+    by chunk (see ChunkedDataset), without merging per-subdomain files
+    first.
+
+    Nonfluid nodes are stored once per chunk as a bit mask, and only the
+    values at fluid nodes are stored for every field.  Field data is
+    compressed with a codec selected per field (see sailfish.codec), and
+    can optionally be quantized with a specified max absolute error.
+    """
+    format_name = 'chunked'
+
+    def __init__(self, config, subdomain_id):
+        LBOutput.__init__(self, config, subdomain_id)
+        self.digits = filename_iter_digits(config.max_iters)
+        self._default_codec = config.output_codec
+        self._field_codecs = _parse_field_map(config.output_field_codecs)
+        self._abs_error = _parse_field_map(config.output_abs_error, float)
+        self._chunk_size = list(config.output_chunk_size)
+
+        # Verify codec settings early.
+        codec.get_codec(self._default_codec)
+        for spec in self._field_codecs.itervalues():
+            codec.get_codec(spec)
+        if any(c < 0 for c in self._chunk_size):
+            raise ValueError('Invalid chunk size: {0}'.format(
+                self._chunk_size))
+
+    def save(self, i):
+        # Nonfluid nodes are not stored, so there is no need to mask them.
+        self.write(i, self._scalar_fields, self._vector_fields)
+
+    def _write_file(self, fname, func, *args):
+        # Files are written under a temporary name and renamed afterwards,
+        # so that readers never see partially written files.
+        tmp = '{0}.tmp'.format(fname)
+        func(tmp, *args)
+        os.rename(tmp, fname)
+
+    def _write_chunks(self, fname, chunks):
+        with open(fname, 'wb') as f:
+            for data in chunks:
+                f.write(data)
+
+    def _encode_field(self, name, components, fluid):
+        """Encodes a list of field components.
+
+        :rvalue: tuple of: encoded data, dict describing the encoding
+        """
+        values = np.array([c[fluid] for c in components])
+        spec = self._field_codecs.get(name, self._default_codec)
+        info = {'dtype': values.dtype.str, 'codec': spec}
+        abs_error = self._abs_error.get(name)
+
+        # Quantization is skipped if there are any invalid values, so that
+        # these are preserved in the output.
+        if abs_error is not None and np.all(np.isfinite(values)):
+            values = codec.quantize(values, abs_error)
+            info['abs_error'] = abs_error
+        info['stored_dtype'] = values.dtype.str
+        return codec.get_codec(spec).encode(values), info
+
+    def _chunk_shape(self, dim):
+        """Returns the chunk size in numpy order."""
+        if len(self._chunk_size) == 1:
+            return self._chunk_size * dim
+        if len(self._chunk_size) != dim:
+            raise ValueError('The chunk size has to be specified for 1 or '
+                             '{0} axes.'.format(dim))
+        return list(reversed(self._chunk_size))
+
+    def write(self, i, scalar_fields, vector_fields):
+        assert self._location is not None, 'Subdomain location not set.'
+
+        path = chunked_dirname(self.basename, self.digits, i)
+        try:
+            os.makedirs(path)
+        except OSError:
+            # The directory can be created concurrently by another subdomain.
+            if not os.path.isdir(path):
+                raise
+
+        shape = scalar_fields.values()[0].shape if scalar_fields else (
+            vector_fields.values()[0][0].shape)
+        if self._fluid_map is None:
+            fluid = np.ones(shape, dtype=np.bool)
+        else:
+            fluid = np.asarray(self._fluid_map, dtype=np.bool)
+
+        location = list(reversed(self._location))
+        fields = [(name, [f], 0) for name, f in scalar_fields.iteritems()]
+        fields.extend((name, f, len(f)) for name, f in vector_fields.iteritems())
+
+        chunks = []
+        masks = []
+        data = dict((name, []) for name, _, _ in fields)
+        offsets = dict((name, 0) for name, _, _ in fields + [('mask', [], 0)])
+
+        def _append(name, buf, out):
+            out.append(buf)
+            extent = [offsets[name], len(buf)]
+            offsets[name] += len(buf)
+            return extent
+
+        for ranges in chunk_ranges(location, shape, self._chunk_shape(len(shape))):
+            sl = [slice(a, b) for a, b in ranges]
+            chunk_fluid = fluid[sl]
+            chunk = {
+                'location': [a + l for (a, _), l in zip(ranges, location)],
+                'shape': [b - a for a, b in ranges],
+                'fluid_nodes': int(np.sum(chunk_fluid)),
+                'mask': _append('mask', zlib.compress(np.packbits(
+                    chunk_fluid.astype(np.uint8)).tostring()), masks),
+                'fields': {},
+            }
+            for name, components, num_components in fields:
+                buf, field_info = self._encode_field(
+                    name, [c[sl] for c in components], chunk_fluid)
+                field_info['components'] = num_components
+                field_info['extent'] = _append(name, buf, data[name])
+                chunk['fields'][name] = field_info
+            chunks.append(chunk)
+
+        sid = self.subdomain_id
+        self._write_file(os.path.join(path, 'mask.{0}'.format(sid)),
+                         self._write_chunks, masks)
+        for name, bufs in data.iteritems():
+            self._write_file(os.path.join(path, '{0}.{1}'.format(name, sid)),
+                             self._write_chunks, bufs)
+
+        def _save_info(fname, info):
+            with open(fname, 'w') as f:
+                json.dump(info, f)
+
+        # The subdomain description is written last, and is used by readers
+        # to detect complete data.
+        self._write_file(os.path.join(path, '{0}.json'.format(sid)),
+                         _save_info, {'location': location,
+                                      'shape': list(shape),
+                                      'chunks': chunks})
+
+
+class ChunkedDataset(object):
+    """Read access to a global dataset saved by ChunkedOutput.
+
+    Data is read and decoded one chunk at a time, so host memory usage
+    is proportional to the size of the requested region.  Chunks are
+    identified by (subdomain ID, chunk index) tuples.  All shapes and
+    locations use the numpy convention, i.e. the slowest-varying axis comes
+    first.  Vector fields have an additional leading axis for the
+    components.  Nonfluid nodes are set to NaN.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: directory with the dataset for a single iteration
+        """
+        self.path = path
+        self.chunks = {}
+        self.scalar_fields = set()
+        self.vector_fields = set()
+
+        for fname in os.listdir(path):
+            sid, ext = os.path.splitext(fname)
+            if ext != '.json' or not sid.isdigit():
+                continue
+            with open(os.path.join(path, fname), 'r') as f:
+                info = json.load(f)
+            for idx, chunk in enumerate(info['chunks']):
+                self.chunks[(int(sid), idx)] = chunk
+                for name, field_info in chunk['fields'].iteritems():
+                    if field_info['components']:
+                        self.vector_fields.add(name)
+                    else:
+                        self.scalar_fields.add(name)
+
+        if not self.chunks:
+            raise ValueError('No chunks found in {0}.'.format(path))
+
+        self.shape = tuple(max(c['location'][i] + c['shape'][i] for c in
+                               self.chunks.itervalues())
+                           for i in range(self.dim))
+
+    @property
+    def dim(self):
+        return len(self.chunks.itervalues().next()['shape'])
+
+    @property
+    def fields(self):
+        return sorted(self.scalar_fields | self.vector_fields)
+
+    def _read_file(self, name, chunk_id, extent):
+        offset, size = extent
+        with open(os.path.join(self.path, '{0}.{1}'.format(name, chunk_id[0])),
+                  'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def read_mask(self, chunk_id):
+        """Returns a boolean array selecting fluid nodes within a chunk."""
+        info = self.chunks[chunk_id]
+        shape = info['shape']
+        bits = np.unpackbits(np.frombuffer(zlib.decompress(
+            self._read_file('mask', chunk_id, info['mask'])), dtype=np.uint8))
+        return bits[:reduce(operator.mul, shape)].reshape(shape).astype(np.bool)
+
+    def read_chunk(self, name, chunk_id):
+        """Returns the data of a single chunk of a field.
+
+        :param name: field name
+        :param chunk_id: (subdomain ID, chunk index) tuple
+        """
+        info = self.chunks[chunk_id]
+        field_info = info['fields'][name]
+        components = max(field_info['components'], 1)
+
+        values = codec.get_codec(field_info['codec']).decode(
+            self._read_file(name, chunk_id, field_info['extent']),
+            field_info['stored_dtype'])
+        if 'abs_error' in field_info:
+            values = codec.dequantize(values, field_info['abs_error'],
+                                      field_info['dtype'])
+        values = values.reshape((components, info['fluid_nodes']))
+
+        fluid = self.read_mask(chunk_id)
+        out = np.empty([components] + info['shape'], dtype=field_info['dtype'])
+        out[:] = np.nan
+        for out_c, values_c in zip(out, values):
+            out_c[fluid] = values_c
+
+        if field_info['components']:
+            return out
+        return out[0]
+
+    def iter_chunks(self, name):
+        """Yields (location, data) pairs for all chunks of a field."""
+        for chunk_id, info in sorted(self.chunks.iteritems()):
+            yield info['location'], self.read_chunk(name, chunk_id)
+
+    def get_region(self, name, start=None, stop=None):
+        """Returns a box-shaped region of a field.
+
+        Only chunks overlapping the region are read.  Nodes not covered by
+        any chunk are set to NaN.
+
+        :param name: field name
+        :param start: location of the first node of the region (inclusive);
+            defaults to the origin of the domain
+        :param stop: location of the last node of the region (exclusive);
+            defaults to the end of the domain
+        """
+        if start is None:
+            start = [0] * self.dim
+        if stop is None:
+            stop = self.shape
+
+        sample = self.chunks.itervalues().next()['fields'][name]
+        prefix_shape = [sample['components']] if sample['components'] else []
+        out = np.empty(prefix_shape + [b - a for a, b in zip(start, stop)],
+                       dtype=sample['dtype'])
+        out[:] = np.nan
+
+        for chunk_id, info in sorted(self.chunks.iteritems()):
+            c0 = info['location']
+            c1 = [a + n for a, n in zip(c0, info['shape'])]
+            lo = [max(a, b) for a, b in zip(start, c0)]
+            hi = [min(a, b) for a, b in zip(stop, c1)]
+            if any(a >= b for a, b in zip(lo, hi)):
+                continue
+
+            data = self.read_chunk(name, chunk_id)
+            prefix = [slice(None)] * len(prefix_shape)
+            src = prefix + [slice(a - c, b - c) for a, b, c in zip(lo, hi, c0)]
+            dst = prefix + [slice(a - s, b - s) for a, b, s in zip(lo, hi, start)]
+            out[dst] = data[src]
+
+        return out
+
+    def get_field(self, name):
+        """Returns a field covering the whole domain."""
+        return self.get_region(name)
+
+
 class MatlabOutput(LBOutput):
     """Saves simulation data as Matlab .mat files."""
     format_name = 'mat'
@@ -257,11 +785,14 @@ class MatlabOutput(LBOutput):
 
     def save(self, i):
         self.mask_nonfluid_nodes()
+        self.write(i, self._scalar_fields, self._vector_fields)
+
+    def write(self, i, scalar_fields, vector_fields):
         import scipy.io
         fname = filename(self.basename, self.digits, self.subdomain_id, i, suffix='')
         data = {}
-        data.update(self._scalar_fields)
-        data.update(self._vector_fields)
+        data.update(scalar_fields)
+        data.update(vector_fields)
         scipy.io.savemat(fname, data)
 
     def dump_dists(self, dists, i):
@@ -270,7 +801,437 @@ class MatlabOutput(LBOutput):
         scipy.io.savemat(fname, dists)
 
 
-_OUTPUTS = [NPYOutput, VTKOutput, MatlabOutput]
+class AsyncWriter(object):
+    """Runs write operations in a background thread.
+
+    Operations are executed in the order in which they were submitted.  The
+    queue of pending operations is bounded, and submit() blocks when it is
+    full, so that a slow disk throttles the simulation instead of causing
+    unbounded memory growth.  An exception raised by a write operation is
+    reraised in the calling thread by the next call to submit() or flush().
+    """
+
+    def __init__(self, queue_size=2):
+        """
+        :param queue_size: max number of operations waiting to be executed
+        """
+        self._queue = Queue.Queue(queue_size)
+        self._thread = None
+        self._error = None
+
+    def __getstate__(self):
+        # The writer thread is started on first use, so that it is created
+        # in the process in which the writes take place.
+        assert self._thread is None
+        return {'queue_size': self._queue.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state['queue_size'])
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                func, args, kwargs = item
+                try:
+                    func(*args, **kwargs)
+                except Exception:
+                    # Only the first error is reported.
+                    if self._error is None:
+                        self._error = sys.exc_info()
+            finally:
+                self._queue.task_done()
+
+    def _check_error(self):
+        if self._error is not None:
+            exc_info = self._error
+            self._error = None
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def submit(self, func, *args, **kwargs):
+        self._check_error()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name='OutputWriter')
+            self._thread.daemon = True
+            self._thread.start()
+        self._queue.put((func, args, kwargs))
+
+    @property
+    def pending(self):
+        """Approximate number of operations waiting to be executed."""
+        return self._queue.qsize()
+
+    def flush(self):
+        """Waits for all pending operations to complete."""
+        if self._thread is not None:
+            self._queue.join()
+        self._check_error()
+
+    def close(self):
+        """Completes all pending operations and stops the writer thread."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._check_error()
+
+
+class AsyncOutput(LBOutput):
+    """Wraps an output object, moving file writes to a background thread.
+
+    On save(), the registered fields are copied into a snapshot buffer taken
+    from a fixed pool, and the simulation can continue as soon as the copy
+    is done.  The snapshot is then masked and written by the wrapped output
+    object in the writer thread, after which the buffer is returned to the
+    pool.  When all buffers are in use, save() blocks until one is released.
+
+    Other operations (e.g. checkpoints) can use the same pipeline via
+    submit().
+    """
+
+    def __init__(self, output, queue_size=2):
+        """
+        :param output: LBOutput instance used to write data to files
+        :param queue_size: max number of snapshots waiting to be written
+        """
+        self._scalar_fields = {}
+        self._vector_fields = {}
+        self._visualization_fields = {}
+        self._fluid_map = None
+        self._output = output
+        self._writer = AsyncWriter(queue_size)
+        # One buffer can be filled, one can be written, and queue_size
+        # buffers can wait in the queue.
+        self._pool_size = queue_size + 2
+        self._pool = None
+
+    @property
+    def basename(self):
+        return self._output.basename
+
+    @property
+    def subdomain_id(self):
+        return self._output.subdomain_id
+
+    def set_fluid_map(self, fluid_map):
+        LBOutput.set_fluid_map(self, fluid_map)
+        self._output.set_fluid_map(fluid_map)
+
+    def set_location(self, location):
+        LBOutput.set_location(self, location)
+        self._output.set_location(location)
+
+    def set_selection(self, region, stride):
+        LBOutput.set_selection(self, region, stride)
+        self._output.set_selection(region, stride)
+
+    def _init_pool(self):
+        self._pool = Queue.Queue()
+        for i in range(self._pool_size):
+            scalars = dict((name, np.empty_like(f)) for name, f in
+                           self._scalar_fields.iteritems())
+            vectors = dict((name, [np.empty_like(c) for c in f]) for name, f
+                           in self._vector_fields.iteritems())
+            self._pool.put((scalars, vectors))
+
+    def _write(self, i, snapshot):
+        scalars, vectors = snapshot
+        try:
+            if self._fluid_map is not None:
+                self.mask_nonfluid_nodes(scalars, vectors)
+            self._output.write(i, scalars, vectors)
+        finally:
+            self._pool.put(snapshot)
+
+    def save(self, i):
+        if self._pool is None:
+            self._init_pool()
+
+        snapshot = self._pool.get()
+        scalars, vectors = snapshot
+        for name, f in self._scalar_fields.iteritems():
+            scalars[name][:] = f
+        for name, f in self._vector_fields.iteritems():
+            for dst, src in zip(vectors[name], f):
+                dst[:] = src
+        self._writer.submit(self._write, i, snapshot)
+
+    def dump_dists(self, dists, i):
+        self._writer.submit(self._output.dump_dists, dists, i)
+
+    def dump_node_type(self, node_type):
+        self._output.dump_node_type(node_type)
+
+    def submit(self, func, *args, **kwargs):
+        self._writer.submit(func, *args, **kwargs)
+
+    def flush(self):
+        self._writer.flush()
+
+    def pending_writes(self):
+        return self._writer.pending
+
+    def close(self):
+        self._writer.close()
+        self._output.close()
+
+
+class GlobalArray(object):
+    """A lazily loaded global field for a single iteration.
+
+    Supports numpy-style indexing with integers, slices (including steps)
+    and Ellipsis.  Only the tiles (subdomains or, for chunked datasets,
+    chunks) overlapping the selected region are read.  Nodes not covered by any subdomain are NaN.
+    """
+
+    def __init__(self, series, name, it):
+        self._series = series
+        self.name = name
+        self.iteration = it
+        prefix_shape, self.dtype = series._field_info(name, it)
+        self.shape = tuple(prefix_shape) + series.shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __array__(self):
+        return self[...]
+
+    def _normalize_key(self, key):
+        if type(key) is not tuple:
+            key = (key,)
+        ellipsis = [i for i, k in enumerate(key) if k is Ellipsis]
+        if len(ellipsis) > 1:
+            raise IndexError('Only a single ellipsis is allowed.')
+        elif ellipsis:
+            i = ellipsis[0]
+            key = (key[:i] + (slice(None),) * (self.ndim - len(key) + 1) +
+                   key[i + 1:])
+        if len(key) > self.ndim:
+            raise IndexError('Too many indices.')
+        return key + (slice(None),) * (self.ndim - len(key))
+
+    def __getitem__(self, key):
+        key = self._normalize_key(key)
+        dim = self._series.dim
+        prefix_key = key[:-dim]
+
+        # Global indices of the selected nodes along every spatial axis.
+        indices = []
+        squeeze = []
+        for k, n in zip(key[-dim:], self._series.shape):
+            if isinstance(k, slice):
+                indices.append(np.arange(*k.indices(n)))
+                squeeze.append(slice(None))
+            else:
+                k = int(k)
+                if k < 0:
+                    k += n
+                if not 0 <= k < n:
+                    raise IndexError('Index out of range.')
+                indices.append(np.array([k]))
+                squeeze.append(0)
+
+        prefix_shape = np.empty(self.shape[:-dim], dtype=np.bool)[prefix_key].shape
+        out = np.empty(prefix_shape + tuple(len(idx) for idx in indices),
+                       dtype=self.dtype)
+        if out.dtype.kind in 'fc':
+            out[:] = np.nan
+        else:
+            out[:] = 0
+
+        for tile_id, c0, tile_shape in self._series.tiles(self.iteration):
+            c1 = [a + n for a, n in zip(c0, tile_shape)]
+            sel = [(idx >= a) & (idx < b) for idx, a, b in zip(indices, c0, c1)]
+            if not all(np.any(m) for m in sel):
+                continue
+
+            tile = self._series.get_tile(self.name, self.iteration, tile_id)
+            tile = tile[prefix_key]
+            src = np.ix_(*[idx[m] - a for idx, m, a in zip(indices, sel, c0)])
+            dst = np.ix_(*[np.flatnonzero(m) for m in sel])
+            out[(Ellipsis,) + dst] = tile[(Ellipsis,) + src]
+
+        return out[[Ellipsis] + squeeze]
+
+
+class OutputSeries(object):
+    """Read access to the output of a simulation as a series of global fields.
+
+    The simulation is identified by its output base name (--output).  The
+    layout of the subdomains is read from the .subdomains file, and all
+    fields are accessed as global arrays (see GlobalArray), without merging
+    the output of individual subdomains.  Both per-subdomain .npz files
+    (NPYOutput) and chunked datasets (ChunkedOutput) are supported.  Output
+    limited to a region of the domain (--output_region, --output_stride) is
+    only supported for chunked datasets, for which the global fields cover
+    the reduced output lattice.
+
+    Recently used tiles are cached in memory.
+    """
+
+    def __init__(self, base, digits=None, cache_size=32):
+        """
+        :param base: output base name of the simulation
+        :param digits: number of digits used for the iteration number in
+            file names; autodetected if None
+        :param cache_size: max number of tiles to keep in memory
+        """
+        self.base = base
+        with open(subdomains_filename(base), 'rb') as f:
+            self.subdomains = pickle.load(f)
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._datasets = {}
+
+        spec = self.subdomains[0]
+        self.dim = spec.dim
+        self.shape = tuple(reversed([max(s.end_location[i] for s in
+                                         self.subdomains)
+                                     for i in range(self.dim)]))
+
+        self.chunked = False
+        # Subdomains without any nodes in the output region do not save
+        # any files.
+        # Only files named as in filename() are matched.  In particular,
+        # checkpoint files (<base>.<id>.<it>.cpoint.npz) are skipped.
+        its = []
+        for s in self.subdomains:
+            its = self._find_iterations(
+                glob.glob('{0}.{1}.*.npz'.format(base, s.id)),
+                r'{0}\.{1}\.(\d+)\.npz$'.format(re.escape(base), s.id),
+                digits)
+            if its:
+                spec = s
+                break
+        if not its:
+            self.chunked = True
+            its = self._find_iterations(
+                glob.glob('{0}.*.chunks'.format(base)),
+                r'{0}\.(\d+)\.chunks$'.format(re.escape(base)), digits)
+
+        self.iterations = sorted(set(int(it) for it in its))
+        if its:
+            self.digits = len(its[0])
+
+        if not self.iterations:
+            raise ValueError('No output files found for {0}.'.format(base))
+
+        if self.chunked:
+            # Chunk locations are in the output lattice, which is smaller
+            # than the simulation domain if the output was limited with
+            # --output_region or --output_stride.
+            tiles = self.tiles(self.iterations[0])
+            self.shape = tuple(max(c0[i] + n[i] for _, c0, n in tiles)
+                               for i in range(self.dim))
+        else:
+            data = np.load(filename(base, self.digits, spec.id,
+                                    self.iterations[0]))
+            try:
+                if NPYOutput.SELECTION_KEYS[0] in data.files:
+                    raise ValueError('Output files for {0} are limited to '
+                                     'a region of the domain, which is not '
+                                     'supported for the npy format.  Use '
+                                     'utils/merge_subdomains.py or the '
+                                     'chunked format.'.format(base))
+            finally:
+                data.close()
+
+    def _dataset(self, it):
+        if it not in self._datasets:
+            self._datasets[it] = ChunkedDataset(chunked_dirname(
+                self.base, self.digits, it))
+        return self._datasets[it]
+
+    def _field_info(self, name, it):
+        """Returns a tuple of: shape of the non-spatial axes, dtype."""
+        if self.chunked:
+            chunks = self._dataset(it).chunks
+            info = chunks[min(chunks)]['fields'][name]
+            return ([info['components']] if info['components'] else [],
+                    np.dtype(info['dtype']))
+        tile = self.get_tile(name, it, self.subdomains[0].id)
+        return list(tile.shape[:-self.dim]), tile.dtype
+
+    @property
+    def fields(self):
+        it = self.iterations[0]
+        if self.chunked:
+            return self._dataset(it).fields
+        data = np.load(filename(self.base, self.digits, self.subdomains[0].id,
+                                it))
+        try:
+            return sorted(data.files)
+        finally:
+            data.close()
+
+    @staticmethod
+    def _find_iterations(files, pattern, digits):
+        """Returns the iteration numbers (as strings) from the names of the
+        files matching pattern."""
+        ret = []
+        for fname in files:
+            m = re.match(pattern, fname)
+            if m is None:
+                continue
+            it = m.group(1)
+            if digits is not None and len(it) != digits:
+                continue
+            ret.append(it)
+        return ret
+
+    def tiles(self, it):
+        """Returns a list of (tile ID, location, shape) tuples describing the
+        tiles in which the data for iteration it is stored.  Tiles are chunks
+        for chunked datasets, and subdomains otherwise.  Locations and shapes
+        use the numpy convention."""
+        if self.chunked:
+            return [(chunk_id, c['location'], c['shape']) for chunk_id, c in
+                    sorted(self._dataset(it).chunks.iteritems())]
+        return [(s.id, list(reversed(s.location)), list(reversed(s.size)))
+                for s in self.subdomains]
+
+    def get_tile(self, name, it, tile_id):
+        """Returns the data of a field for a single tile (see tiles())."""
+        key = (name, it, tile_id)
+        if key in self._cache:
+            tile = self._cache.pop(key)
+        elif self.chunked:
+            tile = self._dataset(it).read_chunk(name, tile_id)
+        else:
+            data = np.load(filename(self.base, self.digits, tile_id, it))
+            try:
+                tile = data[name]
+            finally:
+                data.close()
+
+        self._cache[key] = tile
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return tile
+
+    def field(self, name, it):
+        """Returns a GlobalArray for a field at iteration it."""
+        return GlobalArray(self, name, it)
+
+    def iter_field(self, name, key=Ellipsis, iterations=None):
+        """Yields (iteration, data) pairs for a region of a field.
+
+        :param name: field name
+        :param key: index expression selecting the region (see GlobalArray)
+        :param iterations: iterable of iterations to process; all available
+            iterations are processed if None
+        """
+        if iterations is None:
+            iterations = self.iterations
+        for it in iterations:
+            yield it, self.field(name, it)[key]
+
+_OUTPUTS = [NPYOutput, VTKOutput, MatlabOutput, ChunkedOutput]
 
 format_name_to_cls = {}
 for output_class in _OUTPUTS:
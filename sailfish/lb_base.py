@@ -176,6 +176,21 @@ class LBSim(object):
         return ((self.iteration % self.config.checkpoint_every) == 0 and
             self.iteration >= self.config.checkpoint_from)
 
+    def need_reductions(self):
+        """Returns True when the reductions declared in get_reductions() are
+        to be evaluated after the current iteration.
+
+        Called from SubdomainRunner.main().
+        """
+        every = self.config.reductions_every
+        return every > 0 and ((self.iteration + 1) % every) == 0
+
+    def get_reductions(self):
+        """Returns a list of sailfish.diagnostics.Reduction objects describing
+        integral quantities to be evaluated on the compute device and logged
+        (see --reductions_every)."""
+        return []
+
     def after_step(self, runner):
         """Called from the main loop after the completion of every step."""
         pass
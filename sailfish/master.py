@@ -19,8 +19,9 @@ from multiprocessing import Process, Array, Event, Value
 
 import zmq
 
-from sailfish import subdomain_runner, util, io
+from sailfish import autotune, diagnostics, subdomain_runner, util, io
 from sailfish.connector import ZMQSubdomainConnector, ZMQRemoteSubdomainConnector, CompressedZMQRemoteSubdomainConnector
+from sailfish.connector import InMemorySubdomainConnector
 
 def _start_subdomain_runner(subdomain, config, sim, num_subdomains,
         backend_class, gpu_id, output,
@@ -40,6 +41,15 @@ def _start_subdomain_runner(subdomain, config, sim, num_subdomains,
     # master), so that the backend object is created within the
     # context of the new process.
     backend = backend_class(config, gpu_id)
+    # Has to happen before the runner is created, as the block size and
+    # memory alignment are used by the code generator.
+    tuned = autotune.apply_tuned(
+        config, autotune.make_key(config, subdomain, sim, backend))
+    if tuned is not None:
+        config.logger.info('Using tuned block size {0} and memory alignment '
+                           '{1} ({2:.2f} MLUPS).'.format(
+                               tuned['block_size'], tuned['mem_alignment'],
+                               tuned['mlups']))
 
     if not timing_info_to_master:
         # If there is no controller channel, all processes are running on a
@@ -86,6 +96,8 @@ class LBMachineMaster(object):
         self._vis_quit_event = None
         self._quit_event = Event()
         self._channel = channel
+        self._reduction_collector = None
+        self._metrics_sock = None
 
         atexit.register(lambda event: event.set(), event=self._quit_event)
 
@@ -151,11 +163,24 @@ class LBMachineMaster(object):
                         "-element buffer (face {4}).".format(
                             subdomain.id, nbid, size1, size2, face_str))
 
-                if nbid in local_subdomain_ids:
-                    c1, c2 = ZMQSubdomainConnector.make_ipc_pair(ctype, (size1, size2),
-                                                             (subdomain.id, nbid))
+                if (nbid in local_subdomain_ids and
+                        self.config.local_connector == 'tcp'):
+                    # Connect local subdomains through the loopback interface.
+                    c1 = self._make_remote_connector('tcp://127.0.0.1',
+                                                     subdomain.id > nbid)
+                    c2 = self._make_remote_connector('tcp://127.0.0.1',
+                                                     nbid > subdomain.id)
+                    subdomain.add_connector(nbid, c1)
+                    local_subdomain_map[nbid].add_connector(subdomain.id, c2)
+                elif nbid in local_subdomain_ids:
+                    if self.config.host_overhead:
+                        c1, c2 = InMemorySubdomainConnector.make_pair(ctype,
+                                (size1, size2), (subdomain.id, nbid))
+                    else:
+                        c1, c2 = ZMQSubdomainConnector.make_ipc_pair(ctype, (size1, size2),
+                                                                 (subdomain.id, nbid))
+                        ipc_files.append(c1.ipc_file)
                     subdomain.add_connector(nbid, c1)
-                    ipc_files.append(c1.ipc_file)
                     local_subdomain_map[nbid].add_connector(subdomain.id, c2)
                 else:
                     receiver = subdomain.id > nbid
@@ -163,21 +188,30 @@ class LBMachineMaster(object):
                         addr = "tcp://{0}".format(self._subdomain_addr_map[nbid])
                     else:
                         addr = "tcp://{0}".format(self._iface)
-                    if self.config.compress_intersubdomain_data:
-                        c1 = CompressedZMQRemoteSubdomainConnector(addr,
-                                receiver=subdomain.id > nbid)
-                    else:
-                        c1 = ZMQRemoteSubdomainConnector(addr, receiver=subdomain.id > nbid)
+                    c1 = self._make_remote_connector(addr, receiver)
                     subdomain.add_connector(nbid, c1)
 
         return ipc_files
 
+    def _make_remote_connector(self, addr, receiver):
+        if self.config.compress_intersubdomain_data:
+            return CompressedZMQRemoteSubdomainConnector(addr,
+                    receiver=receiver)
+        else:
+            return ZMQRemoteSubdomainConnector(addr, receiver=receiver)
+
     def _init_visualization_and_io(self, sim):
         if self.config.output:
             output_cls = io.format_name_to_cls[self.config.output_format]
         else:
             output_cls = io.LBOutput
 
+        if self.config.output_queue_size > 0:
+            base_cls = output_cls
+            queue_size = self.config.output_queue_size
+            output_cls = lambda config, subdomain_id: io.AsyncOutput(
+                    base_cls(config, subdomain_id), queue_size)
+
         if self.config.mode != 'visualization':
             return lambda subdomain: output_cls(self.config, subdomain.id)
 
@@ -272,20 +306,34 @@ class LBMachineMaster(object):
         if self._channel is not None:
             self._channel.send(ports)
             ports = self._channel.receive()
-        else:
-            # If there is no channel, we're the single master running in this
-            # simulation and no port information should be necessary.
-            assert not ports
+        # If there is no channel, we're the single master running in this
+        # simulation and port information is only used for loopback
+        # connections between local subdomains (--local_connector=tcp).
 
         for socket in sockets:
             socket.send_pyobj(ports)
 
-        if self._channel is not None and self.config.mode == 'benchmark':
-            for socket in sockets:
-                ti, min_ti, max_ti = socket.recv_pyobj()
-                self._channel.send((tuple(ti), tuple(min_ti), tuple(max_ti)))
-                socket.send('ack')
-
+        # With a controller channel, other machines handle some of the
+        # subdomains, and partial results are merged by the controller.
+        reductions = self.sim.get_reductions()
+        if (reductions and self.config.reductions_every > 0 and
+                self._channel is None):
+            self._reduction_collector = diagnostics.ReductionCollector(
+                reductions, len(self.subdomains), self.config.logger,
+                self.config.reductions_file)
+
+        # Live metrics are forwarded to the controller.
+        if self.config.metrics_every > 0 and self.config._metrics_addr:
+            self._metrics_sock = ctx.socket(zmq.PUB)
+            self._metrics_sock.connect(self.config._metrics_addr)
+
+        # All messages from the runners (summaries, partial reduction
+        # results, metrics) are handled in a single loop, so that a runner
+        # is never blocked on a full socket while the master is waiting for
+        # a message from a different runner.
+        poller = zmq.Poller()
+        for socket in sockets:
+            poller.register(socket, zmq.POLLIN)
 
         # Wait for all subdomain runners to finish.
         done_runners = set()
@@ -294,7 +342,8 @@ class LBMachineMaster(object):
                 if runner not in done_runners and not runner.is_alive():
                     done_runners.add(runner)
 
-            self._quit_event.wait(1)
+            for socket, _ in poller.poll(1000):
+                self._handle_runner_msg(socket, socket.recv_pyobj())
             if self._quit_event.is_set():
                 self.config.logger.info('Received termination request.')
                 time.sleep(0.5)
@@ -303,9 +352,40 @@ class LBMachineMaster(object):
                         runner.terminate()
                 break
 
+        # Process any results sent just before the runners terminated.
+        for socket, _ in poller.poll(0):
+            self._handle_runner_msg(socket, socket.recv_pyobj())
+
+        if self._metrics_sock is not None:
+            self._metrics_sock.close(linger=1000)
+
         for ipcfile in ipc_files:
             os.unlink(ipcfile)
 
+    def _handle_runner_msg(self, socket, msg):
+        """Processes a message sent by a subdomain runner: partial reduction
+        results, a metrics snapshot or the final timing summary.
+
+        :param socket: socket on which the message was received
+        """
+        if msg[0] == 'reductions':
+            _, iteration, values = msg
+            if self._reduction_collector is not None:
+                self._reduction_collector.add(iteration, values)
+            else:
+                self._channel.send(('reductions', iteration,
+                                    [(float(v), float(n)) for v, n in values]))
+        elif msg[0] == 'metrics':
+            if self._metrics_sock is not None:
+                self._metrics_sock.send_json(msg[1])
+        else:
+            # Summaries are only sent to the master if there is a controller
+            # channel.
+            ti, min_ti, max_ti, report = msg
+            self._channel.send(('summary', tuple(ti), tuple(min_ti),
+                                tuple(max_ti), report))
+            socket.send('ack')
+
     def run(self):
         self.config.logger.info('Machine master starting with PID {0}'.format(os.getpid()))
         self.config.logger.info('Handling subdomains: {0}'.format([b.id for b in
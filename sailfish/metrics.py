@@ -0,0 +1,199 @@
+"""Live metrics published by running simulations.
+
+When enabled (--metrics_every), every subdomain runner periodically sends a
+snapshot of its performance metrics to its machine master, which forwards
+it to the controller.  The controller publishes all snapshots on a zmq PUB
+socket (--metrics_port) as JSON objects, and can optionally serve the latest
+snapshot for every subdomain in the Prometheus text format over HTTP
+(--metrics_http_port).
+
+Use utils/monitor.py to display the metrics of a running simulation.
+"""
+
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'LGPL3'
+
+import BaseHTTPServer
+import socket
+import threading
+import time
+
+import numpy as np
+import zmq
+
+from sailfish.profile import TimeProfile
+
+#: (name, description) of the numeric metrics in a snapshot.
+GAUGES = [
+    ('iteration', 'Current iteration.'),
+    ('mlups', 'Millions of lattice node updates per second since the '
+     'previous snapshot.'),
+    ('step_p50', 'Median step time since the previous snapshot, in seconds.'),
+    ('step_p90', '90th percentile of the step time, in seconds.'),
+    ('step_p99', '99th percentile of the step time, in seconds.'),
+    ('net_wait', 'Mean time per step spent waiting for data from remote '
+     'subdomains, in seconds.'),
+    ('output_queue', 'Number of output operations waiting to be written.'),
+    ('device_memory', 'Device memory allocated by the subdomain, in bytes.'),
+]
+
+
+class RunnerMetrics(object):
+    """Collects metrics for a single subdomain runner."""
+
+    def __init__(self, runner, every):
+        """
+        :param runner: SubdomainRunner instance
+        :param every: interval between snapshots, in iterations
+        """
+        self._runner = runner
+        self._every = every
+        self._host = socket.gethostname()
+        self._steps = []
+        self._net_wait = 0.0
+        self._last_iteration = runner._sim.iteration
+        self._last_time = time.time()
+        runner._profile.add_listener(self._on_timer)
+
+    def _on_timer(self, event, duration):
+        if event == TimeProfile.STEP:
+            self._steps.append(duration)
+        elif event == TimeProfile.NET_RECV:
+            self._net_wait += duration
+
+    def need_snapshot(self, iteration):
+        return iteration % self._every == 0
+
+    def snapshot(self):
+        """Returns a dict with the metrics accumulated since the previous
+        snapshot, and resets them."""
+        runner = self._runner
+        now = time.time()
+        iteration = runner._sim.iteration
+        steps = np.array(self._steps)
+        elapsed = now - self._last_time
+
+        ret = {
+            'subdomain_id': runner._spec.id,
+            'host': self._host,
+            'time': now,
+            'iteration': iteration,
+            'mlups': (runner._spec.num_nodes *
+                      (iteration - self._last_iteration) / elapsed * 1e-6
+                      if elapsed > 0 else 0.0),
+            'net_wait': self._net_wait / len(steps) if len(steps) else 0.0,
+            'output_queue': runner._output.pending_writes(),
+            'device_memory': runner.backend.allocated_memory,
+        }
+        for p in (50, 90, 99):
+            ret['step_p{0}'.format(p)] = (float(np.percentile(steps, p)) if
+                                          len(steps) else 0.0)
+
+        self._steps = []
+        self._net_wait = 0.0
+        self._last_iteration = iteration
+        self._last_time = now
+        return ret
+
+
+def prometheus_text(snapshots):
+    """Formats snapshots in the Prometheus text exposition format.
+
+    :param snapshots: iterable of snapshot dicts (see RunnerMetrics.snapshot())
+    :rvalue: string
+    """
+    snapshots = sorted(snapshots, key=lambda s: s['subdomain_id'])
+    lines = []
+    for name, description in GAUGES:
+        metric = 'sailfish_' + name
+        lines.append('# HELP {0} {1}'.format(metric, description))
+        lines.append('# TYPE {0} gauge'.format(metric))
+        for s in snapshots:
+            lines.append('{0}{{subdomain="{1}",host="{2}"}} {3!r}'.format(
+                metric, s['subdomain_id'], s['host'], float(s[name])))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsAggregator(object):
+    """Receives snapshots from machine masters, republishes them and keeps
+    the most recent snapshot for every subdomain.  Runs in a background
+    thread in the controller."""
+
+    def __init__(self, ctx, port=0, http_port=0):
+        """
+        :param ctx: zmq Context
+        :param port: TCP port on which snapshots are published; if 0,
+            a random port is used
+        :param http_port: if not 0, TCP port on which the Prometheus text
+            endpoint is served
+        """
+        self._sub = ctx.socket(zmq.SUB)
+        self._sub.setsockopt(zmq.SUBSCRIBE, '')
+        #: Port to which the machine masters connect.
+        self.collect_port = self._sub.bind_to_random_port('tcp://*')
+        self._pub = ctx.socket(zmq.PUB)
+        if port:
+            self._pub.bind('tcp://*:{0}'.format(port))
+            self.port = port
+        else:
+            self.port = self._pub.bind_to_random_port('tcp://*')
+
+        self._lock = threading.Lock()
+        self._latest = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='MetricsAggregator')
+        self._thread.daemon = True
+
+        self._http = None
+        if http_port:
+            aggregator = self
+
+            class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = prometheus_text(aggregator.latest())
+                    self.send_response(200)
+                    self.send_header('Content-Type',
+                                     'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self._http = BaseHTTPServer.HTTPServer(('', http_port), Handler)
+            self._http_thread = threading.Thread(
+                target=self._http.serve_forever, name='MetricsHTTP')
+            self._http_thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        if self._http is not None:
+            self._http_thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        if self._http is not None:
+            self._http.shutdown()
+            self._http.server_close()
+        self._sub.close()
+        self._pub.close()
+
+    def latest(self):
+        """Returns a list of the most recent snapshots for all subdomains."""
+        with self._lock:
+            return self._latest.values()
+
+    def _run(self):
+        poller = zmq.Poller()
+        poller.register(self._sub, zmq.POLLIN)
+        while not self._stop.is_set():
+            if not poller.poll(200):
+                continue
+            snapshot = self._sub.recv_json()
+            with self._lock:
+                self._latest[snapshot['subdomain_id']] = snapshot
+            self._pub.send_json(snapshot)
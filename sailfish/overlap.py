@@ -0,0 +1,191 @@
+"""Overlap of communication and computation.
+
+With the bulk/boundary split, the boundary kernel is run first, so that
+the data for the neighboring subdomains can be sent and received while the
+bulk kernel is running.  OverlapAnalyzer records, for every step, the
+intervals in which the bulk kernels were running and in which data was
+being sent or received, and computes how much of the communication was
+hidden behind the bulk computation, how much of it was exposed, and which
+neighbor was most often the last one to deliver its data (and is thus on
+the critical path).
+
+GPU event times are converted to host times using a reference event recorded
+at the beginning of every step.  This assumes that the device is idle at
+that point, which is the case as the main loop waits for the completion of
+the previous step.
+"""
+
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'LGPL3'
+
+# Minimum fraction of the step time that the split has to hide for it to be
+# considered worth the cost of the additional kernel launch and the lower
+# efficiency of the boundary kernel.
+MIN_GAIN = 0.02
+
+
+def _union(intervals):
+    """Returns a list of disjoint intervals covering the same time as
+    the input list of (start, end) tuples."""
+    ret = []
+    for start, end in sorted(intervals):
+        if ret and start <= ret[-1][1]:
+            ret[-1] = (ret[-1][0], max(ret[-1][1], end))
+        else:
+            ret.append((start, end))
+    return ret
+
+
+def _length(intervals):
+    return sum(end - start for start, end in intervals)
+
+
+def _intersection(a, b):
+    """Returns the total length of the intersection of two lists of
+    disjoint intervals."""
+    return sum(max(0.0, min(e1, e2) - max(s1, s2)) for s1, e1 in a
+               for s2, e2 in b)
+
+
+class OverlapAnalyzer(object):
+    """Accumulates communication/computation overlap statistics of a single
+    subdomain."""
+
+    def __init__(self):
+        self.steps = 0
+        self.comm = 0.0
+        self.bulk = 0.0
+        self.overlap = 0.0
+        # Peer ID -> total time spent waiting for data from that peer.
+        self.peer_wait = {}
+        # Peer ID -> number of steps in which it was the slowest peer.
+        self.critical = {}
+        self._comm = []
+        self._waits = {}
+
+    def add_comm(self, start, end):
+        """Records an interval in which data was being sent or received."""
+        self._comm.append((start, end))
+
+    def add_wait(self, peer, duration):
+        """Records time spent waiting for data from a neighboring subdomain."""
+        self._waits[peer] = self._waits.get(peer, 0.0) + duration
+
+    def end_step(self, bulk):
+        """Completes statistics for a single step.
+
+        :param bulk: list of (start, end) intervals in which the bulk
+            kernels were running
+        """
+        comm = _union(self._comm)
+        bulk = _union(bulk)
+        self.steps += 1
+        self.comm += _length(comm)
+        self.bulk += _length(bulk)
+        self.overlap += _intersection(comm, bulk)
+
+        if self._waits:
+            peer = max(self._waits, key=self._waits.get)
+            self.critical[peer] = self.critical.get(peer, 0) + 1
+            for p, wait in self._waits.iteritems():
+                self.peer_wait[p] = self.peer_wait.get(p, 0.0) + wait
+
+        self._comm = []
+        self._waits = {}
+
+    def report(self, step, compute, split, bulk_fraction):
+        """Returns a dict summarizing the overlap.  All times are averages
+        per step, in seconds.
+
+        :param step: average duration of a step
+        :param compute: average duration of the compute kernels
+        :param split: True if the bulk/boundary split is used
+        :param bulk_fraction: fraction of the nodes that are (or would be,
+            if the split was used) handled by the bulk kernel
+        """
+        n = float(max(self.steps, 1))
+        comm = self.comm / n
+        overlap = self.overlap / n
+        ret = {'steps': self.steps, 'split': split, 'step': step,
+               'compute': compute, 'bulk_fraction': bulk_fraction,
+               'comm': comm, 'bulk': self.bulk / n, 'overlap': overlap,
+               'exposed': comm - overlap,
+               'overlap_fraction': overlap / comm if comm > 0 else 0.0,
+               'peer_wait': dict((p, w / n) for p, w in
+                                 self.peer_wait.iteritems()),
+               'critical_peer': None, 'critical_share': 0.0}
+        if self.critical:
+            peer = max(self.critical, key=self.critical.get)
+            ret['critical_peer'] = peer
+            ret['critical_share'] = self.critical[peer] / n
+        return ret
+
+
+def recommend(report):
+    """Returns a recommendation on whether the bulk/boundary split is worth
+    using for the subdomain described by report (see
+    OverlapAnalyzer.report())."""
+    step = report['step']
+    if not report['steps'] or report['comm'] <= 0.0 or step <= 0.0:
+        return 'No communication; the bulk/boundary split is not needed.'
+
+    if report['split']:
+        hidden = report['overlap']
+        if hidden < MIN_GAIN * step:
+            return ('The split hides only {0:.1f} us ({1:.1f}% of the step) '
+                    'of communication per step.  At this subdomain size, it '
+                    'is not worth it; try --nobulk_boundary_split.'.format(
+                        hidden * 1e6, hidden / step * 100))
+        return ('The split hides {0:.0f}% of the communication ({1:.1f} us '
+                'per step, {2:.1f}% of the step), with {3:.1f} us still '
+                'exposed.  Keep it.'.format(report['overlap_fraction'] * 100,
+                                            hidden * 1e6, hidden / step * 100,
+                                            report['exposed'] * 1e6))
+
+    if report['bulk_fraction'] <= 0.0:
+        return ('The subdomain is too small to have a bulk region, so the '
+                'split cannot hide any communication.')
+    # Without the split, all communication is exposed.  At most the part
+    # of it that is shorter than the bulk kernel could be hidden.
+    potential = min(report['comm'], report['compute'] * report['bulk_fraction'])
+    if potential < MIN_GAIN * step:
+        return ('The split could hide at most {0:.1f} us ({1:.1f}% of the '
+                'step) of communication per step, which is not worth it at '
+                'this subdomain size.'.format(potential * 1e6,
+                                              potential / step * 100))
+    return ('The split could hide up to {0:.1f} us ({1:.1f}% of the step) of '
+            'communication per step; try running without '
+            '--nobulk_boundary_split.'.format(potential * 1e6,
+                                               potential / step * 100))
+
+
+def format_overlap(reports):
+    """Returns a list of lines of a table summarizing the overlap of
+    communication and computation.
+
+    :param reports: dict mapping subdomain IDs to dicts returned by
+        OverlapAnalyzer.report()
+    """
+    reports = dict((sid, r) for sid, r in reports.iteritems() if r['steps'])
+    if not reports:
+        return []
+    lines = ['{0:>4} {1:>5} {2:>10} {3:>9} {4:>12} {5:>12}  {6}'.format(
+        'sub', 'split', 'comm [us]', 'overlap', 'exposed [us]', 'bulk [us]',
+        'critical peer')]
+    for sid, r in sorted(reports.iteritems()):
+        if r['critical_peer'] is not None:
+            critical = '{0} ({1:.0f}% of steps)'.format(
+                r['critical_peer'], r['critical_share'] * 100)
+        else:
+            critical = '-'
+        lines.append('{0:>4} {1:>5} {2:>10.1f} {3:>8.1f}% {4:>12.1f} '
+                     '{5:>12.1f}  {6}'.format(
+                         sid, 'yes' if r['split'] else 'no', r['comm'] * 1e6,
+                         r['overlap_fraction'] * 100, r['exposed'] * 1e6,
+                         r['bulk'] * 1e6, critical))
+    # The subdomain with the most exposed communication determines the
+    # duration of the step.
+    sid, r = max(reports.iteritems(), key=lambda x: x[1]['exposed'])
+    lines.append('Subdomain {0}: {1}'.format(sid, recommend(r)))
+    return lines
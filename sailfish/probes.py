@@ -0,0 +1,345 @@
+"""Point probes recording time series of macroscopic fields.
+
+Probes are specified in a text file, with one probe per line, as global
+coordinates in natural order (x, y, [z]).  Coordinates do not need to be
+integers -- fields can be interpolated between nodes.
+
+Every probe is handled by the subdomain owning the node at which it is
+located.  With interpolation, a probe located between nodes of different
+subdomains is handled by all of them: every subdomain samples the nodes it
+owns, and the partial (weighted) sums are added in read().  The fields are
+sampled on the device after every simulation step
+(or every N steps) into a ring buffer, which is only transferred to the host
+when it is full.  Each subdomain saves its samples in two files:
+ - <base>.<subdomain_id>.probes.json: description of the probes and fields,
+ - <base>.<subdomain_id>.probes: sequence of binary records (see
+   record_dtype()) appended every time the ring buffer is flushed.
+
+Use read() to load the time series for all probes.
+"""
+
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'LGPL3'
+
+import glob
+import json
+import math
+import os
+import numpy as np
+
+
+def load(fname, dim):
+    """Loads probe locations from a text file.
+
+    :param fname: file name
+    :param dim: dimensionality of the simulation
+    :rvalue: float64 array of shape (num_probes, dim)
+    """
+    probes = np.loadtxt(fname, dtype=np.float64, ndmin=2)
+    if probes.shape[1] != dim:
+        raise ValueError('Probe locations in {0} should have {1} '
+                         'coordinates.'.format(fname, dim))
+    return probes
+
+
+def _wrap(nodes, global_size, periodicity):
+    """Maps global node locations outside of the simulation domain to the
+    corresponding nodes within it: periodic images for periodic axes, and
+    the closest node otherwise."""
+    if global_size is None:
+        return nodes
+    nodes = nodes.copy()
+    for axis, (n, periodic) in enumerate(zip(global_size, periodicity)):
+        if periodic:
+            nodes[:, axis] %= n
+        else:
+            nodes[:, axis] = np.clip(nodes[:, axis], 0, n - 1)
+    return nodes
+
+
+def locate(probes, location, size, interpolate=False, global_size=None,
+           periodicity=None):
+    """Finds the probes located within a subdomain.
+
+    :param probes: array of probe locations (see load())
+    :param location: location of the subdomain (natural order)
+    :param size: size of the subdomain (natural order)
+    :param interpolate: if True, field values are linearly interpolated
+        from the nodes surrounding the probe; otherwise, the value at the
+        nearest node is used
+    :param global_size: size of the simulation domain (natural order); if
+        set, nodes beyond the domain are replaced with their periodic images
+        or the closest node within the domain
+    :param periodicity: list of booleans indicating whether the domain is
+        periodic along every axis (natural order)
+    :rvalue: tuple of: array of IDs (indices in the probes array) of the
+        probes sampled in the subdomain, int array of shape (num_points,
+        num_probes, dim) with the locations of the nodes from which the field
+        is sampled (natural order, relative to the first non-ghost node of the
+        subdomain), float array of shape (num_points, num_probes) with the
+        weights of the nodes.  Nodes owned by other subdomains have a weight
+        of 0, and are replaced with a node within the subdomain.  The
+        weights for such probes thus only sum up to a partial value.
+    """
+    location = np.array(location)
+    size = np.array(size)
+    dim = len(location)
+    if periodicity is None:
+        periodicity = [False] * dim
+
+    def _owned(nodes):
+        return np.all((nodes >= location) & (nodes < location + size), axis=1)
+
+    if not interpolate:
+        base = _wrap(np.floor(probes + 0.5).astype(np.int64), global_size,
+                     periodicity)
+        ids = np.flatnonzero(_owned(base))
+        return ids, (base[ids] - location)[np.newaxis], np.ones((1, len(ids)))
+
+    base = np.floor(probes).astype(np.int64)
+    frac = probes - base
+
+    nodes = []
+    weights = []
+    for corner in xrange(1 << dim):
+        offset = np.array([(corner >> i) & 1 for i in range(dim)])
+        corner_nodes = _wrap(base + offset, global_size, periodicity)
+        nodes.append(corner_nodes - location)
+        weights.append(np.prod(np.where(offset, frac, 1.0 - frac), axis=1) *
+                       _owned(corner_nodes))
+    nodes = np.array(nodes)
+    weights = np.array(weights)
+
+    ids = np.flatnonzero(np.any(weights > 0.0, axis=0))
+    nodes = nodes[:, ids]
+    weights = weights[:, ids]
+
+    # Nodes owned by other subdomains are replaced with the first node with
+    # a nonzero weight, so that only valid locations are accessed.
+    first = np.argmax(weights > 0.0, axis=0)
+    foreign = weights == 0.0
+    replacement = nodes[first, np.arange(len(ids))]
+    for i in range(len(nodes)):
+        nodes[i][foreign[i]] = replacement[foreign[i]]
+    return ids, nodes, weights
+
+
+def record_dtype(num_values, num_probes, dtype):
+    """Returns the numpy dtype of a single record in a probe data file.
+
+    :param num_values: number of sampled values for every probe (sum of
+        the numbers of components of all sampled fields)
+    """
+    return np.dtype([('iteration', '<i8'),
+                     ('values', np.dtype(dtype).str, (num_values, num_probes))])
+
+
+def header_filename(base, subdomain_id):
+    return data_filename(base, subdomain_id) + '.json'
+
+
+def data_filename(base, subdomain_id):
+    return '{0}.{1}.probes'.format(base, subdomain_id)
+
+
+class ProbeRecorder(object):
+    """Samples macroscopic fields at probe locations within a subdomain."""
+
+    def __init__(self, runner, probes, fields, every=1, ring_len=100,
+                 interpolate=False):
+        """
+        :param runner: SubdomainRunner instance
+        :param probes: array of probe locations (see load())
+        :param fields: list of (name, field) tuples to sample, where field
+            is a scalar field or a list of vector field components
+        :param every: sampling interval, in iterations
+        :param ring_len: number of samples kept on the device before they
+            are transferred to the host
+        :param interpolate: see locate()
+        """
+        self._runner = runner
+        self._every = every
+        spec = runner._spec
+        config = runner.config
+        global_size = [config.lat_nx, config.lat_ny]
+        periodicity = [config.periodic_x, config.periodic_y]
+        if spec.dim == 3:
+            global_size.append(config.lat_nz)
+            periodicity.append(config.periodic_z)
+        self.ids, nodes, weights = locate(probes, spec.location, spec.size,
+                                          interpolate, global_size, periodicity)
+        self._samples = []
+        if len(self.ids) == 0:
+            return
+
+        backend = runner.backend
+        num_probes = len(self.ids)
+        num_values = sum(len(f) if type(f) is list else 1 for _, f in fields)
+        self._dtype = record_dtype(num_values, num_probes, runner.float)
+
+        es = spec.envelope_size
+        idx = np.array([runner._get_global_idx(list(n + es)) for n in
+                        nodes.reshape((-1, spec.dim))])
+        self._idx = backend.alloc_buf(like=np.uint32(idx))
+        self._weights = backend.alloc_buf(
+            like=weights.ravel().astype(runner.float))
+        self._ring_host = backend.alloc_async_host_buf(
+            ring_len * num_values * num_probes, dtype=runner.float).reshape(
+                (ring_len, num_values, num_probes))
+        self._ring = backend.alloc_buf(like=self._ring_host)
+
+        block_size = 32
+        grid = (int(math.ceil(num_probes / float(block_size))),)
+        self._kernels = []
+        offset = 0
+        for name, field in fields:
+            components = runner.gpu_field(field)
+            if type(field) is not list:
+                components = [components]
+            for gpu_field in components:
+                self._kernels.append(runner.get_kernel(
+                    'SampleProbes', [self._idx, self._weights, gpu_field,
+                                     self._ring, num_probes,
+                                     len(nodes), offset,
+                                     num_values * num_probes, every, ring_len],
+                    'PPPPiiiiii', (block_size,), needs_iteration=True))
+                offset += num_probes
+        self._grid = grid
+        self._timer = runner._profile.register_timer('probe_sample', gpu=True)
+
+        header = {
+            'version': 2,
+            'num_probes': len(probes),
+            'ids': self.ids.tolist(),
+            'locations': probes[self.ids].tolist(),
+            'interpolate': interpolate,
+            'fields': [(name, len(f) if type(f) is list else 0) for name, f
+                       in fields],
+            'dtype': np.dtype(runner.float).str,
+            'every': every,
+        }
+        base = runner.config.output
+        with open(header_filename(base, spec.id), 'w') as f:
+            json.dump(header, f)
+        self._fname = data_filename(base, spec.id)
+        # Data recorded in a previous run is only kept when the simulation
+        # is continued from a checkpoint (see restore()).
+        if not config.restore_from:
+            open(self._fname, 'wb').close()
+
+    @property
+    def active(self):
+        """True if there are any probes within the subdomain."""
+        return len(self.ids) > 0
+
+    def need_sample(self, iteration):
+        """Returns True if the fields are to be sampled after the step
+        which ends at iteration."""
+        return self.active and iteration % self._every == 0
+
+    def sample(self):
+        """Samples the fields.  Has to be called right after the simulation
+        step which computed the fields."""
+        runner = self._runner
+        runner._profile.record_gpu_start(self._timer, runner._calc_stream)
+        for kernel in self._kernels:
+            runner.backend.run_kernel(kernel, self._grid, runner._calc_stream)
+        runner._profile.record_gpu_end(self._timer, runner._calc_stream)
+        self._samples.append(runner._sim.iteration)
+        if len(self._samples) == len(self._ring_host):
+            self.flush()
+
+    def flush(self):
+        """Transfers the samples from the device and appends them to the data
+        file."""
+        if not self._samples:
+            return
+        runner = self._runner
+        runner.backend.from_buf_async(self._ring, runner._calc_stream)
+        runner._calc_stream.synchronize()
+
+        ring_len = len(self._ring_host)
+        records = np.zeros(len(self._samples), dtype=self._dtype)
+        records['iteration'] = self._samples
+        records['values'] = self._ring_host[
+            [(it / self._every) % ring_len for it in self._samples]]
+        self._samples = []
+        runner._output.submit(self._append, records)
+
+    def restore(self, iteration):
+        """Drops records saved after iteration from the data file.  Called
+        after the simulation state is restored from a checkpoint."""
+        truncate(self._fname, self._dtype, iteration)
+
+    def _append(self, records):
+        with open(self._fname, 'ab') as f:
+            records.tofile(f)
+
+
+def truncate(fname, dtype, iteration):
+    """Removes records for iterations later than iteration from a probe
+    data file.
+
+    :param dtype: record dtype (see record_dtype())
+    """
+    if not os.path.exists(fname):
+        return
+    records = np.fromfile(fname, dtype=dtype)
+    with open(fname, 'wb') as f:
+        records[records['iteration'] <= iteration].tofile(f)
+
+
+def read(base):
+    """Loads the time series recorded by all probes.
+
+    :param base: output base name
+    :rvalue: tuple of: array of iterations, dict mapping field names to
+        arrays of shape (num_iterations, num_probes) for scalar fields or
+        (num_iterations, num_probes, num_components) for vector fields;
+        probes are ordered as in the file from which they were loaded, and
+        data for probes which were never sampled is set to NaN.  Values of
+        probes sampled by several subdomains are added.
+    """
+    pieces = []
+    for fname in sorted(glob.glob(header_filename(base, '*'))):
+        with open(fname, 'r') as f:
+            header = json.load(f)
+        num_values = sum(max(n, 1) for _, n in header['fields'])
+        dtype = record_dtype(num_values, len(header['ids']), header['dtype'])
+        records = np.fromfile(fname[:-len('.json')], dtype=dtype)
+        # A simulation restarted from a checkpoint can record the same
+        # iterations again.  Keep the most recent samples.
+        _, last = np.unique(records['iteration'][::-1], return_index=True)
+        pieces.append((header, records[::-1][last]))
+
+    if not pieces:
+        raise ValueError('No probe data found for {0}.'.format(base))
+
+    iterations = np.unique(np.concatenate([r['iteration'] for _, r in pieces]))
+    num_probes = max(h['num_probes'] for h, _ in pieces)
+    sampled = np.zeros((len(iterations), num_probes), dtype=np.bool)
+    ret = {}
+    for header, records in pieces:
+        rows = np.searchsorted(iterations, records['iteration'])
+        sampled[rows[:, np.newaxis], header['ids']] = True
+        i = 0
+        for name, components in header['fields']:
+            name = str(name)
+            n = max(components, 1)
+            if name not in ret:
+                shape = [len(iterations), num_probes]
+                if components:
+                    shape.append(components)
+                ret[name] = np.zeros(shape, dtype=header['dtype'])
+            values = records['values'][:, i:i + n]
+            i += n
+            if components:
+                values = values.transpose((0, 2, 1))
+            else:
+                values = values[:, 0]
+            ret[name][rows[:, np.newaxis], header['ids']] += values
+
+    for values in ret.itervalues():
+        values[~sampled] = np.nan
+    return iterations, ret
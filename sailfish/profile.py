@@ -1,17 +1,201 @@
-"""Code for profiling a simulation."""
+"""Code for profiling a simulation.
+
+Timers are kept in a registry.  The core timers used by the subdomain
+runners are registered under fixed IDs (TimeProfile.BULK, etc.), and any
+other part of the code can register additional timers at runtime with
+TimeProfile.register_timer().  For every timer, the total, minimum and
+maximum duration is tracked, together with a latency histogram from which
+percentiles can be computed.
+
+The duration and peak memory use of the startup phases of the controller
+and the subdomain runners are recorded with StartupProfile.
+"""
 
 __author__ = 'Michal Januszewski'
 __email__ = 'sailfish-cfd@googlegroups.com'
 __license__ = 'LGPL3'
 
+import contextlib
+import json
+import sys
 import time
-from sailfish import util
+import numpy as np
+from sailfish import autotune, overlap, roofline, trace, util
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class Histogram(object):
+    """Log-linear latency histogram, in the style of HdrHistogram.
+
+    Durations are recorded with a resolution of 1 us and a relative error
+    not larger than 2^-(sub_bucket_bits - 1).
+    """
+
+    def __init__(self, sub_bucket_bits=6, max_exponent=40):
+        self._bits = sub_bucket_bits
+        self._half = 1 << (sub_bucket_bits - 1)
+        self.counts = np.zeros((1 << sub_bucket_bits) +
+                               max_exponent * self._half, dtype=np.int64)
+
+    def _index(self, us):
+        if us < (1 << self._bits):
+            return us
+        exp = us.bit_length() - self._bits
+        return (1 << self._bits) + (exp - 1) * self._half + (
+            (us >> exp) - self._half)
+
+    def _value(self, idx):
+        """Returns the midpoint of a bucket, in us."""
+        if idx < (1 << self._bits):
+            return float(idx)
+        exp = (idx - (1 << self._bits)) / self._half + 1
+        mantissa = (idx - (1 << self._bits)) % self._half + self._half
+        return (mantissa + 0.5) * (1 << exp)
+
+    def record(self, duration):
+        """Records a duration, in seconds."""
+        idx = self._index(int(duration * 1e6))
+        self.counts[min(idx, len(self.counts) - 1)] += 1
+
+    def merge(self, other):
+        self.counts += other.counts
+
+    @property
+    def total_count(self):
+        return int(self.counts.sum())
+
+    def percentile(self, p):
+        """Returns the p-th percentile of recorded durations, in seconds."""
+        total = self.total_count
+        if total == 0:
+            return 0.0
+        rank = max(1, int(np.ceil(p / 100.0 * total)))
+        idx = np.searchsorted(np.cumsum(self.counts), rank)
+        return self._value(int(idx)) / 1e6
+
+
+class TimerStats(object):
+    """Aggregated statistics for a single timer."""
+
+    PERCENTILES = (50, 90, 99, 99.9)
+
+    def __init__(self, name, gpu=False, track=trace.CPU):
+        """
+        :param name: name of the timer
+        :param gpu: True if the timer is measured with GPU events
+        :param track: trace track on which the timer's events are shown
+        """
+        self.name = name
+        self.gpu = gpu
+        self.track = track
+        self.count = 0
+        self.total = 0.0
+        self.min = 0.0
+        self.max = 0.0
+        self.histogram = Histogram()
+
+    def add(self, duration):
+        if self.count == 0:
+            self.min = self.max = duration
+        else:
+            self.min = min(self.min, duration)
+            self.max = max(self.max, duration)
+        self.count += 1
+        self.total += duration
+        self.histogram.record(duration)
+
+    def report(self):
+        """Returns a dict summarizing the timer."""
+        ret = {'gpu': self.gpu, 'count': self.count, 'total': self.total,
+               'mean': self.total / self.count if self.count else 0.0,
+               'min': self.min, 'max': self.max}
+        for p in self.PERCENTILES:
+            ret['p{0}'.format(p)] = self.histogram.percentile(p)
+        return ret
+
+
+def summary_requested(config):
+    """Returns True if subdomain runners are to send profiling summaries to
+    the controller at the end of the simulation."""
+    return bool(config.mode == 'benchmark' or config.profile_report or
+                config.bandwidth_file)
+
+
+def peak_rss():
+    """Returns the peak resident set size of the current process, in bytes,
+    or 0 if it is not available on this platform."""
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on OS X, and in kilobytes on Linux.
+    if sys.platform == 'darwin':
+        return rss
+    return rss * 1024
+
+
+class StartupProfile(object):
+    """Records the wall time and peak RSS of consecutive startup phases."""
+
+    def __init__(self):
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager timing a single phase.
+
+        :param name: name of the phase
+        """
+        t_start = time.time()
+        yield
+        self.phases.append({'phase': name, 'start': t_start,
+                            'time': time.time() - t_start,
+                            'peak_rss': peak_rss()})
+
+    @property
+    def total(self):
+        return sum(p['time'] for p in self.phases)
+
+
+def format_startup(controller_phases, subdomain_phases):
+    """Returns a list of lines of a table summarizing startup phases.
+
+    :param controller_phases: list of phases (see StartupProfile.phases) of
+        the controller
+    :param subdomain_phases: dict mapping subdomain IDs to lists of phases of
+        the subdomain runners; for every phase, the slowest subdomain is
+        shown
+    """
+    lines = ['{0:<28} {1:>9} {2:>14}  {3}'.format(
+        'Startup phase', 'time [s]', 'peak RSS [MB]', 'slowest subdomain')]
+    for p in controller_phases:
+        lines.append('{0:<28} {1:>9.3f} {2:>14.1f}'.format(
+            'controller/' + p['phase'], p['time'], p['peak_rss'] / 1048576.0))
+
+    names = []
+    slowest = {}
+    for sid, phases in sorted(subdomain_phases.iteritems()):
+        for p in phases:
+            if p['phase'] not in slowest:
+                names.append(p['phase'])
+                slowest[p['phase']] = (sid, p)
+            elif p['time'] > slowest[p['phase']][1]['time']:
+                slowest[p['phase']] = (sid, p)
+    for name in names:
+        sid, p = slowest[name]
+        lines.append('{0:<28} {1:>9.3f} {2:>14.1f}  {3}'.format(
+            'runner/' + name, p['time'], p['peak_rss'] / 1048576.0, sid))
+    return lines
+
 
 class TimeProfile(object):
     """Maintains statistics about time spent in different parts of the
     simulation."""
 
-    # GPU events.
+    # IDs of core timers.  GPU events.
     BULK = 0
     BOUNDARY = 1
     COLLECTION = 2
@@ -27,94 +211,235 @@ class TimeProfile(object):
     SEND_MACRO = 10
     RECV_MACRO = 11
     NET_RECV = 12
+    NET_SEND = 13
+
+    STEP = 14
 
-    STEP = 13
+    # (name, gpu, track) for the core timers, in the order of their IDs.
+    _CORE_TIMERS = [
+        ('bulk', True, trace.GPU_CALC),
+        ('boundary', True, trace.GPU_CALC),
+        ('collection', True, trace.GPU_DATA),
+        ('distrib', True, trace.GPU_DATA),
+        ('macro_bulk', True, trace.GPU_CALC),
+        ('macro_boundary', True, trace.GPU_CALC),
+        ('macro_collection', True, trace.GPU_DATA),
+        ('macro_distrib', True, trace.GPU_DATA),
+        ('send_dists', False, trace.CPU),
+        ('recv_dists', False, trace.CPU),
+        ('send_macro', False, trace.CPU),
+        ('recv_macro', False, trace.CPU),
+        ('net_recv', False, trace.CPU),
+        ('net_send', False, trace.CPU),
+        ('step', False, trace.CPU),
+    ]
 
-    # This event needs to have the highest ID.
-    # Square of total calculation time. Used for standard deviation.
-    STEP_SQ = 14
+    # Timers measuring the bulk kernels and the exchange of data with
+    # neighboring subdomains, used for the overlap analysis.
+    _BULK_TIMERS = (BULK, MACRO_BULK)
+    _COMM_TIMERS = (SEND_DISTS, RECV_DISTS, SEND_MACRO, RECV_MACRO)
 
     def __init__(self, runner):
         self._runner = runner
         self._make_event = runner.backend.make_event
         self._events_start = {}
         self._events_end = {}
-        self._times_start = [0.0] * (self.STEP_SQ + 1)
-        self._timings = [0.0] * (self.STEP_SQ + 1)
-        self._min_timings = [1000.0] * (self.STEP_SQ + 1)
-        self._max_timings = [0.0] * (self.STEP_SQ + 1)
+        self._times_start = []
+        self._listeners = []
+        self.timers = []
+        self._timer_ids = {}
+        for name, gpu, track in self._CORE_TIMERS:
+            self.register_timer(name, gpu, track)
+
+        # Square of total calculation time, accumulated over minibatches.
+        # Used for standard deviation.
+        self._step_sq = 0.0
         self._samples = 0
         self._sample_sum = 0.0
+        self.startup = StartupProfile()
+        # Set in record_start() if the overlap of communication and
+        # computation is to be analyzed.
+        self.overlap = None
+
+        config = runner.config
+        if config.trace_iters > 0:
+            self.tracer = trace.Tracer(runner._spec.id, self.event_names(),
+                                       config.trace_from, config.trace_iters)
+        else:
+            self.tracer = None
+
+    def register_timer(self, name, gpu=False, track=None):
+        """Registers a new timer, or returns the ID of an existing one.
+
+        :param name: unique name of the timer
+        :param gpu: if True, the timer is to be used with record_gpu_start()
+            and record_gpu_end(); otherwise with record_cpu_start() and
+            record_cpu_end()
+        :param track: trace track for the timer's events (see sailfish.trace);
+            defaults to the calculation stream for GPU timers
+        :rvalue: ID of the timer
+        """
+        if name in self._timer_ids:
+            return self._timer_ids[name]
+        if track is None:
+            track = trace.GPU_CALC if gpu else trace.CPU
+        timer_id = len(self.timers)
+        self.timers.append(TimerStats(name, gpu, track))
+        self._times_start.append(0.0)
+        self._timer_ids[name] = timer_id
+        if getattr(self, 'tracer', None) is not None:
+            self.tracer.event_names[timer_id] = name
+        return timer_id
+
+    def add_listener(self, func):
+        """Registers a function to be called as func(timer_id, duration) at
+        the end of every measurement of a CPU timer.  Unlike the aggregated
+        statistics, listeners also see measurements taken before
+        --benchmark_sample_from."""
+        self._listeners.append(func)
+
+    def instrument(self, obj, method, name):
+        """Measures all calls of obj.method with a new CPU timer.
+
+        :param obj: object whose bound method is to be replaced with the
+            measured version
+        :param method: name of the method
+        :param name: name of the timer
+        """
+        timer_id = self.register_timer(name)
+        func = getattr(obj, method)
+
+        def measured(*args, **kwargs):
+            self.record_cpu_start(timer_id)
+            ret = func(*args, **kwargs)
+            self.record_cpu_end(timer_id)
+            return ret
+
+        setattr(obj, method, measured)
+
+    def event_names(self):
+        """Returns a dict mapping timer IDs to names."""
+        return dict((i, t.name) for i, t in enumerate(self.timers))
+
+    def report(self):
+        """Returns a dict mapping timer names to dicts summarizing the
+        timers (see TimerStats.report())."""
+        return dict((t.name, t.report()) for t in self.timers if t.count)
 
     def record_start(self):
         self.t_start = time.time()
+        if summary_requested(self._runner.config):
+            self.overlap = overlap.OverlapAnalyzer()
+
+    def _timing_info(self, stat):
+        timers = self.timers
+        return util.TimingInfo(
+                comp=stat(timers[self.BULK]) + stat(timers[self.BOUNDARY]),
+                bulk=stat(timers[self.BULK]),
+                bnd=stat(timers[self.BOUNDARY]),
+                coll=stat(timers[self.COLLECTION]),
+                net_wait=stat(timers[self.NET_RECV]),
+                recv=stat(timers[self.RECV_DISTS]),
+                send=stat(timers[self.SEND_DISTS]),
+                total=stat(timers[self.STEP]),
+                total_sq=0.0,
+                subdomain_id=self._runner._spec.id)
 
     def record_end(self):
         self.t_end = time.time()
-        if self._runner.config.mode != 'benchmark':
+        config = self._runner.config
+        if self.tracer is not None and len(self.tracer):
+            if self.tracer.dropped:
+                config.logger.warning(
+                    '{0} oldest trace events were dropped.'.format(
+                        self.tracer.dropped))
+            self.tracer.save(config.trace_file)
+
+        if not summary_requested(config):
             return
-        mi = self._runner.config.max_iters - self._runner.config.benchmark_sample_from
+        mi = config.max_iters - config.benchmark_sample_from
 
         # Final minibatch might be incomplete, but we still need to take it into
         # account.
         if self._samples > 0:
-            self._timings[self.STEP_SQ] += self._samples * (self._sample_sum /
-                                                            self._samples)**2
-
-        ti = util.TimingInfo(
-                comp=(self._timings[self.BULK] + self._timings[self.BOUNDARY]) / mi,
-                bulk=self._timings[self.BULK] / mi,
-                bnd =self._timings[self.BOUNDARY] / mi,
-                coll=self._timings[self.COLLECTION] / mi,
-                net_wait=self._timings[self.NET_RECV] / mi,
-                recv=self._timings[self.RECV_DISTS] / mi,
-                send=self._timings[self.SEND_DISTS] / mi,
-                total=self._timings[self.STEP] / mi,
-                total_sq=self._timings[self.STEP_SQ] / mi,
-                subdomain_id=self._runner._spec.id)
+            self._step_sq += self._samples * (self._sample_sum /
+                                              self._samples)**2
 
-        min_ti = util.TimingInfo(
-                comp=(self._min_timings[self.BULK] + self._min_timings[self.BOUNDARY]),
-                bulk=self._min_timings[self.BULK],
-                bnd =self._min_timings[self.BOUNDARY],
-                coll=self._min_timings[self.COLLECTION],
-                net_wait=self._min_timings[self.NET_RECV],
-                recv=self._min_timings[self.RECV_DISTS],
-                send=self._min_timings[self.SEND_DISTS],
-                total=self._min_timings[self.STEP],
-                total_sq=0.0,
-                subdomain_id=self._runner._spec.id)
+        ti = self._timing_info(lambda t: t.total / mi)._replace(
+            total_sq=self._step_sq / mi)
+        min_ti = self._timing_info(lambda t: t.min)
+        max_ti = self._timing_info(lambda t: t.max)
 
-        max_ti = util.TimingInfo(
-                comp=(self._max_timings[self.BULK] + self._max_timings[self.BOUNDARY]),
-                bulk=self._max_timings[self.BULK],
-                bnd =self._max_timings[self.BOUNDARY],
-                coll=self._max_timings[self.COLLECTION],
-                net_wait=self._max_timings[self.NET_RECV],
-                recv=self._max_timings[self.RECV_DISTS],
-                send=self._max_timings[self.SEND_DISTS],
-                total=self._max_timings[self.STEP],
-                total_sq=0.0,
-                subdomain_id=self._runner._spec.id)
+        if config.peak_bandwidth > 0:
+            peak = config.peak_bandwidth * 1e9
+        else:
+            peak = self._runner.backend.peak_bandwidth
+        bandwidth = roofline.bandwidth_report(
+            self.timers, self._runner._kernel_traffic(), peak)
+        overlap_report = self.overlap.report(
+            ti.total, ti.comp, self._runner._boundary_blocks is not None,
+            self._runner._bulk_fraction)
 
-        self._runner.send_summary_info(ti, min_ti, max_ti)
+        self._runner.send_summary_info(ti, min_ti, max_ti,
+                                       {'timers': self.report(),
+                                        'startup': self.startup.phases,
+                                        'bandwidth': bandwidth,
+                                        'overlap': overlap_report,
+                                        'autotune_key': autotune.make_key(
+                                            config, self._runner._spec,
+                                            self._runner._sim,
+                                            self._runner.backend)})
 
     def start_step(self):
+        need_ref = self.overlap is not None
+        if self.tracer is not None:
+            self.tracer.set_iteration(self._runner._sim.iteration)
+            need_ref = need_ref or self.tracer.active
+        if need_ref:
+            # GPU event times are measured relative to this event.
+            self._trace_ref = self._make_event(self._runner._calc_stream,
+                                               timing=True)
+            self._trace_ref_time = time.time()
         self.record_cpu_start(self.STEP)
 
     def end_step(self):
-        if (self._runner._sim.iteration <
+        self.record_cpu_end(self.STEP)
+        if self.tracer is not None and self.tracer.active:
+            self._trace_gpu_events()
+
+        if (self._runner._sim.iteration >=
             self._runner.config.benchmark_sample_from):
-            return
+            # Aggregate timings from GPU events.
+            for i, ev_start in self._events_start.iteritems():
+                self.timers[i].add(self._events_end[i].time_since(ev_start) / 1e3)
+            if self.overlap is not None:
+                self.overlap.end_step(self._gpu_intervals(self._BULK_TIMERS))
 
-        self.record_cpu_end(self.STEP)
+        self._events_start.clear()
+        self._events_end.clear()
+
+    def _gpu_intervals(self, timer_ids):
+        """Returns a list of (start, end) host times of the GPU events of
+        the current step measured by the given timers."""
+        ref = self._trace_ref
+        ret = []
+        for i in timer_ids:
+            if i in self._events_start:
+                ret.append((
+                    self._trace_ref_time +
+                    self._events_start[i].time_since(ref) / 1e3,
+                    self._trace_ref_time +
+                    self._events_end[i].time_since(ref) / 1e3))
+        return ret
 
-        # Aggregate timings from GPU events.
+    def _trace_gpu_events(self):
+        ref = self._trace_ref
         for i, ev_start in self._events_start.iteritems():
-            duration = self._events_end[i].time_since(ev_start) / 1e3
-            self._timings[i] += duration
-            self._min_timings[i] = min(self._min_timings[i], duration)
-            self._max_timings[i] = max(self._max_timings[i], duration)
+            start = ev_start.time_since(ref) / 1e3
+            end = self._events_end[i].time_since(ref) / 1e3
+            self.tracer.record(i, self.timers[i].track,
+                               self._trace_ref_time + start,
+                               self._trace_ref_time + end)
 
     def record_gpu_start(self, event, stream):
         ev = self._make_event(stream, timing=True)
@@ -129,29 +454,158 @@ class TimeProfile(object):
     def record_cpu_start(self, event):
         self._times_start[event] = time.time()
 
-    def record_cpu_end(self, event):
+    def record_cpu_end(self, event, peer=-1):
+        """
+        :param peer: ID of the neighboring subdomain involved in the event;
+            only used for tracing
+        """
+        t_end = time.time()
+        if self.tracer is not None and self.tracer.active:
+            self.tracer.record(event, trace.CPU, self._times_start[event],
+                               t_end, peer)
+
+        duration = t_end - self._times_start[event]
+        for listener in self._listeners:
+            listener(event, duration)
+
         if (self._runner._sim.iteration <
             self._runner.config.benchmark_sample_from):
             return
 
-        t_end = time.time()
-        duration = t_end - self._times_start[event]
-        self._min_timings[event] = min(self._min_timings[event], duration)
-        self._max_timings[event] = max(self._max_timings[event], duration)
-        self._timings[event] += duration
+        self.timers[event].add(duration)
 
-        minibatch = self._runner.config.benchmark_minibatch
+        if self.overlap is not None:
+            if event in self._COMM_TIMERS:
+                self.overlap.add_comm(self._times_start[event], t_end)
+            elif event == self.NET_RECV:
+                self.overlap.add_wait(peer, duration)
 
         if event == self.STEP:
+            minibatch = self._runner.config.benchmark_minibatch
             self._samples += 1
             self._sample_sum += duration
 
             if self._samples == minibatch:
-                self._timings[self.STEP_SQ] += minibatch * (self._sample_sum / minibatch)**2
+                self._step_sq += minibatch * (self._sample_sum / minibatch)**2
                 self._sample_sum = 0.0
                 self._samples = 0
 
 
+def merge_reports(reports):
+    """Merges timer reports from multiple subdomains.
+
+    :param reports: dict mapping subdomain IDs to reports returned by
+        TimeProfile.report()
+    :rvalue: dict with per-subdomain reports and, for every timer, the
+        total count and the worst-case (max over subdomains) statistics
+    """
+    timers = {}
+    for report in reports.itervalues():
+        for name, stats in report.iteritems():
+            if name not in timers:
+                timers[name] = dict(stats)
+                continue
+            merged = timers[name]
+            merged['count'] += stats['count']
+            merged['total'] += stats['total']
+            for key, value in stats.iteritems():
+                if key == 'min':
+                    merged[key] = min(merged[key], value)
+                elif key not in ('gpu', 'count', 'total', 'mean'):
+                    merged[key] = max(merged[key], value)
+            merged['mean'] = merged['total'] / merged['count']
+    return {'subdomains': dict((str(k), v) for k, v in reports.iteritems()),
+            'timers': timers}
+
+
+def save_report(fname, reports, extra=None):
+    """Saves a machine-readable profiling report.
+
+    :param fname: output file name
+    :param reports: dict mapping subdomain IDs to timer reports, see
+        merge_reports()
+    :param extra: dict of additional data to include in the report
+    """
+    data = merge_reports(reports)
+    if extra:
+        data.update(extra)
+    with open(fname, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+
+# Timers measuring host phases with --host_overhead, as (name, name of the
+# enclosing timer).  The phases enclosed by 'step' are called directly from
+# the main loop of the subdomain runner.
+HOST_PHASES = [
+    ('host_requests', 'step'),
+    ('host_step', 'step'),
+    ('host_boundary', 'host_step'),
+    ('host_bulk', 'host_step'),
+    ('send_dists', 'host_step'),
+    ('net_send', 'send_dists'),
+    ('recv_dists', 'host_step'),
+    ('net_recv', 'recv_dists'),
+    ('send_macro', 'host_step'),
+    ('recv_macro', 'host_step'),
+    ('reductions', 'step'),
+    ('host_fields_to_host', 'step'),
+    ('host_update_output', 'step'),
+    ('host_save_output', 'step'),
+    ('host_after_step', None),
+]
+
+
+def format_host_overhead(reports):
+    """Returns a list of lines of a table summarizing the host time per
+    simulation step, for every host phase.
+
+    The time not accounted for by any of the enclosed phases is shown as
+    'other', and includes the cost of the profiling itself (about
+    1 us for every measured call).
+
+    :param reports: dict mapping subdomain IDs to timer reports, see
+        merge_reports(); the times are averaged over all subdomains
+    """
+    timers = merge_reports(reports)['timers']
+    if 'step' not in timers:
+        return []
+    steps = float(timers['step']['count'])
+    lines = ['{0:<28} {1:>9} {2:>10} {3:>9} {4:>9}'.format(
+        'Host phase', 'us/step', 'calls/step', 'us/call', 'p99 [us]')]
+
+    def add_line(name, depth, total, count=None, t=None):
+        label = '  ' * depth + name
+        if t is None:
+            lines.append('{0:<28} {1:>9.2f}'.format(label, total / steps * 1e6))
+        else:
+            lines.append('{0:<28} {1:>9.2f} {2:>10.2f} {3:>9.2f} '
+                         '{4:>9.2f}'.format(label, total / steps * 1e6,
+                                            count / steps, t['mean'] * 1e6,
+                                            t['p99'] * 1e6))
+
+    depth = {'step': 0, None: -1}
+    children = {}
+    for name, parent in HOST_PHASES:
+        depth[name] = depth[parent] + 1
+        if name in timers:
+            children.setdefault(parent, []).append(name)
+
+    def add_phase(name):
+        t = timers[name]
+        add_line(name, depth[name], t['total'], t['count'], t)
+        if name in children:
+            for child in children[name]:
+                add_phase(child)
+            other = t['total'] - sum(timers[c]['total'] for c in
+                                     children[name])
+            add_line('other', depth[name] + 1, other)
+
+    add_phase('step')
+    for name in children.get(None, []):
+        add_phase(name)
+    return lines
+
+
 def profile(profile_event):
     def _profile(f):
         def decorate(self, *args, **kwargs):
@@ -161,4 +615,3 @@ def profile(profile_event):
             return ret
         return decorate
     return _profile
-
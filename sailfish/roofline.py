@@ -0,0 +1,85 @@
+"""Achieved memory bandwidth of the compute kernels.
+
+LB simulations are memory-bound, so the best measure of how close a kernel
+is to the hardware limits is the memory bandwidth it achieves.  Subdomain
+runners describe the memory traffic of their kernels with
+SubdomainRunner._kernel_traffic(), from which the bandwidth is computed
+using the GPU event times measured by TimeProfile, and compared with
+the peak bandwidth of the device (--peak_bandwidth, or the value detected by
+the backend).
+"""
+
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'LGPL3'
+
+
+def bandwidth_report(timers, traffic, peak=None):
+    """Computes the achieved bandwidth of kernels.
+
+    :param timers: list of TimerStats objects, indexed by timer ID
+    :param traffic: list of (timer ID, items, bytes per item) tuples, where
+        items is the number of nodes (or other units of work) processed by
+        a single call of the kernels measured by the timer
+    :param peak: peak memory bandwidth of the device, in bytes/s, or None
+        if unknown
+    :rvalue: list of dicts, one for every kernel which was run
+    """
+    ret = []
+    for timer_id, items, bytes_per_item in traffic:
+        timer = timers[timer_id]
+        if not timer.count or not items:
+            continue
+        mean = timer.total / timer.count
+        moved = items * bytes_per_item
+        entry = {'kernel': timer.name, 'items': items,
+                 'bytes_per_item': bytes_per_item, 'bytes': moved,
+                 'time': mean,
+                 'bandwidth': moved / mean if mean > 0 else 0.0}
+        if peak:
+            entry['peak'] = peak
+            entry['peak_fraction'] = entry['bandwidth'] / peak
+            # Upper bound on performance for a memory-bound kernel.
+            entry['max_mlups'] = peak / bytes_per_item * 1e-6
+        ret.append(entry)
+    return ret
+
+
+def format_bandwidth(reports):
+    """Returns a list of lines of a table summarizing achieved bandwidth.
+
+    :param reports: dict mapping subdomain IDs to lists returned by
+        bandwidth_report()
+    """
+    lines = ['{0:>4} {1:<18} {2:>10} {3:>10} {4:>9} {5:>9} {6:>8}'.format(
+        'sub', 'kernel', 'B/item', 'time [ms]', 'GB/s', '% peak',
+        'max MLUPS')]
+    for sid, entries in sorted(reports.iteritems()):
+        for e in entries:
+            if 'peak' in e:
+                peak = '{0:>9.1f} {1:>8.1f}'.format(e['peak_fraction'] * 100,
+                                                   e['max_mlups'])
+            else:
+                peak = '{0:>9} {1:>8}'.format('-', '-')
+            lines.append('{0:>4} {1:<18} {2:>10} {3:>10.3f} {4:>9.2f} '
+                         '{5}'.format(sid, e['kernel'], e['bytes_per_item'],
+                                      e['time'] * 1e3, e['bandwidth'] * 1e-9,
+                                      peak))
+    return lines
+
+
+def save_bandwidth(fname, reports):
+    """Saves achieved bandwidth as tab-separated columns, in the format of
+    the perftest result files.
+
+    :param reports: see format_bandwidth()
+    """
+    with open(fname, 'w') as f:
+        f.write('# subdomain\tkernel\titems\tbytes_per_item\ttime\t'
+                'bandwidth\tpeak_fraction\n')
+        for sid, entries in sorted(reports.iteritems()):
+            for e in entries:
+                f.write('{0}\t{1}\t{2}\t{3}\t{4!r}\t{5!r}\t{6!r}\n'.format(
+                    sid, e['kernel'], e['items'], e['bytes_per_item'],
+                    e['time'], e['bandwidth'],
+                    e.get('peak_fraction', float('nan'))))
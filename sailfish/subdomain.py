@@ -8,7 +8,6 @@ from collections import defaultdict, namedtuple
 import inspect
 import operator
 import numpy as np
-from scipy.ndimage import filters
 
 from sailfish import util
 from sailfish import sym
@@ -341,7 +340,13 @@ class Subdomain(object):
 
     @classmethod
     def add_options(cls, group):
-        pass
+        group.add_argument('--geometry_slab_size', type=int, default=0,
+                metavar='N',
+                help='If > 0, boundary and initial conditions are evaluated '
+                'in slabs of N nodes along the slowest-varying axis, and the '
+                'geometry is postprocessed slab by slab.  This limits the '
+                'peak host memory usage when setting up large subdomains. '
+                'If 0, the whole subdomain is processed at once.')
 
     def __init__(self, grid_shape, spec, grid, *args, **kwargs):
         """
@@ -369,6 +374,10 @@ class Subdomain(object):
         self._needs_orientation = False
         self._orientation = spec.runner.make_scalar_field(np.uint32,
                 register=False)
+        # Slab of nodes (along the slowest-varying axis) currently being
+        # processed in chunked mode.  None if the whole subdomain is processed
+        # at once.
+        self._slab = None
 
     @property
     def config(self):
@@ -382,6 +391,27 @@ class Subdomain(object):
         raise NotImplementedError('initial_conditions() not defined in a child '
                 'class')
 
+    def _slabs(self, size):
+        """Divides the range [0, size) into slabs of at most
+        geometry_slab_size nodes.
+
+        :param size: number of nodes along the slowest-varying axis
+        :rvalue: iterator over slice objects; a single slice covering the whole
+            range is returned if chunked processing is disabled
+        """
+        step = self.config.geometry_slab_size
+        if step <= 0:
+            step = size
+        for start in xrange(0, size, step):
+            yield slice(start, min(start + step, size))
+
+    def _slab_field(self, field):
+        """Returns the part of a non-ghost field corresponding to the slab
+        currently being processed."""
+        if self._slab is None:
+            return field
+        return field[self._slab]
+
     def _verify_params(self, where, node_type):
         """Verifies that the node parameters are set correctly."""
 
@@ -426,16 +456,18 @@ class Subdomain(object):
             assert isinstance(node_type, nt.LBNodeType)
 
         self._verify_params(where, node_type)
-        self._type_map[where] = node_type.id
+        type_map = self._slab_field(self._type_map)
+        param_map = self._slab_field(self._param_map)
+        type_map[where] = node_type.id
         key = hash((node_type.id, frozenset(node_type.params.items())))
-        assert np.all(self._param_map[where] == 0),\
+        assert np.all(param_map[where] == 0),\
                 "Overriding previously set nodes is not allowed."
-        self._param_map[where] = key
+        param_map[where] = key
         self._params[key] = node_type
         self._seen_types.add(node_type.id)
 
         if hasattr(node_type, 'orientation') and node_type.orientation is not None:
-            self._orientation[where] = node_type.orientation
+            self._slab_field(self._orientation)[where] = node_type.orientation
         elif node_type.needs_orientation:
             self._needs_orientation = True
 
@@ -470,8 +502,15 @@ class Subdomain(object):
     def reset(self):
         self.config.logger.debug('Setting subdomain geometry...')
         self._type_map_encoded = False
-        mgrid = self._get_mgrid()
-        self.boundary_conditions(*mgrid)
+        if self.config.geometry_slab_size > 0:
+            for slab in self._slabs(self.spec.size[-1]):
+                self._slab = slab
+                try:
+                    self.boundary_conditions(*self._get_mgrid(slab))
+                finally:
+                    self._slab = None
+        else:
+            self.boundary_conditions(*self._get_mgrid())
         self.config.logger.debug('... boundary conditions done.')
 
         self._postprocess_nodes()
@@ -496,8 +535,40 @@ class Subdomain(object):
         return self._encoder.scratch_space_size if self._encoder is not None else 0
 
     def init_fields(self, sim):
-        mgrid = self._get_mgrid()
-        self.initial_conditions(sim, *mgrid)
+        if self.config.geometry_slab_size > 0:
+            shape = tuple(reversed(self.spec.size))
+            for slab in self._slabs(self.spec.size[-1]):
+                self.initial_conditions(_SlabView(sim, slab, shape),
+                                        *self._get_mgrid(slab))
+        else:
+            self.initial_conditions(sim, *self._get_mgrid())
+
+    def _dry_types(self):
+        """Returns an array of IDs of dry node types used in the subdomain.
+
+        The unused node type is always included, so that nodes marked as unused
+        while postprocessing one slab are still treated as dry when processing
+        its neighbors.
+        """
+        dry_types = list((set(nt.get_dry_node_type_ids()) & self._seen_types) |
+                         set([nt._NTUnused.id]))
+        return self._type_map.dtype.type(dry_types)
+
+    def _postprocess_nodes(self):
+        type_map = self._type_map.base
+        dry_types = self._dry_types()
+
+        # Find nodes which are walls themselves and are completely surrounded by
+        # walls.  These nodes are marked as unused, as they do not contribute to
+        # the dynamics of the fluid in any way.  The number of dry neighbors
+        # (including the node itself) is computed on a uint8 mask with
+        # a periodic halo.
+        for slab in self._slabs(type_map.shape[0]):
+            dry_map = util.in_anyd_fast(util.wrapped_slab(type_map, slab),
+                                        dry_types).view(np.uint8)
+            dry_map = util.periodic_halo(dry_map, range(1, dry_map.ndim))
+            where = util.neighbor_count(dry_map, self.grid) == self.grid.Q
+            type_map[slab][where] = nt._NTUnused.id
 
     def update_context(self, ctx):
         assert self._encoder is not None
@@ -533,9 +604,19 @@ class Subdomain2D(Subdomain):
         self.gy, self.gx = grid_shape
         Subdomain.__init__(self, grid_shape, spec, *args, **kwargs)
 
-    def _get_mgrid(self):
-        return reversed(np.mgrid[self.spec.oy:self.spec.oy + self.spec.ny,
-                                 self.spec.ox:self.spec.ox + self.spec.nx])
+    def _get_mgrid(self, slab=None):
+        """Returns coordinate arrays for the subdomain.
+
+        :param slab: if not None, only coordinates of nodes within this slab
+            (along the Y axis) are returned, as broadcast views which do not
+            allocate memory for every node
+        """
+        if slab is None:
+            return reversed(np.mgrid[self.spec.oy:self.spec.oy + self.spec.ny,
+                                     self.spec.ox:self.spec.ox + self.spec.nx])
+        return reversed(np.broadcast_arrays(*np.ogrid[
+            self.spec.oy + slab.start:self.spec.oy + slab.stop,
+            self.spec.ox:self.spec.ox + self.spec.nx]))
 
     def _define_ghosts(self):
         assert not self._type_map_encoded
@@ -547,22 +628,6 @@ class Subdomain2D(Subdomain):
         self._type_map.base[es + self.spec.ny:, :] = nt._NTGhost.id
         self._type_map.base[:, es + self.spec.nx:] = nt._NTGhost.id
 
-    def _postprocess_nodes(self):
-        uniq_types = set(np.unique(self._type_map.base))
-        dry_types = list(set(nt.get_dry_node_type_ids()) & uniq_types)
-        dry_types = self._type_map.dtype.type(dry_types)
-
-        # Find nodes which are walls themselves and are completely surrounded by
-        # walls.  These nodes are marked as unused, as they do not contribute to
-        # the dynamics of the fluid in any way.
-        cnt = np.zeros_like(self._type_map.base).astype(np.uint32)
-        for i, vec in enumerate(self.grid.basis):
-            a = np.roll(self._type_map.base, int(-vec[0]), axis=1)
-            a = np.roll(a, int(-vec[1]), axis=0)
-            cnt[util.in_anyd_fast(a, dry_types)] += 1
-
-        self._type_map.base[(cnt == self.grid.Q)] = nt._NTUnused.id
-
 class Subdomain3D(Subdomain):
     dim = 3
 
@@ -570,10 +635,21 @@ class Subdomain3D(Subdomain):
         self.gz, self.gy, self.gx = grid_shape
         Subdomain.__init__(self, grid_shape, spec, *args, **kwargs)
 
-    def _get_mgrid(self):
-        return reversed(np.mgrid[self.spec.oz:self.spec.oz + self.spec.nz,
-                                 self.spec.oy:self.spec.oy + self.spec.ny,
-                                 self.spec.ox:self.spec.ox + self.spec.nx])
+    def _get_mgrid(self, slab=None):
+        """Returns coordinate arrays for the subdomain.
+
+        :param slab: if not None, only coordinates of nodes within this slab
+            (along the Z axis) are returned, as broadcast views which do not
+            allocate memory for every node
+        """
+        if slab is None:
+            return reversed(np.mgrid[self.spec.oz:self.spec.oz + self.spec.nz,
+                                     self.spec.oy:self.spec.oy + self.spec.ny,
+                                     self.spec.ox:self.spec.ox + self.spec.nx])
+        return reversed(np.broadcast_arrays(*np.ogrid[
+            self.spec.oz + slab.start:self.spec.oz + slab.stop,
+            self.spec.oy:self.spec.oy + self.spec.ny,
+            self.spec.ox:self.spec.ox + self.spec.nx]))
 
     def _define_ghosts(self):
         assert not self._type_map_encoded
@@ -587,20 +663,33 @@ class Subdomain3D(Subdomain):
         self._type_map.base[:, es + self.spec.ny:, :] = nt._NTGhost.id
         self._type_map.base[:, :, es + self.spec.nx:] = nt._NTGhost.id
 
-    def _postprocess_nodes(self):
-        uniq_types = set(np.unique(self._type_map.base))
-        dry_types = list(set(nt.get_dry_node_type_ids()) & uniq_types)
-        dry_types = self._type_map.dtype.type(dry_types)
 
-        # Find nodes which are walls themselves and are completely surrounded by
-        # walls. These nodes are marked as unused, as they do not contribute to
-        # the dynamics of the fluid in any way.
-        dry_map = util.in_anyd_fast(self._type_map.base,
-                                    dry_types).astype(np.uint8)
-        neighbors = np.zeros((3, 3, 3), dtype=np.uint8)
-        neighbors[1,1,1] = 1
-        for ei in self.grid.basis:
-            neighbors[1 + ei[2], 1 + ei[1], 1 + ei[0]] = 1
-
-        where = (filters.convolve(dry_map, neighbors, mode='wrap') == self.grid.Q)
-        self._type_map.base[where] = nt._NTUnused.id
+class _SlabView(object):
+    """Restricts the fields of a simulation object to a slab of nodes.
+
+    All attribute lookups are forwarded to the wrapped simulation object.
+    Arrays (and lists of arrays, as used for vector fields) covering the whole
+    subdomain are replaced with views of the selected slab, so that they can
+    be indexed with the coordinate arrays passed to initial_conditions()."""
+
+    def __init__(self, sim, slab, shape):
+        """
+        :param sim: LBSim instance
+        :param slab: slice object selecting nodes along the slowest-varying
+            axis
+        :param shape: shape of a non-ghost field in the subdomain
+        """
+        self._sim = sim
+        self._slab = slab
+        self._shape = shape
+
+    def _is_field(self, value):
+        return isinstance(value, np.ndarray) and value.shape == self._shape
+
+    def __getattr__(self, name):
+        value = getattr(self._sim, name)
+        if self._is_field(value):
+            return value[self._slab]
+        if type(value) is list and value and all(self._is_field(x) for x in value):
+            return [x[self._slab] for x in value]
+        return value
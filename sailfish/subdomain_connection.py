@@ -328,11 +328,19 @@ def _get_dst_full_slice(b1, b2, src_slice_global, full_map, slice_axes):
         b2_start = b2.location[slice_axes[i]]
         dst_low.append(global_pos.start - b2_start)
 
-    full_idxs = np.argwhere(full_map)
-    if len(full_idxs) > 0:
+    if np.any(full_map):
         # Lowest and highest coordinate along each axis.
-        full_min = np.min(full_idxs, 0)
-        full_max = np.max(full_idxs, 0)
+        full_min = []
+        full_max = []
+        for axis in range(full_map.ndim):
+            proj = full_map
+            for other in reversed(range(full_map.ndim)):
+                if other != axis:
+                    proj = np.logical_or.reduce(proj, other)
+            nonzero = np.flatnonzero(proj)
+            full_min.append(nonzero[0])
+            full_max.append(nonzero[-1])
+
         # Loop over axes.
         for i, (lo, hi) in enumerate(zip(full_min, full_max)):
             b2_start = b2.location[slice_axes[i]]
@@ -361,47 +369,42 @@ def _get_dst_partial_map(dists, grid, src_slice_global, b1, slice_axes,
     :param conn_axis: axis along which the two subdomains are connected
     """
     # Location of the b1 block in global coordinates (real nodes only).
-    min_loc = np.int32([b1.location[ax] for ax in slice_axes])
-    max_loc = np.int32([b1.end_location[ax] for ax in slice_axes])
-
-    # Creates an array where the entry at [x,y] is the global coordinate pair
-    # corresponding to the node [x,y] in the transfer buffer.
-    src_coords = np.mgrid[src_slice_global]
-    # [2,x,y] -> [x,y,2]
-    src_coords = np.rollaxis(src_coords, 0, len(src_coords.shape))
+    min_loc = [b1.location[ax] for ax in slice_axes]
+    max_loc = [b1.end_location[ax] for ax in slice_axes]
 
-    last_axis = len(src_coords.shape) - 1
+    # Global coordinates of the nodes in the transfer buffer, as a list of
+    # open grids (one array per axis, broadcastable to the buffer shape).
+    src_coords = np.ogrid[src_slice_global]
+    buf_shape = [span.stop - span.start for span in src_slice_global]
 
     # Selects source nodes that have the full set of distributions (`dists`).
-    full_map = np.ones(src_coords.shape[:-1], dtype=np.bool)
+    full_map = np.ones(buf_shape, dtype=np.bool)
 
-    # Maps distribution index to a boolean array selecting (in src_coords)
-    # nodes for which the distribution identified by the key is defined.
+    # Maps distribution index to a boolean array selecting (in the transfer
+    # buffer) nodes for which the distribution identified by the key is defined.
     dist_idx_to_dist_map = {}
 
     for dist_idx in dists:
         # When we follow the basis vector backwards, do we end up at a
-        # real (non-ghost) node in the source subdomain?
+        # real (non-ghost) node in the source subdomain?  The condition is
+        # evaluated separately for every axis and then combined.
         basis_vec = [int(x) for x in grid.basis[dist_idx]]
         del basis_vec[conn_axis]
-        src_block_node = src_coords - basis_vec
-        dist_map = np.logical_and(src_block_node >= min_loc,
-                                  src_block_node < max_loc)
+        dist_map = np.ones(buf_shape, dtype=np.bool)
+        for coords, shift, lo, hi in zip(src_coords, basis_vec, min_loc, max_loc):
+            src_block_node = coords - shift
+            dist_map &= (src_block_node >= lo) & (src_block_node < hi)
 
-        dist_map = np.logical_and.reduce(dist_map, last_axis)
-        full_map = np.logical_and(full_map, dist_map)
+        full_map &= dist_map
         dist_idx_to_dist_map[dist_idx] = dist_map
 
     # Maps distribution index to an array of indices (pairs in 3D, single
     # coordinate in 2D) in the local subdomain coordinate system (real nodes).
     dst_partial_map = {}
-    buf_min_loc = [span.start for span in src_slice_global]
 
     for dist_idx, dist_map in dist_idx_to_dist_map.iteritems():
-        partial_nodes = src_coords[np.logical_and(dist_map,
-                                   np.logical_not(full_map))]
+        partial_nodes = np.argwhere(dist_map & np.logical_not(full_map))
         if len(partial_nodes) > 0:
-            partial_nodes -= buf_min_loc
             dst_partial_map[dist_idx] = partial_nodes
 
     return dst_partial_map, full_map
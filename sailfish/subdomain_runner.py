@@ -11,7 +11,7 @@ import operator
 import os
 import numpy as np
 import zmq
-from sailfish import codegen, io
+from sailfish import checkpoint, codegen, diagnostics, io, metrics, probes
 from sailfish.profile import profile, TimeProfile
 from sailfish.subdomain_connection import ConnectionBuffer, MacroConnectionBuffer
 
@@ -64,6 +64,7 @@ class SubdomainRunner(object):
         """
 
         self._summary_sender = None
+        self._master_sock = None
         self._ppid = os.getppid() if os.name != 'nt' else 0
 
         self._ctx = zmq.Context()
@@ -90,6 +91,36 @@ class SubdomainRunner(object):
         self._vis_map_cache = None
         self._quit_event = quit_event
 
+        # Slices (slowest-varying axis first) selecting the nodes saved in
+        # output files, or None if all nodes are saved.  Reduced output is
+        # gathered into separate host arrays: (field, component, host array)
+        # for fields collected on the device and (field, host array) for
+        # fields reduced on the host.
+        self._output_selection = None
+        self._output_active = True
+        self._output_buffers = []
+        self._output_host_buffers = []
+        self._output_kernels = []
+
+        # (name, field) for all named fields, the probe recorder,
+        # the device reductions and the live metrics collector.
+        self._named_fields = []
+        self._probes = None
+        self._reductions = None
+        self._metrics = None
+
+        # Number of checkpoints saved so far, and (file name, dists) of
+        # the last full checkpoint, used for incremental checkpoints.
+        self._checkpoints = 0
+        self._checkpoint_ref = None
+        self._checkpoint_writer = io.AsyncWriter(1)
+
+        # Number of steps included in the profiling statistics (see
+        # --benchmark_sample_from), and the number of these steps in which
+        # macroscopic fields were written.
+        self._sampled_steps = 0
+        self._macro_steps = 0
+
         self._profile = TimeProfile(self)
         # This only happens in unit tests.
         if master_addr is not None:
@@ -246,7 +277,9 @@ class SubdomainRunner(object):
         fview[:] = 0
 
         if name is not None and register:
-            self._output.register_field(fview, name)
+            self._named_fields.append((name, fview))
+            if self._is_output_field(name):
+                self._output.register_field(self._output_view(fview), name)
 
         if register:
             self._scalar_fields.append(fview)
@@ -261,11 +294,43 @@ class SubdomainRunner(object):
             components.append(field)
 
         if name is not None:
-            self._output.register_field(components, name)
+            self._named_fields.append((name, components))
+        if name is not None and self._is_output_field(name):
+            self._output.register_field(
+                [self._output_view(c, components, i) for i, c in
+                 enumerate(components)], name)
 
         self._vector_fields.append(components)
         return components
 
+    def _is_output_field(self, name):
+        return not self.config.output_fields or name in self.config.output_fields
+
+    def _output_view(self, field, vector=None, component=None):
+        """Returns the array to register for output in place of field.
+
+        :param field: scalar field (non-ghost view)
+        :param vector: vector field that field is a component of, if any
+        :param component: index of the component within vector
+        """
+        if self._output_selection is None:
+            return field
+
+        shape = field[self._output_selection].shape
+        if not self._output_active:
+            return np.zeros(shape, dtype=field.dtype)
+        if field.dtype == self.float:
+            host = self.backend.alloc_async_host_buf(
+                reduce(operator.mul, shape), dtype=field.dtype).reshape(shape)
+            if vector is None:
+                self._output_buffers.append((field, None, host))
+            else:
+                self._output_buffers.append((vector, component, host))
+        else:
+            host = np.zeros(shape, dtype=field.dtype)
+            self._output_host_buffers.append((field, host))
+        return host
+
     def visualization_map(self):
         if self._vis_map_cache is None:
             self._vis_map_cache = self._subdomain.visualization_map()
@@ -277,10 +342,144 @@ class SubdomainRunner(object):
         self._subdomain = self._sim.subdomain(self._global_size, self._spec,
                 self._sim.grid)
         self._subdomain.reset()
-        self._output.set_fluid_map(self._subdomain.fluid_map())
+        self._init_output_selection()
         if self.config.debug_dump_node_type_map:
             self._output.dump_node_type(self._subdomain.visualization_map())
 
+    def _init_output_selection(self):
+        """Determines which nodes of the subdomain are saved in output
+        files (see the --output_region and --output_stride options)."""
+        fluid_map = self._subdomain.fluid_map()
+        stride = io.parse_output_stride(self.config.output_stride, self.dim)
+
+        if not self.config.output_region and all(x == 1 for x in stride):
+            self._output.set_fluid_map(fluid_map)
+            self._output.set_location(self._spec.location)
+            return
+
+        region = io.parse_output_region(self.config.output_region, self.dim)
+        self._output.set_selection(self.config.output_region, stride)
+        selection = io.output_selection(region, stride, self._spec.location,
+                                        self._spec.size)
+        if selection is None:
+            # Nothing to save in this subdomain.  Fields are still registered
+            # with empty arrays to keep the output object consistent.
+            self._output_active = False
+            self._output_selection = [slice(0, 0)] * self.dim
+            return
+
+        slices, location = selection
+        self._output_selection = list(reversed(slices))
+        self._output.set_fluid_map(fluid_map[self._output_selection])
+        self._output.set_location(location)
+
+    def _init_output_kernels(self):
+        """Creates kernels gathering the nodes saved in output files into
+        compact device buffers."""
+        if not self._output_buffers or not self._output_active:
+            return
+
+        es = self._spec.envelope_size
+        selection = [slice(x.start + es, x.stop + es, x.step) for x in
+                     self._output_selection]
+        coords = np.broadcast_arrays(*np.ogrid[selection])
+        idx = self._get_global_idx(list(reversed(coords)))
+        self._output_idx = GPUBuffer(np.uint32(idx).ravel(), self.backend)
+
+        block_size = 32
+        grid_size = (int(math.ceil(idx.size / float(block_size))),)
+        for field, component, host in self._output_buffers:
+            gpu_field = self.gpu_field(field)
+            if component is not None:
+                gpu_field = gpu_field[component]
+            buf = GPUBuffer(host, self.backend)
+            self._output_kernels.append((KernelGrid(
+                self.get_kernel('CollectSparseData',
+                                [self._output_idx.gpu, gpu_field, buf.gpu,
+                                 idx.size], 'PPPi', (block_size,)),
+                grid_size), buf))
+
+    def _init_probes(self):
+        """Sets up sampling of fields at probe locations (see the --probes
+        option)."""
+        if not self.config.probes:
+            return
+        if not self.config.output:
+            raise ValueError('Recording probes requires --output to be set.')
+
+        if self.config.probe_fields:
+            named = dict(self._named_fields)
+            for name in self.config.probe_fields:
+                if name not in named:
+                    raise ValueError('Unknown probe field: {0}'.format(name))
+            fields = [(name, named[name]) for name in self.config.probe_fields]
+        else:
+            fields = [(name, f) for name, f in self._named_fields if
+                      type(f) is list or f.dtype == self.float]
+
+        recorder = probes.ProbeRecorder(
+            self, probes.load(self.config.probes, self.dim), fields,
+            self.config.probe_every, self.config.probe_buffer,
+            self.config.probe_interpolate)
+        if recorder.active:
+            self.config.logger.debug('Recording {0} probes.'.format(
+                len(recorder.ids)))
+            self._probes = recorder
+
+    def _init_reductions(self):
+        """Prepares evaluation of the reductions declared by the simulation."""
+        reductions = self._sim.get_reductions()
+        if reductions and self.config.reductions_every > 0:
+            self._reductions = diagnostics.DeviceReductions(
+                self, reductions, self._named_fields)
+            # Without a master, the results are merged locally.  This is only
+            # possible when the simulation has a single subdomain.
+            if self._master_sock is None:
+                self._reduction_collector = diagnostics.ReductionCollector(
+                    reductions, 1, self.config.logger,
+                    self.config.reductions_file)
+
+    def _send_reductions(self):
+        values = self._reductions.evaluate()
+        if self._master_sock is None:
+            self._reduction_collector.add(self._sim.iteration, values)
+        else:
+            self._master_sock.send_pyobj(('reductions', self._sim.iteration,
+                                          values))
+
+    def _update_output(self, from_host=False):
+        """Fills reduced output arrays which are not transferred from the
+        device.
+
+        :param from_host: if True, all reduced output arrays are filled from
+            the host copies of the fields
+        """
+        if self._output_selection is None:
+            return
+        buffers = list(self._output_host_buffers)
+        if from_host:
+            for field, component, host in self._output_buffers:
+                if component is not None:
+                    field = field[component]
+                buffers.append((field, host))
+        for field, host in buffers:
+            host[:] = field[self._output_selection]
+
+    def _check_output(self):
+        """Fills reduced output arrays and checks the output for invalid
+        values (if enabled with --check_invalid_results_host).
+
+        :rvalue: False if an invalid value was found in the output
+        """
+        self._update_output()
+        if not self.config.check_invalid_results_host:
+            return True
+        return self._output.verify()
+
+    def _save_output(self):
+        if self._output_active:
+            self._output.save(self._sim.iteration)
+
     def _init_shape(self):
         # Logical size of the lattice (including ghost nodes).
         # X dimension is the last one on the list (nz, ny, nx)
@@ -376,6 +575,16 @@ class SubdomainRunner(object):
 
         self._kernel_grid_bulk[0] /= bs
 
+        # Fraction of the nodes that are handled by the bulk kernel if the
+        # bulk/boundary split is used (see sailfish.overlap).
+        if (0 in self._kernel_grid_bulk or self._kernel_grid_bulk[0] < 0 or
+                self._kernel_grid_bulk[1] < 0):
+            self._bulk_fraction = 0.0
+        else:
+            self._bulk_fraction = (
+                reduce(operator.mul, self._kernel_grid_bulk) /
+                float(reduce(operator.mul, self._kernel_grid_full)))
+
         # Special cases: boundary kernels can cover the whole domain or this is
         # the only block participating in the simulation.
         if (0 in self._kernel_grid_bulk or self._kernel_grid_bulk[0] < 0 or
@@ -437,6 +646,41 @@ class SubdomainRunner(object):
     def num_nodes(self):
         return reduce(operator.mul, self._lat_size)
 
+    def _kernel_nodes(self):
+        """Returns the number of nodes processed by the bulk and boundary
+        kernels in a single step."""
+        bs = self._kernel_block_size[0]
+        if self._boundary_blocks is None:
+            # The boundary kernel handles the whole domain.
+            return 0, reduce(operator.mul, self._kernel_grid_full) * bs
+        return (reduce(operator.mul, self._kernel_grid_bulk) * bs,
+                reduce(operator.mul, self._boundary_blocks) * bs)
+
+    def _kernel_traffic(self):
+        """Describes the memory traffic of the compute kernels.
+
+        :rvalue: list of (timer ID, nodes, bytes per node) tuples, see
+            roofline.bandwidth_report()
+        """
+        float_size = self.float().nbytes
+        # Every node update reads and writes all distributions, and reads the
+        # node type from the geometry map.  This is the same for the AA and AB
+        # access patterns.
+        dists = sum(grid.Q for grid in self._sim.grids)
+        per_node = 2 * dists * float_size + np.uint32().nbytes
+        # Macroscopic fields are only written on steps for which they are
+        # requested (output, probes, reductions), so their traffic is
+        # averaged over the steps which were actually measured.
+        if self._sampled_steps:
+            components = sum(len(f) if type(f) is list else 1 for _, f in
+                             self._named_fields)
+            per_node += (components * float_size * self._macro_steps /
+                         float(self._sampled_steps))
+
+        bulk, boundary = self._kernel_nodes()
+        return [(TimeProfile.BULK, bulk, per_node),
+                (TimeProfile.BOUNDARY, boundary, per_node)]
+
     def _get_dist_bytes(self, grid):
         """Returns the number of bytes required to store a single set of
            distributions for the whole simulation domain."""
@@ -459,23 +703,25 @@ class SubdomainRunner(object):
             return ((gx + arr_nx * gy + arr_nx * arr_ny * gz) +
                     (self._get_nodes() * dist_num))
 
-    def _idx_helper(self, gx, buf_slice, dists):
+    def _idx_helper(self, gx, buf_slice, dists=None):
         """Returns a numpy array of global indices (in the subdomain coordinate
         system).
 
         :param gx: location along the x axis
         :param buf_slice: slice in the area perpendicular to the X axis
-        :param dists: a list of distribution indices
+        :param dists: a list of distribution indices; if None, indices of
+            nodes (e.g. for macroscopic fields) are returned
         """
-        sel = [slice(0, len(dists))]
-        idx = np.mgrid[sel + list(reversed(buf_slice))].astype(np.uint32)
-        for i, dist_num in enumerate(dists):
-            idx[0][i,:] = dist_num
-        if self.dim == 2:
-            return self._get_global_idx((gx, idx[1]), idx[0]).astype(np.uint32)
+        if dists is None:
+            coords = np.ogrid[list(reversed(buf_slice))]
+            dist_num = 0
         else:
-            return self._get_global_idx((gx, idx[2], idx[1]),
-                    idx[0]).astype(np.uint32)
+            coords = np.ogrid[[slice(0, len(dists))] + list(reversed(buf_slice))]
+            dist_num = np.int_(dists)[coords[0]]
+            coords = coords[1:]
+
+        return self._get_global_idx([gx] + list(reversed(coords)),
+                                    dist_num).astype(np.uint32)
 
     def _get_src_slice_indices(self, face, cpair, opposite=False):
         """Returns a numpy array of indices of sparse nodes from which
@@ -530,7 +776,10 @@ class SubdomainRunner(object):
 
     def _dst_face_loc_to_full_loc(self, face, face_loc, opposite=False):
         """Expands a location tuple in the (full) face coordinate system into a
-        a complete location tuple in the full coordinate system of the subdomain."""
+        a complete location tuple in the full coordinate system of the subdomain.
+
+        The elements of face_loc can be either numbers or numpy arrays of
+        coordinates."""
         axis = self._spec.face_to_axis(face)
         # In the fully local step of the AA access pattern, the location along
         # the connection axis is different.
@@ -539,59 +788,53 @@ class SubdomainRunner(object):
         else:
             missing_loc = self.lat_linear_dist[self._spec.opposite_face(face)]
 
-        if axis == 0:
-            return [missing_loc] + face_loc
-        elif axis == 1:
-            if self.dim == 2:
-                return (face_loc[0], missing_loc)
-            else:
-                return (face_loc[0], missing_loc, face_loc[1])
-        elif axis == 2:
-            return face_loc + [missing_loc]
+        full_loc = list(face_loc)
+        full_loc.insert(axis, missing_loc)
+        return full_loc
 
     def _get_partial_dst_indices(self, face, cpair):
-        """Returns objects used to store data for nodes for which a partial
-        set of distributions is available.
+        """Returns objects used to distribute data for nodes for which a
+        partial set of distributions is available.
 
         This has the form of a tuple:
-        - a page-locked numpy buffer for the distributions
         - a numpy array of indices of nodes to which partial data is to be
           distributed
-        - like the previous item, but for the fully local step in the AA access
-          pattern
         - a selector to be applied to the receive buffer to get the partial
           distributions
 
+        The partial distributions are serialized into a single continuous
+        buffer, in the order of increasing distribution number.
+
         :param face: face ID for the connection
         :param cpair: ConnectionPair describing the connection
         """
         if cpair.dst.partial_nodes == 0:
-            return None, None, None
-        buf = self.backend.alloc_async_host_buf(cpair.dst.partial_nodes,
-                dtype=self.float)
-        idx = np.zeros(cpair.dst.partial_nodes, dtype=np.uint32)
-        dst_low = [x + self._spec.envelope_size for x in cpair.dst.dst_low]
-        sel = []
-        i = 0
-        for dist_num, locations in sorted(cpair.dst.dst_partial_map.items()):
-            for loc in locations:
-                dst_loc = [x + y for x, y in zip(dst_low, loc)]
-                dst_loc = self._dst_face_loc_to_full_loc(face, dst_loc)
-
-                # Reverse 'loc' here to go from natural order (x, y, z) to the
-                # in-face buffer order z, y, x
-                sel.append([cpair.dst.dists.index(dist_num)] + list(reversed(loc)))
-                idx[i] = self._get_global_idx(dst_loc, dist_num)
-                i += 1
-        sel2 = []
-        for i in range(0, len(sel[0])):
-            sel2.append([])
-
-        for loc in sel:
-            for i, coord in enumerate(loc):
-                sel2[i].append(coord)
-
-        return buf, idx, sel2
+            return None, None
+
+        dist_nums = []
+        buf_dists = []
+        locations = []
+        for dist_num, dist_locations in sorted(cpair.dst.dst_partial_map.items()):
+            n = len(dist_locations)
+            dist_nums.append(np.repeat(dist_num, n))
+            buf_dists.append(np.repeat(cpair.dst.dists.index(dist_num), n))
+            locations.append(dist_locations)
+        dist_nums = np.hstack(dist_nums)
+        buf_dists = np.hstack(buf_dists)
+        locations = np.vstack(locations)
+
+        # Locations are in the natural order (x, y, z) in the face coordinate
+        # system.
+        dst_loc = [locations[:,i] + self._spec.envelope_size + x for i, x in
+                   enumerate(cpair.dst.dst_low)]
+        dst_loc = self._dst_face_loc_to_full_loc(face, dst_loc)
+        idx = self._get_global_idx(dst_loc, dist_nums).astype(np.uint32)
+
+        # Reverse the location here to go from natural order (x, y, z) to the
+        # in-face buffer order z, y, x.
+        sel = [buf_dists] + [locations[:,i] for i in
+                             reversed(range(locations.shape[1]))]
+        return idx, sel
 
     def _init_buffers(self):
         """Creates buffers for inter-block communication."""
@@ -624,6 +867,12 @@ class SubdomainRunner(object):
                     dist_full_idx_opposite = None
                     coll_idx_opposite = None
 
+                # Any partial dists are serialized into a single continuous
+                # buffer.  The indices are shared by all grids.
+                dist_partial_idx, dist_partial_sel = \
+                        self._get_partial_dst_indices(face, cpair)
+                dist_partial_idx = GPUBuffer(dist_partial_idx, self.backend)
+
                 for i, grid in enumerate(self._sim.grids):
                     # TODO(michalj): Optimize this by providing proper padding.
                     coll_buf = alloc(cpair.src.transfer_shape, dtype=self.float)
@@ -639,16 +888,18 @@ class SubdomainRunner(object):
                         local_coll_buf = None
                         local_recv_buf = None
 
-                    # Any partial dists are serialized into a single continuous buffer.
-                    dist_partial_buf, dist_partial_idx, dist_partial_sel = \
-                            self._get_partial_dst_indices(face, cpair)
+                    if dist_partial_sel is not None:
+                        dist_partial_buf = alloc(cpair.dst.partial_nodes,
+                                                 dtype=self.float)
+                    else:
+                        dist_partial_buf = None
 
                     cbuf = ConnectionBuffer(face, cpair,
                             GPUBuffer(coll_buf, self.backend),
                             coll_idx,
                             recv_buf,
                             GPUBuffer(dist_partial_buf, self.backend),
-                            GPUBuffer(dist_partial_idx, self.backend),
+                            dist_partial_idx,
                             dist_partial_sel,
                             GPUBuffer(dist_full_buf, self.backend),
                             dist_full_idx, i,
@@ -691,13 +942,17 @@ class SubdomainRunner(object):
     def _init_gpu_data(self):
         self.config.logger.debug("Initializing compute unit data.")
 
+        # Fields are wrapped in arrays so that they can be used in reduction
+        # kernels.
         for field in self._scalar_fields:
-            self._gpu_field_map[id(field)] = self.backend.alloc_buf(like=field.base)
+            self._gpu_field_map[id(field)] = self.backend.alloc_buf(
+                like=field.base, wrap_in_array=True)
 
         for field in self._vector_fields:
             gpu_vector = []
             for component in field:
-                gpu_vector.append(self.backend.alloc_buf(like=component.base))
+                gpu_vector.append(self.backend.alloc_buf(
+                    like=component.base, wrap_in_array=True))
             self._gpu_field_map[id(field)] = gpu_vector
 
         for grid in self._sim.grids:
@@ -869,12 +1124,14 @@ class SubdomainRunner(object):
         for b_id, connector in self._spec._connectors.iteritems():
             conn_bufs = self._block_to_connbuf[b_id]
 
+            self._profile.record_cpu_start(TimeProfile.NET_SEND)
             if len(conn_bufs) > 1:
                 connector.send(np.hstack(
                     [np.ravel(getattr(x, buf).host) for x in conn_bufs]))
             else:
                 # TODO(michalj): Use non-blocking sends here?
                 connector.send(np.ravel(getattr(conn_bufs[0], buf).host).copy())
+            self._profile.record_cpu_end(TimeProfile.NET_SEND, b_id)
 
     @profile(TimeProfile.RECV_DISTS)
     def _recv_dists(self):
@@ -899,7 +1156,7 @@ class SubdomainRunner(object):
                 if not connector.recv(dest, self._quit_event):
                     return
 
-                self._profile.record_cpu_end(TimeProfile.NET_RECV)
+                self._profile.record_cpu_end(TimeProfile.NET_RECV, b_id)
                 i = 0
                 for cbuf in conn_bufs:
                     recv_buf = get_buf(cbuf)
@@ -917,7 +1174,7 @@ class SubdomainRunner(object):
                 if not connector.recv(dest, self._quit_event):
                     return
 
-                self._profile.record_cpu_end(TimeProfile.NET_RECV)
+                self._profile.record_cpu_end(TimeProfile.NET_RECV, b_id)
                 # If ravel returned a copy, we need to write the data
                 # back to the proper buffer.
                 # TODO(michalj): Check if there is any way of avoiding this
@@ -926,8 +1183,21 @@ class SubdomainRunner(object):
                     recv_buf[:] = dest.reshape(recv_buf.shape)
                 distribute(cbuf)
 
-    def _fields_to_host(self):
-        """Copies data for all fields from the GPU to the host."""
+    def _fields_to_host(self, full=True):
+        """Copies data for all fields from the GPU to the host.
+
+        :param full: if False, only data saved in output files is copied
+        """
+        for kernel, buf in self._output_kernels:
+            self.backend.run_kernel(kernel.kernel, kernel.grid, self._calc_stream)
+            self.backend.from_buf_async(buf.gpu, self._calc_stream)
+
+        if not full and self._output_selection is not None:
+            for field, _ in self._output_host_buffers:
+                self.backend.from_buf_async(self.gpu_field(field),
+                                            self._calc_stream)
+            return
+
         for field in self._scalar_fields:
             self.backend.from_buf_async(self.gpu_field(field), self._calc_stream)
 
@@ -1185,10 +1455,11 @@ class SubdomainRunner(object):
         gy = rest / arr_nx
         return dist_num, gy, gx
 
-    def send_summary_info(self, timing_info, min_timings, max_timings):
+    def send_summary_info(self, timing_info, min_timings, max_timings,
+                          report):
         if self._summary_sender is not None:
             self._summary_sender.send_pyobj((timing_info, min_timings,
-                    max_timings))
+                    max_timings, report))
             self.config.logger.debug('Sending timing information to controller.')
             assert self._summary_sender.recv() == 'ack'
 
@@ -1197,38 +1468,107 @@ class SubdomainRunner(object):
         self._sim.verify_fields()
 
     def save_checkpoint(self):
+        """Saves the live copy of the distributions to a checkpoint file.
+
+        The file is compressed and written in a background thread."""
+        incremental = (self.config.checkpoint_incremental > 0 and
+                       self._checkpoint_ref is not None and
+                       self._checkpoints % self.config.checkpoint_incremental != 0)
+
         if self.config.single_checkpoint:
             fname = io.checkpoint_filename(self.config.checkpoint_file,
                     1, self._spec.id, 0)
+            # Do not overwrite the reference for incremental checkpoints.
+            if incremental:
+                fname += '.inc'
         else:
             fname = io.checkpoint_filename(self.config.checkpoint_file,
                     io.filename_iter_digits(self.config.max_iters),
                     self._spec.id, self._sim.iteration)
+        fname += '.npz'
 
         sim_state = pickle.dumps(self._sim.get_state(), -1)
-        data = { 'state': sim_state }
-
-        for i in range(len(self._sim.grids)):
-            data['dist{0}a'.format(i)] = self._debug_get_dist(True, i)
-            data['dist{0}b'.format(i)] = self._debug_get_dist(False, i)
-
-        np.savez(fname, **data)
+        dists = [self._debug_get_dist(True, i) for i in
+                 range(len(self._sim.grids))]
+
+        reference = None
+        if incremental:
+            reference = self._checkpoint_ref
+        elif self.config.checkpoint_incremental > 0:
+            self._checkpoint_ref = (fname, dists)
+        self._checkpoints += 1
+
+        self._checkpoint_writer.submit(checkpoint.write, fname, sim_state,
+                dists, self.config.checkpoint_codec, reference,
+                self.config.checkpoint_tolerance, self._placement())
+        # An incremental checkpoint saved for the reference that has just
+        # been overwritten is no longer valid.
+        if self.config.single_checkpoint and not incremental:
+            self._checkpoint_writer.submit(checkpoint.remove,
+                                           fname[:-len('.npz')] + '.inc.npz')
+
+    def _placement(self):
+        return {'location': list(self._spec.location),
+                'size': list(self._spec.size),
+                'envelope_size': self._spec.envelope_size}
 
     def restore_checkpoint(self, fname):
+        """Restores the simulation state from a checkpoint.
+
+        :param fname: name of a checkpoint file saved by any subdomain; the
+            checkpoint can come from a simulation using a different subdomain
+            decomposition
+        """
         self.config.logger.info('Restoring checkpoint')
 
-        cpoint = np.load(fname)
-        sim_state = pickle.loads(str(cpoint['state']))
+        sim_state, meta = checkpoint.read_meta(fname)
+        if meta is None or meta.get('placement') is None:
+            _, dists, secondary = checkpoint.read(fname)
+        else:
+            dists, secondary = self._read_checkpoint_pieces(
+                checkpoint.piece_files(fname))
         self._sim.set_state(sim_state)
 
-        for k, v in cpoint.iteritems():
-            if not k.startswith('dist'):
-                continue
-
-            is_primary = k.endswith('a')
-            dist_num = int(k[4:-1])
-
-            self._debug_set_dist(v, is_primary, dist_num)
+        for i, dist in enumerate(dists):
+            self._debug_set_dist(dist, True, i)
+            # With the AA access pattern, there is only a single copy of
+            # the distributions.
+            if self.config.access_pattern == 'AB':
+                if secondary is not None:
+                    self._debug_set_dist(secondary[i], False, i)
+                else:
+                    self._debug_set_dist(dist, False, i)
+
+    def _read_checkpoint_pieces(self, fnames):
+        """Returns distributions for this subdomain, read from a set of
+        checkpoint files saved by all subdomains."""
+        placement = self._placement()
+        shape = [self._sim.grid.Q] + self._physical_size
+
+        # If the checkpoint contains this subdomain, restore the complete
+        # distributions, including ghost nodes.
+        for fname in fnames:
+            _, meta = checkpoint.read_meta(fname)
+            if (meta['placement'] == placement and
+                    list(meta['grids'][0]['shape']) == shape):
+                self.config.logger.debug('Restoring from {0}.'.format(fname))
+                _, dists, secondary = checkpoint.read(fname)
+                return dists, secondary
+
+        # Otherwise, assemble the non-ghost nodes from all subdomains
+        # overlapping with this one.  Ghost nodes keep their current values.
+        self.config.logger.debug('Assembling distributions from {0} '
+                                 'checkpoint files.'.format(len(fnames)))
+        dists = [self._debug_get_dist(True, i) for i in
+                 range(len(self._sim.grids))]
+        start = list(reversed(self._spec.location))
+        stop = [a + n for a, n in zip(start, reversed(self._spec.size))]
+        filled = checkpoint.load_region(fnames, start, stop, dists,
+                                        [self._spec.envelope_size] * len(start))
+        if filled != self._spec.num_nodes:
+            raise ValueError('Checkpoint does not cover subdomain {0}.'.format(
+                self._spec.id))
+        return dists, None
 
     def _prepare_compute_kernels(self):
         gck = self._sim.get_compute_kernels
@@ -1242,41 +1582,86 @@ class SubdomainRunner(object):
         self.config.logger.info("Initializing subdomain.")
         self.config.logger.debug(self.backend.info)
 
-        self._init_geometry()
-        self._sim.init_fields(self)
-        self._init_buffers()
-        self._init_compute()
+        phase = self._profile.startup.phase
+        with phase('geometry'):
+            self._init_geometry()
+        with phase('fields'):
+            self._sim.init_fields(self)
+        with phase('buffers'):
+            self._init_buffers()
+        with phase('compile'):
+            self._init_compute()
         self.config.logger.debug("Initializing macroscopic fields.")
-        self._subdomain.init_fields(self._sim)
-        self._init_gpu_data()
+        with phase('macro_fields'):
+            self._subdomain.init_fields(self._sim)
+        with phase('gpu_data'):
+            self._init_gpu_data()
         self.config.logger.debug("Applying initial conditions.")
 
-        self._init_interblock_kernels()
-        self._prepare_compute_kernels()
-        self._pbc_kernels = self._sim.get_pbc_kernels(self)
-        self._aux_kernels = self._sim.get_aux_kernels(self)
-
-        self._initial_conditions()
-
-        if self.config.output:
-            self._output.save(self._sim.iteration)
-
-        if not self.config.max_iters:
-            self.config.logger.warning("Running infinite simulation.")
-
-        if self.config.restore_from:
-            self.restore_checkpoint(self.config.restore_from)
-
-        if self._initialization:
-            self.initialize()
-
-        self.config.logger.info("Starting simulation.")
-        self.main()
+        with phase('kernels'):
+            self._init_interblock_kernels()
+            self._init_output_kernels()
+            self._init_probes()
+            self._init_reductions()
+            if self.config.metrics_every > 0 and self._master_sock is not None:
+                self._metrics = metrics.RunnerMetrics(
+                    self, self.config.metrics_every)
+            self._prepare_compute_kernels()
+            self._pbc_kernels = self._sim.get_pbc_kernels(self)
+            self._aux_kernels = self._sim.get_aux_kernels(self)
+            if self.config.host_overhead:
+                self._instrument_host_phases()
+
+        # Make sure snapshots and checkpoints queued for the background
+        # writers are saved even if the simulation fails.
+        try:
+            with phase('initial_conditions'):
+                self._initial_conditions()
+
+                if self.config.output:
+                    self._update_output(from_host=True)
+                    self._save_output()
+
+            if not self.config.max_iters:
+                self.config.logger.warning("Running infinite simulation.")
+
+            if self.config.restore_from:
+                with phase('restore'):
+                    self.restore_checkpoint(self.config.restore_from)
+                    if self._probes is not None:
+                        self._probes.restore(self._sim.iteration)
+
+            if self._initialization:
+                with phase('initialization'):
+                    self.initialize()
+
+            self.config.logger.info("Starting simulation.")
+            self.main()
+            if self._probes is not None:
+                self._probes.flush()
+        finally:
+            try:
+                self._output.close()
+            finally:
+                self._checkpoint_writer.close()
 
         self.config.logger.info(
             "Simulation completed after {0} iterations.".format(
                 self._sim.iteration))
 
+    def _instrument_host_phases(self):
+        """Measures the host phases of the main loop which are not covered
+        by the core timers (see profile.HOST_PHASES)."""
+        instrument = self._profile.instrument
+        instrument(self, '_step_requests', 'host_requests')
+        instrument(self._sim, 'after_step', 'host_after_step')
+        instrument(self, 'step', 'host_step')
+        instrument(self, '_step_boundary', 'host_boundary')
+        instrument(self, '_step_bulk', 'host_bulk')
+        instrument(self, '_fields_to_host', 'host_fields_to_host')
+        instrument(self, '_update_output', 'host_update_output')
+        instrument(self, '_save_output', 'host_save_output')
+
     def need_quit(self):
         # The quit event is used by the visualization interface.
         if self._quit_event.is_set():
@@ -1314,6 +1699,22 @@ class SubdomainRunner(object):
         self._prepare_compute_kernels()
         self._init_compute()
 
+    def _step_requests(self):
+        """Determines what is required from the next step.
+
+        :rvalue: tuple of: output, full sync, sync, probe sampling and
+            reduction requests
+        """
+        output_req = self._sim.need_output()
+        # Check this before need_sync(), which resets the flag.
+        full_sync_req = self._sim.need_sync_flag or not output_req
+        sync_req = self._sim.need_sync()
+        probe_req = (self._probes is not None and
+                     self._probes.need_sample(self._sim.iteration + 1))
+        reduction_req = (self._reductions is not None and
+                         self._sim.need_reductions())
+        return output_req, full_sync_req, sync_req, probe_req, reduction_req
+
     def main(self):
         is_quit = False
 
@@ -1322,17 +1723,28 @@ class SubdomainRunner(object):
             while True:
                 self._profile.start_step()
 
-                output_req = self._sim.need_output()
-                sync_req = self._sim.need_sync()
+                (output_req, full_sync_req, sync_req, probe_req,
+                 reduction_req) = self._step_requests()
 
                 if sync_req and self.config.debug_dump_dists:
                     dbuf = self._debug_get_dist(self)
                     self._output.dump_dists(dbuf, self._sim.iteration)
 
-                self.step(sync_req)
+                # Macroscopic fields are only computed on the device when
+                # they are requested.
+                macro_req = sync_req or probe_req or reduction_req
+                self.step(macro_req)
+                if self._sim.iteration >= self.config.benchmark_sample_from:
+                    self._sampled_steps += 1
+                    if macro_req:
+                        self._macro_steps += 1
+                if probe_req:
+                    self._probes.sample()
+                if reduction_req:
+                    self._send_reductions()
 
                 if sync_req:
-                    self._fields_to_host()
+                    self._fields_to_host(full_sync_req)
 
                 if (self.config.max_iters > 0 and self._sim.iteration >=
                         self.config.max_iters) or self.need_quit():
@@ -1341,16 +1753,20 @@ class SubdomainRunner(object):
                 self._data_stream.synchronize()
                 self._calc_stream.synchronize()
                 if output_req:
-                    if self.config.check_invalid_results_host:
-                        if not self._output.verify():
-                            self.config.logger.error("Invalid value detected in "
-                                    "output for iteration {0}".format(
-                                    self._sim.iteration))
-                            self._quit_event.set()
-                            break
-                    self._output.save(self._sim.iteration)
+                    if not self._check_output():
+                        self.config.logger.error("Invalid value detected in "
+                                "output for iteration {0}".format(
+                                self._sim.iteration))
+                        self._quit_event.set()
+                        break
+                    self._save_output()
                 self._profile.end_step()
 
+                if (self._metrics is not None and
+                        self._metrics.need_snapshot(self._sim.iteration)):
+                    self._master_sock.send_pyobj(
+                        ('metrics', self._metrics.snapshot()))
+
                 if self.config.checkpoint_file and self._sim.need_checkpoint():
                     self.save_checkpoint()
 
@@ -1361,7 +1777,8 @@ class SubdomainRunner(object):
             self._data_stream.synchronize()
             self._calc_stream.synchronize()
             if output_req:
-                self._output.save(self._sim.iteration)
+                self._update_output()
+                self._save_output()
 
             self._profile.record_end()
 
@@ -1412,6 +1829,23 @@ class NNSubdomainRunner(SubdomainRunner):
     An arrow above symbolizes a dependency between the two streams.
     """
 
+    def _kernel_traffic(self):
+        float_size = self.float().nbytes
+        num_grids = len(self._sim.grids)
+        dists = sum(grid.Q for grid in self._sim.grids)
+        map_size = np.uint32().nbytes
+        # The macro kernels read all distributions and write one field per
+        # grid.  The simulation step kernels additionally read the fields
+        # (values from neighboring nodes are assumed to be cached).
+        macro = dists * float_size + num_grids * float_size + map_size
+        sim = 2 * dists * float_size + num_grids * float_size + map_size
+
+        bulk, boundary = self._kernel_nodes()
+        return [(TimeProfile.MACRO_BULK, bulk, macro),
+                (TimeProfile.MACRO_BOUNDARY, boundary, macro),
+                (TimeProfile.BULK, bulk, sim),
+                (TimeProfile.BOUNDARY, boundary, sim)]
+
     @profile(TimeProfile.RECV_MACRO)
     def _recv_macro(self):
         for b_id, connector in self._spec._connectors.iteritems():
@@ -1454,26 +1888,19 @@ class NNSubdomainRunner(SubdomainRunner):
                 # TODO(michalj): Use non-blocking sends here?
                 connector.send(np.ravel(conn_bufs[0].coll_buf.host).copy())
 
-    def _macro_idx_helper(self, gx, buf_slice):
-        idx = np.mgrid[list(reversed(buf_slice))].astype(np.uint32)
-        if self.dim == 2:
-            return self._get_global_idx((gx, idx[0])).astype(np.uint32)
-        else:
-            return self._get_global_idx((gx, idx[1], idx[0])).astype(np.uint32)
-
     def _get_src_macro_indices(self, face, cpair):
         if face in (self._spec.X_LOW, self._spec.X_HIGH):
             gx = self.lat_linear_macro[face]
         else:
             return None
-        return self._macro_idx_helper(gx, cpair.src.src_macro_slice)
+        return self._idx_helper(gx, cpair.src.src_macro_slice)
 
     def _get_dst_macro_indices(self, face, cpair):
         if face in (self._spec.X_LOW, self._spec.X_HIGH):
             gx = self.lat_linear[face]
         else:
             return None
-        return self._macro_idx_helper(gx, cpair.src.dst_macro_slice)
+        return self._idx_helper(gx, cpair.src.dst_macro_slice)
 
     def _init_buffers(self):
         super(NNSubdomainRunner, self)._init_buffers()
@@ -715,7 +715,10 @@ def get_interblock_dists(grid, direction, opposite=False):
     """Computes a list of indices of distributions that would be transferred
     to a node pointed to by the vector 'direction'.
     """
-    d = Matrix((direction,))
+    # Use plain integer arithmetic here -- sympy dot products are slow, and
+    # this function is called for every subdomain connection.
+    d = [int(x) for x in direction]
+    d_len2 = sum(x * x for x in d)
 
     def process_dists(dists):
         if opposite:
@@ -725,7 +728,7 @@ def get_interblock_dists(grid, direction, opposite=False):
 
     ret = []
     for i, ei in enumerate(grid.basis):
-        if ei.dot(d) >= d.dot(d):
+        if sum(int(x) * y for x, y in zip(ei, d)) >= d_len2:
             ret.append(i)
     return process_dists(ret)
 
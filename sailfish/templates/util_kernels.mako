@@ -751,6 +751,31 @@ ${kernel} void DistributeSparseData(
 	dist[gi] = buffer[idx];
 }
 
+// Samples a field at a set of probe locations.  Every probe value is a
+// weighted sum of field values at num_points nodes (idx_array and weights
+// are laid out as [num_points][num_probes]).  Samples are saved in a ring
+// buffer of ring_len records, each record holding record_size values; the
+// current record is selected based on the iteration number.
+${kernel} void SampleProbes(
+		${global_ptr} int *idx_array, ${global_ptr} float *weights,
+		${global_ptr} float *field, ${global_ptr} float *buffer,
+		int num_probes, int num_points, int offset, int record_size,
+		int every, int ring_len, unsigned int iteration_number)
+{
+	int idx = get_global_id(0);
+	if (idx >= num_probes) {
+		return;
+	}
+
+	float tmp = 0.0f;
+	for (int i = 0; i < num_points; i++) {
+		int j = i * num_probes + idx;
+		tmp += weights[j] * field[idx_array[j]];
+	}
+	int slot = (iteration_number / every) % ring_len;
+	buffer[slot * record_size + offset + idx] = tmp;
+}
+
 %if dim == 2:
 ${kernel} void CollectContinuousMacroData(
 		${global_ptr} float *field, int base_gx, int max_lx, int gy,
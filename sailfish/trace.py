@@ -0,0 +1,159 @@
+"""Timeline tracing of simulation steps.
+
+When tracing is enabled (--trace_iters), every subdomain runner records the
+begin and end timestamps of CPU phases, GPU kernel groups and transfers to
+and from neighboring subdomains for a window of iterations.  Each runner
+saves its events to a separate file, and the pieces are merged into a single
+trace in the Chrome trace event format, which can be viewed in
+chrome://tracing or Perfetto (ui.perfetto.dev).
+
+In the merged trace, every subdomain is shown as a separate process, with
+one track for CPU events and one for every GPU stream.
+"""
+
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'LGPL3'
+
+import json
+import os
+import numpy as np
+
+from sailfish import io
+
+# Tracks (thread IDs in the Chrome trace format).
+CPU = 0
+GPU_CALC = 1
+GPU_DATA = 2
+
+_TRACK_NAMES = {CPU: 'CPU', GPU_CALC: 'GPU (calc stream)',
+                GPU_DATA: 'GPU (data stream)'}
+
+
+def piece_filename(fname, subdomain_id):
+    return io.source_filename(fname, subdomain_id)
+
+
+class Tracer(object):
+    """Records timeline events in a preallocated ring buffer.
+
+    Events are identified by integer IDs, which are mapped to names when the
+    trace is saved.  Once the buffer is full, the oldest events are
+    overwritten.
+    """
+
+    def __init__(self, subdomain_id, event_names, start, iters,
+                 capacity=65536):
+        """
+        :param subdomain_id: ID of the subdomain handled by the runner
+        :param event_names: dict mapping event IDs to names
+        :param start: first iteration to trace
+        :param iters: number of iterations to trace
+        :param capacity: max number of events kept in memory
+        """
+        self.subdomain_id = subdomain_id
+        self.event_names = event_names
+        self._first = start
+        self._last = start + iters
+        self._capacity = capacity
+        self._event = np.zeros(capacity, dtype=np.int32)
+        self._track = np.zeros(capacity, dtype=np.int8)
+        self._peer = np.zeros(capacity, dtype=np.int32)
+        self._iteration = np.zeros(capacity, dtype=np.int64)
+        self._start = np.zeros(capacity, dtype=np.float64)
+        self._end = np.zeros(capacity, dtype=np.float64)
+        self._count = 0
+        self._current = 0
+        self.active = False
+
+    def set_iteration(self, iteration):
+        """Sets the iteration to which subsequent events belong, and enables
+        or disables recording accordingly."""
+        self._current = iteration
+        self.active = self._first <= iteration < self._last
+
+    def record(self, event, track, start, end, peer=-1):
+        """Records a single event.
+
+        :param event: event ID
+        :param track: one of CPU, GPU_CALC, GPU_DATA
+        :param start: start timestamp, in seconds since the epoch
+        :param end: end timestamp
+        :param peer: ID of the neighboring subdomain involved in the event,
+            or -1
+        """
+        i = self._count % self._capacity
+        self._event[i] = event
+        self._track[i] = track
+        self._peer[i] = peer
+        self._iteration[i] = self._current
+        self._start[i] = start
+        self._end[i] = end
+        self._count += 1
+
+    def __len__(self):
+        return min(self._count, self._capacity)
+
+    @property
+    def dropped(self):
+        """Number of events overwritten due to lack of space."""
+        return max(0, self._count - self._capacity)
+
+    def events(self):
+        """Returns a list of events in the Chrome trace event format."""
+        pid = self.subdomain_id
+        ret = [{'name': 'process_name', 'ph': 'M', 'pid': pid,
+                'args': {'name': 'Subdomain {0}'.format(pid)}},
+               {'name': 'process_sort_index', 'ph': 'M', 'pid': pid,
+                'args': {'sort_index': pid}}]
+        for track, name in _TRACK_NAMES.iteritems():
+            ret.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                        'tid': track, 'args': {'name': name}})
+
+        n = len(self)
+        order = np.argsort(self._start[:n], kind='mergesort')
+        for i in order:
+            args = {'iteration': int(self._iteration[i])}
+            if self._peer[i] >= 0:
+                args['peer'] = int(self._peer[i])
+            ret.append({
+                'name': self.event_names.get(int(self._event[i]),
+                                             str(self._event[i])),
+                'ph': 'X', 'pid': pid, 'tid': int(self._track[i]),
+                'ts': self._start[i] * 1e6,
+                'dur': max(self._end[i] - self._start[i], 0.0) * 1e6,
+                'args': args})
+        return ret
+
+    def save(self, fname):
+        """Saves the events to the piece file for the subdomain."""
+        with open(piece_filename(fname, self.subdomain_id), 'w') as f:
+            json.dump(self.events(), f)
+
+
+def merge(fname, subdomain_ids, remove=True):
+    """Merges trace pieces saved by subdomain runners into a single trace.
+
+    :param fname: name of the merged trace file
+    :param subdomain_ids: IDs of the subdomains whose pieces are to be merged;
+        missing pieces are skipped
+    :param remove: if True, the pieces are deleted after merging
+    :rvalue: list of IDs of the subdomains whose pieces were merged
+    """
+    events = []
+    merged = []
+    for sid in subdomain_ids:
+        piece = piece_filename(fname, sid)
+        if not os.path.exists(piece):
+            continue
+        with open(piece, 'r') as f:
+            events.extend(json.load(f))
+        merged.append(sid)
+
+    with open(fname, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    if remove:
+        for sid in merged:
+            os.remove(piece_filename(fname, sid))
+    return merged
@@ -133,6 +133,87 @@ def in_anyd_fast(arr1, values):
     return ret
 
 
+def wrapped_slab(arr, slab, halo=1):
+    """Returns a copy of a slab of an array, extended by a halo on both sides.
+
+    Indices in the halo wrap around the boundaries of the array, i.e. the
+    result is the same as if the slab was extracted from a periodic array.
+
+    :param arr: array from which to extract the slab
+    :param slab: slice object selecting the slab along the first axis of arr
+    :param halo: number of halo elements to add on each side of the slab
+    """
+    idx = np.arange(slab.start - halo, slab.stop + halo)
+    return np.take(arr, idx, axis=0, mode='wrap')
+
+
+def periodic_halo(arr, axes, halo=1):
+    """Returns a copy of an array extended by a periodic halo.
+
+    :param arr: array to extend
+    :param axes: iterable of axis numbers along which to add the halo
+    :param halo: number of halo elements to add on each side
+    """
+    for axis in axes:
+        idx = np.arange(-halo, arr.shape[axis] + halo)
+        arr = np.take(arr, idx, axis=axis, mode='wrap')
+    return arr
+
+
+def neighbor_views(arr, grid):
+    """Yields views of an array shifted by the basis vectors of a grid.
+
+    The array has to include a halo of 1 node on each side along every axis.
+    For every basis vector e_i, a pair (i, view) is generated, where view has
+    the shape of the array without the halo, and the element at location r
+    in the view is the element at location r + e_i in the array.  Views
+    are used instead of np.roll so that no copies of the array are made.
+
+    :param arr: 2D or 3D array (slowest-varying axis first)
+    :param grid: grid object defining the connectivity of the lattice
+    """
+    inner = [n - 2 for n in arr.shape]
+    for i, vec in enumerate(grid.basis):
+        # Basis vectors are in natural order (x, y, z), while the array
+        # is indexed in reverse order.
+        yield i, arr[[slice(1 + int(c), 1 + int(c) + n) for c, n in
+                      zip(reversed(list(vec)), inner)]]
+
+
+def neighbor_count(mask, grid):
+    """Counts neighbors selected by a mask.
+
+    :param mask: uint8 array with values 0 and 1, with a halo of 1 node on
+        each side along every axis (see neighbor_views())
+    :param grid: grid object defining the connectivity of the lattice
+    :rvalue: uint8 array with the number of neighbors (along all basis
+        vectors of the grid, including the zero vector) for which mask is set
+    """
+    assert grid.Q < 256
+    ret = np.zeros([n - 2 for n in mask.shape], dtype=np.uint8)
+    for i, view in neighbor_views(mask, grid):
+        ret += view
+    return ret
+
+
+def neighbor_bitmask(mask, grid):
+    """Returns a bitmask of neighbors selected by a mask.
+
+    :param mask: uint8/bool array with a halo of 1 node on each side along
+        every axis (see neighbor_views())
+    :param grid: grid object defining the connectivity of the lattice
+    :rvalue: uint32 array, in which bit i is set if mask is set for the
+        neighbor along the i-th basis vector of the grid
+    """
+    assert grid.Q <= 32
+    ret = np.zeros([n - 2 for n in mask.shape], dtype=np.uint32)
+    for i, view in neighbor_views(mask, grid):
+        bit = view.astype(np.uint32)
+        bit <<= i
+        ret |= bit
+    return ret
+
+
 def is_number(param):
     return type(param) is float or type(param) is int or isinstance(param, np.number)
 
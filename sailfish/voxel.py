@@ -0,0 +1,181 @@
+"""Memory-mapped voxel geometry input.
+
+Voxel files are opened with np.memmap, so that every subdomain runner only
+reads the part of the geometry that it actually needs.  The underlying pages
+are shared between all processes running on a machine via the OS page cache.
+
+Supported formats:
+ - .npy files, as generated by utils/voxelizer,
+ - raw files, with the shape and data type specified explicitly,
+ - packed voxel files (see save_packed()), storing boolean masks with
+   8 nodes per byte.
+"""
+
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'LGPL3'
+
+import struct
+import numpy as np
+
+# Packed voxel file header: magic string, number of dimensions, shape
+# (up to 3 dimensions).  The header is padded to PACKED_HEADER_SIZE bytes.
+PACKED_MAGIC = 'SFVOXP01'
+PACKED_HEADER_SIZE = 64
+_PACKED_HEADER_FMT = '<8sI3Q'
+
+
+def save_packed(fname, mask):
+    """Saves a boolean mask as a packed voxel file.
+
+    Every row of the mask (along the fastest-varying axis) is padded to a
+    full number of bytes.
+
+    :param fname: output file name
+    :param mask: boolean numpy array (2D or 3D), slowest-varying axis first
+    """
+    shape = list(mask.shape) + [0] * (3 - mask.ndim)
+    header = struct.pack(_PACKED_HEADER_FMT, PACKED_MAGIC, mask.ndim, *shape)
+    with open(fname, 'wb') as f:
+        f.write(header.ljust(PACKED_HEADER_SIZE, '\0'))
+        # Process the mask one slice at a time so that memory-mapped input
+        # arrays do not have to be loaded into memory as a whole.
+        for i in xrange(mask.shape[0]):
+            np.packbits(np.asarray(mask[i]).astype(np.uint8), axis=-1).tofile(f)
+
+
+def _read_packed_header(fname):
+    """Returns the shape of the array in a packed voxel file, or None if
+    the file is not a packed voxel file."""
+    with open(fname, 'rb') as f:
+        header = f.read(struct.calcsize(_PACKED_HEADER_FMT))
+    if len(header) < struct.calcsize(_PACKED_HEADER_FMT):
+        return None
+    magic, ndim, sz, sy, sx = struct.unpack(_PACKED_HEADER_FMT, header)
+    if magic != PACKED_MAGIC:
+        return None
+    return tuple(int(x) for x in (sz, sy, sx)[:ndim])
+
+
+class VoxelGeometry(object):
+    """Read-only access to a voxel geometry file.
+
+    The file is memory-mapped, and only the requested regions are read from
+    disk, so host memory usage scales with the size of the region and not
+    with the size of the whole geometry.  Instances can be pickled (e.g. as
+    part of the simulation config) -- the file is reopened on first access.
+
+    All shapes and locations use the numpy convention, i.e. the slowest-varying
+    (Z in 3D, Y in 2D) axis comes first.
+    """
+
+    def __init__(self, fname, shape=None, dtype=np.bool_, offset=0):
+        """
+        :param fname: path to the voxel file
+        :param shape: shape of the voxel array; only used for raw files
+        :param dtype: data type of the voxels; only used for raw files
+        :param offset: size of the header, in bytes; only used for raw files
+        """
+        self.fname = fname
+        self.packed = False
+        self._offset = offset
+        self._dtype = np.dtype(dtype)
+        self._data = None
+
+        packed_shape = _read_packed_header(fname)
+        if fname.endswith('.npy'):
+            self._npy = True
+            self.shape = self._get_data().shape
+        elif packed_shape is not None:
+            self._npy = False
+            self.packed = True
+            self.shape = packed_shape
+            self._offset = PACKED_HEADER_SIZE
+            self._dtype = np.dtype(np.uint8)
+        else:
+            if shape is None:
+                raise ValueError('Shape has to be specified for raw voxel '
+                                 'files.')
+            self._npy = False
+            self.shape = tuple(shape)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_data'] = None
+        return state
+
+    @property
+    def dim(self):
+        return len(self.shape)
+
+    def _get_data(self):
+        if self._data is None:
+            if self._npy:
+                self._data = np.load(self.fname, mmap_mode='r')
+            elif self.packed:
+                shape = list(self.shape)
+                shape[-1] = (shape[-1] + 7) / 8
+                self._data = np.memmap(self.fname, dtype=self._dtype, mode='r',
+                                       offset=self._offset, shape=tuple(shape))
+            else:
+                self._data = np.memmap(self.fname, dtype=self._dtype, mode='r',
+                                       offset=self._offset, shape=self.shape)
+        return self._data
+
+    def get_region(self, start, stop):
+        """Returns a dense array with voxels from a box-shaped region.
+
+        The box can extend beyond the geometry (e.g. when it includes ghost
+        nodes of a subdomain at the domain boundary), in which case the
+        voxels outside of the geometry are set to 0 (False).
+
+        :param start: location of the first node of the region (inclusive)
+        :param stop: location of the last node of the region (exclusive)
+        """
+        assert len(start) == len(stop) == self.dim
+        dtype = np.bool_ if self.packed else self._dtype
+        ret = np.zeros([b - a for a, b in zip(start, stop)], dtype=dtype)
+
+        src = [slice(max(a, 0), min(b, n)) for a, b, n in
+               zip(start, stop, self.shape)]
+        if any(s.start >= s.stop for s in src):
+            return ret
+        dst = [slice(s.start - a, s.stop - a) for s, a in zip(src, start)]
+
+        data = self._get_data()
+        if self.packed:
+            x = src[-1]
+            byte_sl = slice(x.start / 8, (x.stop + 7) / 8)
+            bits = np.unpackbits(np.asarray(data[src[:-1] + [byte_sl]]),
+                                 axis=-1)
+            shift = byte_sl.start * 8
+            ret[dst] = bits[..., x.start - shift:x.stop - shift]
+        else:
+            ret[dst] = data[src]
+        return ret
+
+    def get_subdomain_region(self, spec, envelope=True):
+        """Returns voxels covering a subdomain.
+
+        :param spec: SubdomainSpec object
+        :param envelope: if True, the returned region includes ghost nodes
+        """
+        es = spec.envelope_size if envelope else 0
+        start = [x - es for x in reversed(spec.location)]
+        stop = [x + n + es for x, n in zip(reversed(spec.location),
+                                           reversed(spec.size))]
+        return self.get_region(start, stop)
+
+    def get_mask(self, *coords):
+        """Returns voxels at the nodes identified by coordinate arrays.
+
+        The coordinate arrays are the ones passed to boundary_conditions() or
+        initial_conditions(), i.e. with the X coordinate first.  The
+        returned array has the same shape as the coordinate arrays, and can
+        be used directly as an argument for set_node().
+
+        :param coords: hx, hy[, hz] coordinate arrays
+        """
+        start = [int(np.min(c)) for c in reversed(coords)]
+        stop = [int(np.max(c)) + 1 for c in reversed(coords)]
+        return self.get_region(start, stop)
@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from sailfish import autotune
+from sailfish.config import LBConfig, LBConfigParser
+
+
+class TestTuningDB(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'sub', 'autotune.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_candidates(self):
+        self.assertEqual(autotune.candidates([64, 32], [64, 32]),
+                         [(32, 32), (64, 32), (64, 64)])
+
+    def test_best_entries(self):
+        entries = autotune.best_entries([
+            ('a', 64, 32, 100.0), ('a', 128, 32, 110.0),
+            ('a', 128, 32, 130.0), ('b', 64, 32, 50.0)])
+        self.assertEqual(entries['a']['block_size'], 128)
+        self.assertEqual(entries['a']['mem_alignment'], 32)
+        self.assertAlmostEqual(entries['a']['mlups'], 120.0)
+        self.assertEqual(sorted(entries['a']['candidates']),
+                         ['128/32', '64/32'])
+        self.assertEqual(entries['b']['block_size'], 64)
+
+    def test_update(self):
+        db = autotune.TuningDB(self.path)
+        self.assertEqual(db.load(), {})
+        self.assertEqual(db.get('a'), None)
+
+        db.update({'a': {'block_size': 128, 'mem_alignment': 64}})
+        db.update({'b': {'block_size': 32, 'mem_alignment': 32}})
+        self.assertEqual(db.get('a')['block_size'], 128)
+        self.assertEqual(db.get('b')['block_size'], 32)
+
+    def test_apply_tuned(self):
+        autotune.TuningDB(self.path).update(
+            {'a': {'block_size': 128, 'mem_alignment': 64, 'mlups': 1.0}})
+        config = LBConfig()
+        config.autotune_db = self.path
+        config.block_size = 64
+        config.mem_alignment = 32
+
+        self.assertEqual(autotune.apply_tuned(config, 'b'), None)
+        self.assertEqual(config.block_size, 64)
+
+        config._explicit = set(['mem_alignment'])
+        self.assertEqual(autotune.apply_tuned(config, 'a'), None)
+        self.assertEqual(config.block_size, 64)
+
+        config._explicit = set()
+        self.assertEqual(autotune.apply_tuned(config, 'a')['block_size'], 128)
+        self.assertEqual(config.block_size, 128)
+        self.assertEqual(config.mem_alignment, 64)
+
+
+class TestExplicitOptions(unittest.TestCase):
+    def setUp(self):
+        self.parser = LBConfigParser()
+        group = self.parser.add_group('test')
+        group.add_argument('--block_size', type=int, default=64)
+        group.add_argument('--mem_alignment', type=int, default=32)
+
+    def test_default(self):
+        config = self.parser.parse([])
+        self.assertFalse(config.is_explicit('block_size'))
+        self.assertFalse(config.is_explicit('mem_alignment'))
+
+    def test_cmdline(self):
+        # Setting an option to its default value still counts.
+        config = self.parser.parse(['--block_size=64'])
+        self.assertTrue(config.is_explicit('block_size'))
+        self.assertFalse(config.is_explicit('mem_alignment'))
+        self.assertEqual(config.block_size, 64)
+
+    def test_set_defaults(self):
+        self.parser.set_defaults({'mem_alignment': 64})
+        config = self.parser.parse([])
+        self.assertFalse(config.is_explicit('block_size'))
+        self.assertTrue(config.is_explicit('mem_alignment'))
+        self.assertEqual(config.mem_alignment, 64)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+
+from benchmark import harness
+from benchmark.scaling import local
+from sailfish.util import TimingInfo
+
+
+class TestStatistics(unittest.TestCase):
+    def test_t_critical(self):
+        self.assertEqual(harness.t_critical(4), 2.776)
+        # Untabulated values fall back to the closest smaller entry.
+        self.assertEqual(harness.t_critical(11), 2.228)
+        self.assertEqual(harness.t_critical(1000), 1.960)
+        self.assertEqual(harness.t_critical(0), float('inf'))
+
+    def test_summarize(self):
+        s = harness.summarize([10, 11, 12, 9, 8])
+        self.assertAlmostEqual(s['mean'], 10.0)
+        self.assertAlmostEqual(s['stdev'], 2.5 ** 0.5)
+        half = 2.776 * s['stdev'] / 5 ** 0.5
+        self.assertAlmostEqual(s['ci'][0], 10.0 - half)
+        self.assertAlmostEqual(s['ci'][1], 10.0 + half)
+
+        s = harness.summarize([3.0])
+        self.assertEqual(s['stdev'], 0.0)
+        self.assertEqual(s['ci'], [3.0, 3.0])
+
+    def test_compare(self):
+        baseline = harness.summarize([100.0, 101.0, 99.0, 100.5, 99.5])
+
+        # Noise within the threshold is not a regression.
+        cmp = harness.compare(harness.summarize([99.0, 98.0, 100.0, 99.5,
+                                                 98.5]), baseline, 0.05)
+        self.assertFalse(cmp['regression'])
+        self.assertTrue(cmp['ci'][0] < cmp['change'] < cmp['ci'][1])
+
+        # A consistent 10% drop is.
+        cmp = harness.compare(harness.summarize([90.0, 91.0, 89.0, 90.5,
+                                                 89.5]), baseline, 0.05)
+        self.assertTrue(cmp['regression'])
+        self.assertAlmostEqual(cmp['change'], -0.1)
+
+        # A large drop is not reported if the measurements are too noisy
+        # to be sure about it.
+        cmp = harness.compare(harness.summarize([60.0, 120.0, 80.0]),
+                              baseline, 0.05)
+        self.assertTrue(cmp['change'] < -0.05)
+        self.assertFalse(cmp['regression'])
+
+        # Improvements are never regressions.
+        cmp = harness.compare(harness.summarize([110.0, 111.0, 109.0]),
+                              baseline, 0.05)
+        self.assertFalse(cmp['regression'])
+        self.assertTrue(cmp['ci'][0] > 0.0)
+
+
+class TestScaling(unittest.TestCase):
+    def test_lattice_size(self):
+        self.assertEqual(local.lattice_size((64, 32), 'y', 4, 'weak'),
+                         {'lat_nx': 64, 'lat_ny': 128})
+        self.assertEqual(local.lattice_size((64, 32, 16), 'z', 4, 'strong'),
+                         {'lat_nx': 64, 'lat_ny': 32, 'lat_nz': 16})
+
+    def test_efficiency(self):
+        runs = [{'subdomains': n, 'throughput': harness.summarize([t])} for
+                n, t in ((2, 20.0), (4, 30.0), (8, 40.0))]
+        local.efficiency(runs)
+        self.assertEqual([r['efficiency'] for r in runs], [1.0, 0.75, 0.5])
+
+    def test_comm_fractions(self):
+        ti = TimingInfo(comp=0.5, bulk=0.3, bnd=0.2, coll=0.0, net_wait=0.1,
+                        recv=0.15, send=0.05, total=1.0, total_sq=1.0,
+                        subdomain_id=0)
+        self.assertAlmostEqual(local.comm_fractions([ti])[0], 0.2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+import cPickle as pickle
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from sailfish import checkpoint, io
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        np.random.seed(1234)
+        self.state = {'iteration': 100}
+        self.dists = [np.random.random((19, 8, 6, 5)).astype(np.float32),
+                      np.random.random((19, 8, 6, 5)).astype(np.float32)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _fname(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def test_full(self):
+        for spec in ('none', 'zlib'):
+            fname = self._fname('full_{0}.npz'.format(spec))
+            checkpoint.write(fname, pickle.dumps(self.state, -1), self.dists,
+                             spec)
+            state, dists, secondary = checkpoint.read(fname)
+            self.assertEqual(state, self.state)
+            self.assertTrue(secondary is None)
+            self.assertEqual(len(dists), 2)
+            for a, b in zip(dists, self.dists):
+                np.testing.assert_equal(a, b)
+                self.assertEqual(a.dtype, b.dtype)
+
+        # No temporary files are left behind.
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['full_none.npz', 'full_zlib.npz'])
+
+    def test_incremental(self):
+        ref_fname = self._fname('full.npz')
+        checkpoint.write(ref_fname, pickle.dumps(self.state, -1), self.dists)
+
+        dists = [d.copy() for d in self.dists]
+        dists[0][:, 3] += 1.0
+        dists[1][:, 5] += 0.01
+        dists[1][:, 6] += 1e-5
+
+        self.assertEqual(checkpoint.changed_planes(dists[1], self.dists[1]),
+                         [5, 6])
+        self.assertEqual(checkpoint.changed_planes(dists[1], self.dists[1],
+                                                   1e-4), [5])
+
+        fname = self._fname('inc.npz')
+        checkpoint.write(fname, pickle.dumps({'iteration': 200}, -1), dists,
+                         reference=(ref_fname, self.dists), tolerance=1e-4)
+        self.assertTrue(os.path.getsize(fname) < os.path.getsize(ref_fname))
+
+        state, restored, _ = checkpoint.read(fname)
+        self.assertEqual(state['iteration'], 200)
+        np.testing.assert_equal(restored[0], dists[0])
+        # Changes below the tolerance are not saved.
+        np.testing.assert_equal(restored[1][:, 6], self.dists[1][:, 6])
+        np.testing.assert_equal(restored[1][:, :6], dists[1][:, :6])
+
+    def test_stale_incremental(self):
+        ref_fname = self._fname('full.npz')
+        checkpoint.write(ref_fname, pickle.dumps(self.state, -1), self.dists)
+        fname = self._fname('full.inc.npz')
+        checkpoint.write(fname, pickle.dumps(self.state, -1), self.dists,
+                         reference=(ref_fname, self.dists))
+
+        # Overwrite the reference with a newer full checkpoint.
+        dists = [d + 1.0 for d in self.dists]
+        checkpoint.write(ref_fname, pickle.dumps(self.state, -1), dists)
+        self.assertRaises(ValueError, checkpoint.read, fname)
+
+        checkpoint.remove(fname)
+        self.assertFalse(os.path.exists(fname))
+        checkpoint.remove(fname)
+
+    def test_legacy(self):
+        fname = self._fname('legacy.npz')
+        np.savez(fname, state=pickle.dumps(self.state, -1),
+                 dist0a=self.dists[0], dist0b=self.dists[1])
+        state, dists, secondary = checkpoint.read(fname)
+        self.assertEqual(state, self.state)
+        np.testing.assert_equal(dists[0], self.dists[0])
+        np.testing.assert_equal(secondary[0], self.dists[1])
+
+
+class TestDecomposition(unittest.TestCase):
+    # Global domain (z, y, x) and subdomains (location, size) in natural
+    # order.
+    shape = (6, 5, 8)
+    subdomains = [((0, 0, 0), (3, 5, 6)), ((3, 0, 0), (5, 5, 6))]
+    envelope_size = 1
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        np.random.seed(1234)
+        self.global_dist = np.random.random((19,) + self.shape).astype(np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _save(self, codec_spec):
+        es = self.envelope_size
+        state = pickle.dumps({'iteration': 10}, -1)
+        for sid, (loc, size) in enumerate(self.subdomains):
+            # Include ghost nodes and some padding along the X axis.
+            dist = np.zeros((19, size[2] + 2 * es, size[1] + 2 * es,
+                             size[0] + 2 * es + 3), dtype=np.float32)
+            dist[:, es:-es, es:-es, es:es + size[0]] = self.global_dist[:,
+                    loc[2]:loc[2] + size[2], loc[1]:loc[1] + size[1],
+                    loc[0]:loc[0] + size[0]]
+            fname = io.checkpoint_filename(os.path.join(self.tmpdir, 'cp'),
+                                           2, sid, 10) + '.npz'
+            checkpoint.write(fname, state, [dist], codec_spec,
+                             placement={'location': list(loc),
+                                        'size': list(size),
+                                        'envelope_size': es})
+        return fname
+
+    def _check(self, codec_spec):
+        fnames = checkpoint.piece_files(self._save(codec_spec))
+        self.assertEqual(len(fnames), 2)
+
+        # A subdomain spanning both checkpointed subdomains, with a larger
+        # envelope.
+        start, stop = (1, 0, 2), (5, 5, 8)
+        out = np.zeros((19, 8, 9, 10), dtype=np.float32)
+        filled = checkpoint.load_region(fnames, start, stop, [out], (2, 2, 2))
+        self.assertEqual(filled, 4 * 5 * 6)
+        np.testing.assert_equal(out[:, 2:6, 2:7, 2:8],
+                                self.global_dist[:, 1:5, 0:5, 2:8])
+        self.assertFalse(np.any(out[:, :2]))
+
+    def test_memmap(self):
+        self._check('none')
+
+    def test_compressed(self):
+        self._check('zlib')
+
+    def test_legacy(self):
+        fname = os.path.join(self.tmpdir, 'legacy.npz')
+        np.savez(fname, state=pickle.dumps({'iteration': 1}, -1),
+                 dist0a=np.zeros(3), dist0b=np.zeros(3))
+        self.assertRaises(ValueError, checkpoint.load_region, [fname],
+                          (0, 0, 0), (1, 1, 1), [np.zeros((19, 1, 1, 1))],
+                          (0, 0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,6 +18,12 @@ class TestCase2D(unittest.TestCase):
         config.lat_nx, config.lat_ny = self.lattice_size
         config.logger = DummyLogger()
         config.grid = 'D2Q9'
+        config.geometry_slab_size = 0
+        config.trace_iters = 0
+        config.profile_report = ''
+        config.bandwidth_file = ''
+        config.metrics_every = 0
+        config.host_overhead = False
         self.sim = LBSim(config)
         self.config = config
         self.backend = DummyBackend()
@@ -36,5 +42,11 @@ class TestCase3D(unittest.TestCase):
         config.lat_nx, config.lat_ny, config.lat_nz = self.lattice_size
         config.logger = DummyLogger()
         config.grid = 'D3Q19'
+        config.geometry_slab_size = 0
+        config.trace_iters = 0
+        config.profile_report = ''
+        config.bandwidth_file = ''
+        config.metrics_every = 0
+        config.host_overhead = False
         self.sim = LBSim(config)
         self.backend = DummyBackend()
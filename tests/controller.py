@@ -1,8 +1,9 @@
 import unittest
 
 from sailfish.config import MachineSpec
-from sailfish import controller
-from sailfish.subdomain import SubdomainSpec2D
+from sailfish import controller, diagnostics
+from sailfish.lb_single import LBFluidSim
+from sailfish.subdomain import Subdomain2D, SubdomainSpec2D
 
 class TestSubdomainDistribution(unittest.TestCase):
     def test_1_1_mapping(self):
@@ -73,5 +74,50 @@ class TestSubdomainDistribution(unittest.TestCase):
         self.assertEqual(assignments, [[subds[0], subds[1], subds[2]], [subds[3]]])
 
 
+class DummySim(LBFluidSim):
+    subdomain = Subdomain2D
+
+
+class DummyChannel(object):
+    def __init__(self, messages):
+        self.messages = list(messages)
+
+    def receive(self, timeout=None):
+        return self.messages.pop(0)
+
+
+class DummyLogger(object):
+    def __init__(self):
+        self.messages = []
+
+    def info(self, msg):
+        self.messages.append(msg)
+
+
+class TestMasterMessages(unittest.TestCase):
+    def test_wait_for_masters(self):
+        ctrl = controller.LBSimulationController(DummySim)
+        # Partial reduction results and summaries from two machines,
+        # interleaved.
+        ctrl._cluster_channels = [
+            DummyChannel([('reductions', 10, [(1.0, 2.0)]),
+                          ('reductions', 20, [(2.0, 2.0)]),
+                          ('summary', (0,), (0,), (0,), {}), 'FIN']),
+            DummyChannel([('reductions', 10, [(3.0, 6.0)]),
+                          ('summary', (1,), (1,), (1,), {}),
+                          ('reductions', 20, [(4.0, 6.0)]), 'FIN'])]
+        logger = DummyLogger()
+        collector = diagnostics.ReductionCollector(
+            [diagnostics.Mean('m', 'rho')], 2, logger)
+        summaries = []
+        ctrl._wait_for_masters(summaries, collector)
+
+        self.assertEqual(sorted(summaries), [((0,), (0,), (0,), {}),
+                                             ((1,), (1,), (1,), {})])
+        # Reductions are normalized once for the whole domain.
+        self.assertEqual(logger.messages, ['Iteration 10: m=5.000000e-01',
+                                           'Iteration 20: m=7.500000e-01'])
+
+
 if __name__ == '__main__':
     unittest.main()
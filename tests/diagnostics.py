@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from sailfish import diagnostics
+
+
+class DummyLogger(object):
+    def __init__(self):
+        self.messages = []
+
+    def info(self, msg):
+        self.messages.append(msg)
+
+
+class TestTranslate(unittest.TestCase):
+    def test_translate(self):
+        fields = ['rho', 'vx', 'vy']
+        expr, used = diagnostics.translate(
+            'sqrt(vx * vx + vy * vy) / rho + 0.5f * vx', fields)
+        self.assertEqual(expr, 'sqrt(x1[i] * x1[i] + x2[i] * x2[i]) / x3[i] '
+                         '+ 0.5f * x1[i]')
+        self.assertEqual(used, ['vx', 'vy', 'rho'])
+
+    def test_kinetic_energy(self):
+        r = diagnostics.kinetic_energy(2)
+        expr, used = diagnostics.translate(r.expr, ['rho', 'vx', 'vy'])
+        self.assertEqual(used, ['vx', 'vy'])
+        self.assertEqual(r.finalize(10.0, 4.0), 2.5)
+
+
+class TestCollector(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_merge(self):
+        reductions = [diagnostics.Sum('s', 'rho'),
+                      diagnostics.Mean('m', 'rho'),
+                      diagnostics.Max('max', 'rho'),
+                      diagnostics.Min('min', 'rho'),
+                      diagnostics.Norm('l2', 'rho')]
+        logger = DummyLogger()
+        fname = os.path.join(self.tmpdir, 'reductions.txt')
+        collector = diagnostics.ReductionCollector(reductions, 2, logger, fname)
+
+        self.assertTrue(collector.add(10, [(1.0, 2.0), (1.0, 2.0), (3.0, 2.0),
+                                           (-1.0, 2.0), (9.0, 2.0)]) is None)
+        self.assertTrue(collector.add(20, [(0.0, 2.0)] * 5) is None)
+        values = collector.add(10, [(3.0, 6.0), (3.0, 6.0), (2.0, 6.0),
+                                    (0.5, 6.0), (16.0, 6.0)])
+        self.assertEqual(values, [4.0, 0.5, 3.0, -1.0, 5.0])
+        self.assertEqual(len(logger.messages), 1)
+        self.assertTrue(logger.messages[0].startswith('Iteration 10: s='))
+
+        with open(fname) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], '# iteration\ts\tm\tmax\tmin\tl2')
+        self.assertEqual(lines[1].split('\t'),
+                         ['10', '4.0', '0.5', '3.0', '-1.0', '5.0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
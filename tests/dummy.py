@@ -2,6 +2,9 @@ class DummyLogger(object):
     def debug(*args):
         pass
 
+    def warning(*args):
+        pass
+
 class DummyEvent(object):
     def is_set(self):
         return False
@@ -5,6 +5,7 @@ from sailfish.subdomain import Subdomain2D, Subdomain3D, SubdomainSpec2D, Subdom
 from sailfish.subdomain_runner import SubdomainRunner
 from sailfish.sym import D2Q9, D3Q19
 from common import TestCase2D, TestCase3D
+from dummy import DummyLogger
 
 class TestSubdomain2D(Subdomain2D):
     def boundary_conditions(self, hx, hy):
@@ -49,8 +50,17 @@ class TestSubdomain3D(Subdomain3D):
                       (hx == self.gx - 1) | (hy == self.gy - 1),
                       NTEquilibriumDensity(1.0))
 
+class RecordingLogger(DummyLogger):
+    def __init__(self):
+        self.warnings = []
+
+    def warning(self, msg):
+        self.warnings.append(msg)
+
+
 class TestOrientationDetection3D(TestCase3D):
     def test_orientation(self):
+        self.sim.config.logger = logger = RecordingLogger()
         spec = SubdomainSpec3D((0, 0, 0), self.lattice_size, envelope_size=1, id_=0)
         spec.runner = SubdomainRunner(self.sim, spec, output=None,
                                       backend=self.backend, quit_event=None)
@@ -106,5 +116,11 @@ class TestOrientationDetection3D(TestCase3D):
         np.testing.assert_equal(sub._orientation[nz - 1, ny - 1, 0], 0)
         np.testing.assert_equal(sub._orientation[nz - 1, ny - 1, nx - 1], 0)
 
+        # Edge nodes have diagonal fluid neighbors and are reported.  Corner
+        # nodes have no fluid neighbors at all in D3Q19.
+        self.assertEqual(len(logger.warnings), 1)
+        self.assertTrue(logger.warnings[0].startswith('{0} edge/corner'.format(
+            4 * (nx - 2) + 4 * (ny - 2) + 4 * (nz - 2))))
+
 if __name__ == '__main__':
     unittest.main()
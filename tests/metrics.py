@@ -0,0 +1,118 @@
+import socket
+import time
+import unittest
+import urllib2
+import zmq
+
+from sailfish import io, metrics
+from sailfish.backend_dummy import DummyBackend
+from sailfish.config import LBConfig
+from sailfish.lb_base import LBSim
+from sailfish.profile import TimeProfile
+from sailfish.subdomain import SubdomainSpec2D
+from sailfish.subdomain_runner import SubdomainRunner
+
+from dummy import *
+
+
+def _snapshot(sid, mlups):
+    return {'subdomain_id': sid, 'host': 'node{0}'.format(sid), 'time': 0.0,
+            'iteration': 100, 'mlups': mlups, 'step_p50': 0.001,
+            'step_p90': 0.002, 'step_p99': 0.003, 'net_wait': 0.0005,
+            'output_queue': 1, 'device_memory': 1024}
+
+
+class TestRunnerMetrics(unittest.TestCase):
+    def test_snapshot(self):
+        config = LBConfig()
+        config.init_iters = 0
+        config.seed = 0
+        config.access_pattern = 'AB'
+        config.precision = 'single'
+        config.block_size = 8
+        config.mem_alignment = 8
+        config.lat_nx, config.lat_ny = 10, 3
+        config.logger = DummyLogger()
+        config.grid = 'D2Q9'
+        config.geometry_slab_size = 0
+        config.trace_iters = 0
+        config.profile_report = ''
+        config.benchmark_sample_from = 1000
+        config.output = ''
+        sim = LBSim(config)
+        runner = SubdomainRunner(sim, SubdomainSpec2D((0, 0), (10, 3), id_=0),
+                                 output=io.LBOutput(config, 0),
+                                 backend=DummyBackend(), quit_event=None)
+        rm = metrics.RunnerMetrics(runner, 10)
+        self.assertFalse(rm.need_snapshot(5))
+        self.assertTrue(rm.need_snapshot(10))
+
+        for i in range(10):
+            sim.iteration = i + 1
+            runner._profile.record_cpu_start(TimeProfile.NET_RECV)
+            runner._profile.record_cpu_end(TimeProfile.NET_RECV)
+            runner._profile.record_cpu_start(TimeProfile.STEP)
+            time.sleep(0.001)
+            runner._profile.record_cpu_end(TimeProfile.STEP)
+
+        s = rm.snapshot()
+        self.assertEqual(s['iteration'], 10)
+        self.assertEqual(s['subdomain_id'], 0)
+        self.assertEqual(s['output_queue'], 0)
+        self.assertTrue(s['mlups'] > 0.0)
+        self.assertTrue(0.001 <= s['step_p50'] <= s['step_p99'])
+        self.assertTrue(s['net_wait'] < s['step_p50'])
+        # Timers are still sampled normally.
+        self.assertEqual(runner._profile.timers[TimeProfile.STEP].count, 0)
+
+        s = rm.snapshot()
+        self.assertEqual(s['mlups'], 0.0)
+        self.assertEqual(s['step_p99'], 0.0)
+
+
+class TestPublishing(unittest.TestCase):
+    def test_prometheus_text(self):
+        text = metrics.prometheus_text([_snapshot(1, 2.5), _snapshot(0, 3.0)])
+        lines = text.splitlines()
+        self.assertTrue('# TYPE sailfish_mlups gauge' in lines)
+        i = lines.index('sailfish_mlups{subdomain="0",host="node0"} 3.0')
+        self.assertEqual(lines[i + 1],
+                         'sailfish_mlups{subdomain="1",host="node1"} 2.5')
+
+    def test_aggregator(self):
+        # Find a free TCP port for the HTTP endpoint.
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        http_port = s.getsockname()[1]
+        s.close()
+
+        ctx = zmq.Context()
+        agg = metrics.MetricsAggregator(ctx, http_port=http_port)
+        agg.start()
+        try:
+            sub = ctx.socket(zmq.SUB)
+            sub.setsockopt(zmq.SUBSCRIBE, '')
+            sub.connect('tcp://127.0.0.1:{0}'.format(agg.port))
+            pub = ctx.socket(zmq.PUB)
+            pub.connect('tcp://127.0.0.1:{0}'.format(agg.collect_port))
+
+            # PUB/SUB connections are established asynchronously, so keep
+            # publishing until the snapshot goes through.
+            for i in range(50):
+                pub.send_json(_snapshot(3, 1.0))
+                if sub.poll(100):
+                    break
+            self.assertEqual(sub.recv_json()['subdomain_id'], 3)
+            self.assertEqual([s['host'] for s in agg.latest()], ['node3'])
+            text = urllib2.urlopen('http://127.0.0.1:{0}/metrics'.format(
+                http_port)).read()
+            self.assertTrue('sailfish_mlups{subdomain="3",host="node3"} 1.0'
+                            in text)
+            pub.close()
+            sub.close()
+        finally:
+            agg.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,504 @@
+import cPickle as pickle
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import zlib
+import numpy as np
+
+from sailfish import codec, io
+from sailfish.subdomain import SubdomainSpec2D
+from utils.merge_subdomains import merge_subdomains, _read_header
+
+
+class DummyConfig(object):
+    max_iters = 100
+    output_codec = 'zlib'
+    output_field_codecs = []
+    output_abs_error = []
+    output_chunk_size = [64]
+
+
+class RecordingOutput(io.LBOutput):
+    def __init__(self, config, subdomain_id):
+        io.LBOutput.__init__(self, config, subdomain_id)
+        self.written = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def write(self, i, scalar_fields, vector_fields):
+        self.release.wait()
+        self.written.append((i, dict((k, v.copy()) for k, v in
+                                     scalar_fields.iteritems())))
+
+
+class TestAsyncOutput(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = DummyConfig()
+        self.config.output = os.path.join(self.tmpdir, 'out')
+        self.rho = np.zeros((4, 5), dtype=np.float32)
+        self.vx = np.zeros((4, 5), dtype=np.float32)
+        self.vy = np.zeros((4, 5), dtype=np.float32)
+        self.fluid_map = np.ones((4, 5), dtype=np.bool)
+        self.fluid_map[0, :] = False
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _register(self, output):
+        output.register_field(self.rho, 'rho')
+        output.register_field([self.vx, self.vy], 'v')
+        output.set_fluid_map(self.fluid_map)
+
+    def test_npy_output(self):
+        output = io.AsyncOutput(io.NPYOutput(self.config, 0), queue_size=1)
+        self._register(output)
+
+        for i in range(5):
+            self.rho[:] = i
+            self.vx[:] = 2 * i
+            self.vy[:] = 3 * i
+            output.save(i)
+        output.close()
+
+        # Live buffers are not modified by masking.
+        self.assertTrue(np.all(self.rho == 4))
+
+        for i in range(5):
+            fname = io.filename(self.config.output, 3, 0, i)
+            data = np.load(fname)
+            self.assertTrue(np.all(np.isnan(data['rho'][0, :])))
+            self.assertTrue(np.all(data['rho'][1:, :] == i))
+            self.assertTrue(np.all(data['v'][0][1:, :] == 2 * i))
+            self.assertTrue(np.all(data['v'][1][1:, :] == 3 * i))
+
+    def test_backpressure(self):
+        wrapped = RecordingOutput(self.config, 0)
+        wrapped.release.clear()
+        output = io.AsyncOutput(wrapped, queue_size=1)
+        self._register(output)
+
+        def _save_all():
+            for i in range(10):
+                self.rho[:] = i
+                output.save(i)
+
+        t = threading.Thread(target=_save_all)
+        t.daemon = True
+        t.start()
+        t.join(0.2)
+        # Writes are blocked, so the saving thread has to be blocked too,
+        # after filling all snapshot buffers.
+        self.assertTrue(t.is_alive())
+        self.assertEqual(wrapped.written, [])
+
+        wrapped.release.set()
+        t.join()
+        output.close()
+
+        self.assertEqual([x[0] for x in wrapped.written], range(10))
+        for i, fields in wrapped.written:
+            self.assertTrue(np.all(fields['rho'][1:, :] == i))
+
+    def test_submit(self):
+        output = io.AsyncOutput(io.LBOutput(self.config, 0))
+        fname = os.path.join(self.tmpdir, 'cpoint.npz')
+        output.submit(np.savez, fname, a=np.arange(3))
+        output.flush()
+        np.testing.assert_equal(np.load(fname)['a'], np.arange(3))
+
+        def _fail():
+            raise IOError('test')
+
+        output.submit(_fail)
+        self.assertRaises(IOError, output.close)
+
+
+class TestChunkedOutput(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = DummyConfig()
+        self.config.output = os.path.join(self.tmpdir, 'out')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_global_dataset(self):
+        # Global domain: 10x7 (x, y), split into 3 subdomains.
+        np.random.seed(1234)
+        rho = np.random.random((7, 10)).astype(np.float32)
+        vx = np.random.random((7, 10)).astype(np.float32)
+        vy = np.random.random((7, 10)).astype(np.float32)
+        fluid = np.ones((7, 10), dtype=np.bool)
+        fluid[3, 4] = False
+
+        # (location, size) in natural order
+        subdomains = [((0, 0), (4, 7)), ((4, 0), (6, 3)), ((4, 3), (6, 4))]
+        for sid, (loc, size) in enumerate(subdomains):
+            sl = [slice(loc[1], loc[1] + size[1]),
+                  slice(loc[0], loc[0] + size[0])]
+            output = io.ChunkedOutput(self.config, sid)
+            output.register_field(rho[sl].copy(), 'rho')
+            output.register_field([vx[sl].copy(), vy[sl].copy()], 'v')
+            output.set_fluid_map(fluid[sl])
+            output.set_location(loc)
+            output.save(10)
+
+        ds = io.ChunkedDataset(io.chunked_dirname(self.config.output, 3, 10))
+        self.assertEqual(ds.shape, (7, 10))
+        self.assertEqual(ds.fields, ['rho', 'v'])
+        self.assertEqual(sorted(ds.chunks.keys()), [(0, 0), (1, 0), (2, 0)])
+
+        expected = rho.copy()
+        expected[3, 4] = np.nan
+        np.testing.assert_equal(ds.get_field('rho'), expected)
+
+        v = ds.get_field('v')
+        self.assertEqual(v.shape, (2, 7, 10))
+        np.testing.assert_equal(v[0, :3, :], vx[:3, :])
+        np.testing.assert_equal(v[1, 4:, 5:], vy[4:, 5:])
+
+        # A region crossing chunk boundaries.
+        np.testing.assert_equal(ds.get_region('rho', (1, 2), (5, 7)),
+                                expected[1:5, 2:7])
+        np.testing.assert_equal(ds.read_chunk('rho', (1, 0)), rho[0:3, 4:10])
+
+    def test_chunk_size(self):
+        self.config.output_chunk_size = [3, 4]
+        np.random.seed(1234)
+        rho = np.random.random((7, 10)).astype(np.float32)
+        fluid = np.random.random((7, 10)) > 0.2
+
+        # (location, size) in natural order
+        subdomains = [((0, 0), (4, 7)), ((4, 0), (6, 7))]
+        for sid, (loc, size) in enumerate(subdomains):
+            sl = [slice(loc[1], loc[1] + size[1]),
+                  slice(loc[0], loc[0] + size[0])]
+            output = io.ChunkedOutput(self.config, sid)
+            output.register_field(rho[sl].copy(), 'rho')
+            output.set_fluid_map(fluid[sl])
+            output.set_location(loc)
+            output.save(0)
+
+        ds = io.ChunkedDataset(io.chunked_dirname(self.config.output, 3, 0))
+        # Chunk boundaries are at multiples of the chunk size: x = 3, 6, 9,
+        # y = 4.
+        self.assertEqual(sorted(c['location'] for c in ds.chunks.itervalues()),
+                         [[0, 0], [0, 3], [0, 4], [0, 6], [0, 9],
+                          [4, 0], [4, 3], [4, 4], [4, 6], [4, 9]])
+        self.assertEqual(ds.chunks[(1, 0)]['shape'], [4, 2])
+        np.testing.assert_equal(ds.read_chunk('rho', (1, 1)),
+                                np.where(fluid, rho, np.nan)[0:4, 6:9])
+
+        expected = np.where(fluid, rho, np.nan)
+        np.testing.assert_equal(ds.get_field('rho'), expected)
+
+        # Only chunks overlapping the region are read.
+        read = []
+        orig = ds.read_chunk
+        ds.read_chunk = lambda name, chunk_id: (read.append(chunk_id),
+                                                orig(name, chunk_id))[1]
+        np.testing.assert_equal(ds.get_region('rho', (5, 4), (7, 7)),
+                                expected[5:7, 4:7])
+        self.assertEqual(sorted(read), [(1, 3), (1, 4)])
+
+        self.config.output_chunk_size = [1, 2, 3]
+        output = io.ChunkedOutput(self.config, 0)
+        output.register_field(rho, 'rho')
+        output.set_location((0, 0))
+        self.assertRaises(ValueError, output.save, 0)
+
+    def test_codecs(self):
+        self.config.output_codec = 'none'
+        self.config.output_field_codecs = ['v=zlib:9']
+        self.config.output_abs_error = ['rho=0.001']
+
+        np.random.seed(1234)
+        rho = np.random.random((6, 5, 4))
+        vx = np.random.random((6, 5, 4)).astype(np.float32)
+        vy = np.random.random((6, 5, 4)).astype(np.float32)
+        vz = np.random.random((6, 5, 4)).astype(np.float32)
+        fluid = np.random.random((6, 5, 4)) > 0.3
+
+        output = io.ChunkedOutput(self.config, 0)
+        output.register_field(rho, 'rho')
+        output.register_field([vx, vy, vz], 'v')
+        output.set_fluid_map(fluid)
+        output.set_location((0, 0, 0))
+        output.save(0)
+
+        ds = io.ChunkedDataset(io.chunked_dirname(self.config.output, 3, 0))
+        self.assertEqual(ds.chunks[(0, 0)]['fields']['v']['codec'], 'zlib:9')
+        self.assertEqual(ds.chunks[(0, 0)]['fields']['rho']['codec'], 'none')
+
+        # Nonfluid nodes are NaN.
+        rho2 = ds.get_field('rho')
+        self.assertEqual(rho2.dtype, rho.dtype)
+        self.assertTrue(np.all(np.isnan(rho2[~fluid])))
+        self.assertTrue(np.all(np.abs(rho2[fluid] - rho[fluid]) <= 0.001))
+
+        v = ds.get_field('v')
+        self.assertEqual(v.dtype, np.float32)
+        np.testing.assert_equal(v[2][fluid], vz[fluid])
+        self.assertTrue(np.all(np.isnan(v[:, ~fluid])))
+
+        chunks = list(ds.iter_chunks('rho'))
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(chunks[0][0], [0, 0, 0])
+
+    def test_invalid_codec(self):
+        self.config.output_codec = 'foo'
+        self.assertRaises(ValueError, io.ChunkedOutput, self.config, 0)
+
+
+class TestOutputSeries(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = DummyConfig()
+        self.config.output = os.path.join(self.tmpdir, 'out')
+
+        # Global domain: 10x7 (x, y), with a hole not covered by any
+        # subdomain at x >= 8, y >= 4.
+        self.subdomains = [
+            SubdomainSpec2D((0, 0), (4, 7), envelope_size=1, id_=0),
+            SubdomainSpec2D((4, 0), (6, 4), envelope_size=1, id_=1),
+            SubdomainSpec2D((4, 4), (4, 3), envelope_size=1, id_=2)]
+        with open(io.subdomains_filename(self.config.output), 'w') as f:
+            pickle.dump(self.subdomains, f)
+
+        np.random.seed(1234)
+        self.rho = {}
+        self.v = {}
+        for it in (0, 10, 20):
+            self.rho[it] = np.random.random((7, 10))
+            self.rho[it][4:, 8:] = np.nan
+            self.v[it] = np.random.random((2, 7, 10))
+            self.v[it][:, 4:, 8:] = np.nan
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _save(self, output_cls):
+        for spec in self.subdomains:
+            sl = [slice(spec.oy, spec.ey), slice(spec.ox, spec.ex)]
+            for it in sorted(self.rho.keys()):
+                output = output_cls(self.config, spec.id)
+                output.register_field(self.rho[it][sl].copy(), 'rho')
+                output.register_field([c[sl].copy() for c in self.v[it]], 'v')
+                output.set_fluid_map(np.ones(self.rho[it][sl].shape, dtype=np.bool))
+                output.set_location(spec.location)
+                output.save(it)
+
+    def _check_series(self):
+        series = io.OutputSeries(self.config.output, cache_size=2)
+        self.assertEqual(series.iterations, [0, 10, 20])
+        self.assertEqual(series.shape, (7, 10))
+        self.assertEqual(series.fields, ['rho', 'v'])
+
+        rho = series.field('rho', 10)
+        self.assertEqual(rho.shape, (7, 10))
+        np.testing.assert_equal(rho[...], self.rho[10])
+        np.testing.assert_equal(np.asarray(rho), self.rho[10])
+        np.testing.assert_equal(rho[2:6, 3:9], self.rho[10][2:6, 3:9])
+        np.testing.assert_equal(rho[::2, 1::3], self.rho[10][::2, 1::3])
+        np.testing.assert_equal(rho[-1], self.rho[10][-1])
+        np.testing.assert_equal(rho[3, 5], self.rho[10][3, 5])
+
+        v = series.field('v', 20)
+        self.assertEqual(v.shape, (2, 7, 10))
+        np.testing.assert_equal(v[1], self.v[20][1])
+        np.testing.assert_equal(v[:, 1:3, 5], self.v[20][:, 1:3, 5])
+        np.testing.assert_equal(v[..., 4], self.v[20][..., 4])
+
+        # Time series at a single point.
+        ts = list(series.iter_field('rho', (5, 5)))
+        self.assertEqual([it for it, _ in ts], [0, 10, 20])
+        for it, val in ts:
+            self.assertEqual(val, self.rho[it][5, 5])
+
+        self.assertTrue(len(series._cache) <= 2)
+
+    def test_npz(self):
+        self._save(io.NPYOutput)
+        self._check_series()
+
+    def test_npz_with_checkpoints(self):
+        self._save(io.NPYOutput)
+        digits = int(io.filename_iter_digits(self.config.max_iters))
+        for it in (10, 30):
+            for spec in self.subdomains:
+                np.savez(io.checkpoint_filename(self.config.output, digits,
+                                                spec.id, it) + '.npz',
+                         state=np.zeros(1))
+        self._check_series()
+
+    def test_merge_subdomains(self):
+        self._save(io.NPYOutput)
+        base = self.config.output
+        digits = io.filename_iter_digits(self.config.max_iters)
+
+        in_memory = merge_subdomains(base, digits, 10, save=False)
+        merged = merge_subdomains(base, digits, 10, save=True)
+        self.assertEqual(sorted(merged.keys()), ['rho', 'v'])
+        for name in ('rho', 'v'):
+            np.testing.assert_equal(merged[name], in_memory[name])
+        np.testing.assert_equal(merged['rho'], self.rho[10])
+        np.testing.assert_equal(merged['v'], self.v[10])
+        del merged
+
+        data = np.load(io.merged_filename(base, digits, 10))
+        try:
+            np.testing.assert_equal(data['v'], self.v[10])
+        finally:
+            data.close()
+        # No temporary files are left behind.
+        self.assertEqual(len(os.listdir(self.tmpdir)), 3 * 3 + 2)
+
+        # Subdomain specs are reloaded when the .subdomains file changes.
+        with open(io.subdomains_filename(base), 'w') as f:
+            pickle.dump(self.subdomains[:2], f)
+        rho = merge_subdomains(base, digits, 10, save=False)['rho']
+        self.assertEqual(rho.shape, (7, 10))
+        self.assertTrue(np.all(np.isnan(rho[4:, 4:])))
+
+    def _save_reduced(self, output_cls, region_spec, stride):
+        region = io.parse_output_region(region_spec, 2)
+        stride = io.parse_output_stride(stride, 2)
+        for spec in self.subdomains:
+            selection = io.output_selection(region, stride, spec.location,
+                                            spec.size)
+            if selection is None:
+                continue
+            slices, location = selection
+            sl = [slice(s.start + l, s.stop + l, s.step) for s, l in
+                  reversed(zip(slices, spec.location))]
+            for it in sorted(self.rho.keys()):
+                output = output_cls(self.config, spec.id)
+                output.register_field(self.rho[it][sl].copy(), 'rho')
+                output.register_field([c[sl].copy() for c in self.v[it]], 'v')
+                output.set_fluid_map(np.ones(self.rho[it][sl].shape, dtype=np.bool))
+                output.set_location(location)
+                output.set_selection(region_spec, stride)
+                output.save(it)
+
+    def test_merge_reduced(self):
+        self._save_reduced(io.NPYOutput, '1:9,2:', [3, 2])
+        base = self.config.output
+        digits = io.filename_iter_digits(self.config.max_iters)
+
+        data = np.load(io.filename(base, digits, 1, 10))
+        try:
+            self.assertEqual(list(data['output_location']), [1, 0])
+            self.assertEqual(str(data['output_region']), '1:9,2:')
+            self.assertEqual(list(data['output_stride']), [3, 2])
+        finally:
+            data.close()
+
+        merged = merge_subdomains(base, digits, 10, save=False)
+        self.assertEqual(sorted(merged.keys()), ['rho', 'v'])
+        np.testing.assert_equal(merged['rho'], self.rho[10][2::2, 1:9:3])
+        np.testing.assert_equal(merged['v'], self.v[10][:, 2::2, 1:9:3])
+        self.assertRaises(ValueError, io.OutputSeries, base)
+
+    def test_read_header(self):
+        fname = os.path.join(self.tmpdir, 'compressed.npz')
+        np.savez_compressed(fname, rho=self.rho[0].astype(np.float32))
+        shape, dtype = _read_header(fname, 'rho')
+        self.assertEqual(shape, (7, 10))
+        self.assertEqual(dtype, np.float32)
+
+    def test_merge_reduced_skipped(self):
+        # Only the first subdomain has nodes in the output region.
+        self._save_reduced(io.NPYOutput, ':4,:', [2])
+        base = self.config.output
+        digits = io.filename_iter_digits(self.config.max_iters)
+        merged = merge_subdomains(base, digits, 20, save=True)
+        np.testing.assert_equal(merged['rho'], self.rho[20][::2, :4:2])
+
+    def test_chunked_reduced(self):
+        self._save_reduced(io.ChunkedOutput, '1:9,2:', [3, 2])
+        series = io.OutputSeries(self.config.output)
+        self.assertEqual(series.shape, (3, 3))
+        np.testing.assert_equal(series.field('rho', 10)[...],
+                                self.rho[10][2::2, 1:9:3])
+
+    def test_chunked(self):
+        self._save(io.ChunkedOutput)
+        self._check_series()
+
+    def test_chunked_small_chunks(self):
+        self.config.output_chunk_size = [3]
+        self._save(io.ChunkedOutput)
+        self._check_series()
+
+
+class TestOutputRegion(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(io.parse_output_region('', 2), [(None, None)] * 2)
+        self.assertEqual(io.parse_output_region('2:10,:,5', 3),
+                         [(2, 10), (None, None), (5, 6)])
+        self.assertEqual(io.parse_output_region('3:,:7', 2),
+                         [(3, None), (None, 7)])
+        self.assertRaises(ValueError, io.parse_output_region, '1:2', 2)
+        self.assertRaises(ValueError, io.parse_output_region, ',1:2', 2)
+
+    def test_stride(self):
+        self.assertEqual(io.parse_output_stride([2], 3), [2, 2, 2])
+        self.assertEqual(io.parse_output_stride([1, 4], 2), [1, 4])
+        self.assertRaises(ValueError, io.parse_output_stride, [1, 2], 3)
+        self.assertRaises(ValueError, io.parse_output_stride, [1, 2, 3], 2)
+        self.assertRaises(ValueError, io.parse_output_stride, [0], 2)
+        self.assertRaises(ValueError, io.parse_output_stride, [2, -1], 2)
+
+    def test_selection(self):
+        region = io.parse_output_region('3:20,5', 2)
+        # Subdomain at x = 10..19, y = 0..9.
+        slices, location = io.output_selection(region, [4, 1], (10, 0), (10, 10))
+        self.assertEqual(slices, [slice(1, 10, 4), slice(5, 6, 1)])
+        self.assertEqual(location, [2, 0])
+        self.assertEqual(len(range(10)[slices[0]]), 3)
+
+        # The region starts within the subdomain.
+        slices, location = io.output_selection(region, [4, 1], (0, 0), (10, 10))
+        self.assertEqual(slices, [slice(3, 10, 4), slice(5, 6, 1)])
+        self.assertEqual(location, [0, 0])
+
+        # No sampled nodes in the subdomain.
+        self.assertTrue(io.output_selection(region, [4, 1], (20, 0),
+                                            (10, 10)) is None)
+        self.assertTrue(io.output_selection(region, [1, 1], (0, 10),
+                                            (10, 10)) is None)
+        self.assertTrue(io.output_selection([(None, None)], [8], (17,),
+                                            (6,)) is None)
+
+
+class TestCodecs(unittest.TestCase):
+    def test_roundtrip(self):
+        arr = np.linspace(0.0, 1.0, 1000).astype(np.float32)
+        for spec in ('none', 'zlib', 'zlib:1'):
+            c = codec.get_codec(spec)
+            np.testing.assert_equal(c.decode(c.encode(arr), arr.dtype), arr)
+
+        # Shuffling makes smooth data more compressible.
+        arr = np.linspace(0.0, 1.0, 10000)
+        self.assertTrue(len(codec.get_codec('zlib').encode(arr)) <
+                        len(zlib.compress(arr.tostring())))
+
+    def test_quantize(self):
+        np.random.seed(1234)
+        arr = np.random.random(1000) * 10.0
+        q = codec.quantize(arr, 0.01)
+        self.assertEqual(q.dtype, np.int16)
+        self.assertTrue(np.all(np.abs(codec.dequantize(q, 0.01, np.float64) -
+                                      arr) <= 0.01))
+        self.assertEqual(codec.quantize(arr, 1.0).dtype, np.int8)
+
+    def test_invalid(self):
+        for spec in ('foo', 'zlib:a', 'none:1', 'blosc'):
+            self.assertRaises(ValueError, codec.get_codec, spec)
+
+
+if __name__ == '__main__':
+    unittest.main()
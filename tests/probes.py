@@ -0,0 +1,147 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from sailfish import probes
+
+
+class TestLocate(unittest.TestCase):
+    points = np.array([[1.0, 2.0], [4.6, 0.2], [9.5, 3.0], [12.0, 1.0]])
+
+    def test_nearest(self):
+        ids, nodes, weights = probes.locate(self.points, (0, 0), (10, 5))
+        np.testing.assert_equal(ids, [0, 1])
+        np.testing.assert_equal(nodes, [[[1, 2], [5, 0]]])
+        np.testing.assert_equal(weights, [[1.0, 1.0]])
+
+        # 9.5 is rounded up to 10, which belongs to the next subdomain.
+        ids, nodes, weights = probes.locate(self.points, (10, 0), (5, 5))
+        np.testing.assert_equal(ids, [2, 3])
+        np.testing.assert_equal(nodes, [[[0, 3], [2, 1]]])
+
+    def test_interpolate(self):
+        ids, nodes, weights = probes.locate(self.points, (0, 0), (10, 5),
+                                            interpolate=True)
+        np.testing.assert_equal(ids, [0, 1, 2])
+        self.assertEqual(nodes.shape, (4, 3, 2))
+        np.testing.assert_almost_equal(np.sum(weights[:, :2], axis=0),
+                                       [1.0] * 2)
+
+        # Field values which are linear in the coordinates are reproduced
+        # exactly.
+        field = lambda x, y: 2.0 * x - 3.0 * y
+        values = np.sum(weights * field(nodes[..., 0], nodes[..., 1]), axis=0)
+        np.testing.assert_almost_equal(values[:2], field(self.points[:2, 0],
+                                                         self.points[:2, 1]))
+
+        # Nodes beyond the subdomain are not sampled.
+        self.assertTrue(np.all(nodes[:, 2, 0] == 9))
+        np.testing.assert_almost_equal(np.sum(weights[:, 2]), 0.5)
+
+    def _sample(self, location, size, **kwargs):
+        field = lambda x, y: 2.0 * x - 3.0 * y + 1.0
+        ids, nodes, weights = probes.locate(self.points, location, size,
+                                            interpolate=True, **kwargs)
+        nodes = nodes + location
+        values = np.zeros(len(self.points))
+        values[ids] = np.sum(weights * field(nodes[..., 0], nodes[..., 1]),
+                             axis=0)
+        return values, field
+
+    def test_interpolate_across_subdomains(self):
+        # The probe at 9.5 is located at location + size - 0.5 of the first
+        # subdomain, and is interpolated from nodes of both subdomains.
+        v0, field = self._sample((0, 0), (10, 5))
+        v1, _ = self._sample((10, 0), (5, 5))
+        np.testing.assert_almost_equal(v0 + v1, field(self.points[:, 0],
+                                                      self.points[:, 1]))
+        self.assertNotEqual(v0[2], 0.0)
+        self.assertNotEqual(v1[2], 0.0)
+
+    def test_interpolate_domain_edge(self):
+        # Nodes beyond the domain are replaced with the closest node...
+        values, _ = self._sample((10, 0), (5, 5), global_size=(15, 5))
+        self.assertAlmostEqual(values[3], 2.0 * 12.0 - 3.0 * 1.0 + 1.0)
+
+        points = np.array([[14.5, 1.0]])
+        ids, nodes, weights = probes.locate(points, (10, 0), (5, 5),
+                                            interpolate=True,
+                                            global_size=(15, 5))
+        np.testing.assert_equal(ids, [0])
+        self.assertTrue(np.all(nodes[..., 0] == 4))
+        np.testing.assert_almost_equal(np.sum(weights), 1.0)
+
+        # ... or with their periodic images.
+        ids, nodes, weights = probes.locate(points, (0, 0), (10, 5),
+                                            interpolate=True,
+                                            global_size=(15, 5),
+                                            periodicity=(True, False))
+        np.testing.assert_equal(ids, [0])
+        np.testing.assert_almost_equal(np.sum(weights), 0.5)
+        self.assertTrue(np.all(nodes[..., 0] == 0))
+
+
+class TestRead(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.base = os.path.join(self.tmpdir, 'out')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, sid, ids, iterations, values):
+        header = {'version': 1, 'num_probes': 4, 'ids': ids,
+                  'fields': [('rho', 0), ('v', 2)],
+                  'dtype': '<f4', 'every': 1}
+        with open(probes.header_filename(self.base, sid), 'w') as f:
+            json.dump(header, f)
+        records = np.zeros(len(iterations), dtype=probes.record_dtype(
+            3, len(ids), np.float32))
+        records['iteration'] = iterations
+        records['values'] = values
+        with open(probes.data_filename(self.base, sid), 'ab') as f:
+            records.tofile(f)
+
+    def test_read(self):
+        v0 = np.arange(2 * 3 * 2).reshape((2, 3, 2))
+        self._write(0, [0, 2], [1, 2], v0)
+        v1 = np.arange(2 * 3 * 1).reshape((2, 3, 1)) + 100
+        self._write(1, [1], [1, 2], v1)
+        # Samples recorded again after a restart.
+        self._write(1, [1], [2], v1[1:] + 1000)
+
+        iterations, data = probes.read(self.base)
+        np.testing.assert_equal(iterations, [1, 2])
+        self.assertEqual(data['rho'].shape, (2, 4))
+        self.assertEqual(data['v'].shape, (2, 4, 2))
+        self.assertTrue(np.all(np.isnan(data['rho'][:, 3])))
+        np.testing.assert_equal(data['rho'][:, 0], v0[:, 0, 0])
+        np.testing.assert_equal(data['rho'][:, 2], v0[:, 0, 1])
+        np.testing.assert_equal(data['rho'][:, 1], [100, 1103])
+        np.testing.assert_equal(data['v'][:, 2], v0[:, 1:, 1])
+        np.testing.assert_equal(data['v'][1, 1], [1104, 1105])
+
+    def test_read_partial(self):
+        # Probe 1 is sampled by two subdomains.
+        self._write(0, [0, 1], [1, 2], np.ones((2, 3, 2)))
+        self._write(1, [1], [1, 2], np.ones((2, 3, 1)) * 2)
+        iterations, data = probes.read(self.base)
+        np.testing.assert_equal(data['rho'][:, :2], [[1, 3], [1, 3]])
+        np.testing.assert_equal(data['v'][:, 1], [[3, 3], [3, 3]])
+        self.assertTrue(np.all(np.isnan(data['rho'][:, 2:])))
+
+    def test_truncate(self):
+        v = np.arange(4 * 3 * 2).reshape((4, 3, 2))
+        self._write(0, [0, 2], [1, 2, 3, 4], v)
+        fname = probes.data_filename(self.base, 0)
+        probes.truncate(fname, probes.record_dtype(3, 2, np.float32), 2)
+        iterations, data = probes.read(self.base)
+        np.testing.assert_equal(iterations, [1, 2])
+        np.testing.assert_equal(data['rho'][:, 0], v[:2, 0, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
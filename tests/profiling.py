@@ -0,0 +1,320 @@
+import ctypes
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import numpy as np
+
+from sailfish import connector, overlap, profile, roofline
+from sailfish.backend_dummy import DummyBackend
+from sailfish.config import LBConfig
+from sailfish.lb_base import LBSim
+from sailfish.subdomain import SubdomainSpec2D
+from sailfish.subdomain_runner import SubdomainRunner
+
+from dummy import *
+
+
+class TestHistogram(unittest.TestCase):
+    def test_percentiles(self):
+        np.random.seed(1234)
+        durations = np.random.exponential(1e-3, 10000) + 1e-5
+        hist = profile.Histogram()
+        for d in durations:
+            hist.record(d)
+        self.assertEqual(hist.total_count, len(durations))
+        for p in (50, 90, 99, 99.9):
+            exact = np.percentile(durations, p)
+            self.assertTrue(abs(hist.percentile(p) - exact) / exact < 0.05)
+
+    def test_small_and_large(self):
+        hist = profile.Histogram()
+        hist.record(3e-6)
+        self.assertAlmostEqual(hist.percentile(100), 3e-6)
+        hist.record(100.0)
+        self.assertTrue(abs(hist.percentile(100) - 100.0) < 100.0 / 16)
+        self.assertEqual(profile.Histogram().percentile(50), 0.0)
+
+    def test_merge(self):
+        a = profile.Histogram()
+        b = profile.Histogram()
+        a.record(1e-3)
+        b.record(2e-3)
+        a.merge(b)
+        self.assertEqual(a.total_count, 2)
+
+
+class TestStartupProfile(unittest.TestCase):
+    def test_phases(self):
+        startup = profile.StartupProfile()
+        with startup.phase('a'):
+            time.sleep(0.01)
+        with startup.phase('b'):
+            pass
+        self.assertEqual([p['phase'] for p in startup.phases], ['a', 'b'])
+        self.assertTrue(startup.phases[0]['time'] >= 0.01)
+        self.assertTrue(startup.phases[1]['start'] >= startup.phases[0]['start'])
+        self.assertTrue(startup.total >= 0.01)
+        if profile.resource is not None:
+            self.assertTrue(startup.phases[1]['peak_rss'] > 0)
+
+    def test_format(self):
+        def _phase(name, t):
+            return {'phase': name, 'start': 0.0, 'time': t, 'peak_rss': 0}
+
+        lines = profile.format_startup(
+            [_phase('config', 0.5)],
+            {0: [_phase('geometry', 1.0), _phase('compile', 3.0)],
+             1: [_phase('geometry', 2.0), _phase('compile', 1.0)]})
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[1].startswith('controller/config'))
+        self.assertTrue(lines[2].startswith('runner/geometry'))
+        self.assertTrue(lines[2].endswith('1'))
+        self.assertTrue(lines[3].startswith('runner/compile'))
+        self.assertTrue(lines[3].endswith('0'))
+
+
+class TestTimeProfile(unittest.TestCase):
+    def setUp(self):
+        config = LBConfig()
+        config.init_iters = 0
+        config.seed = 0
+        config.access_pattern = 'AB'
+        config.precision = 'single'
+        config.block_size = 8
+        config.mem_alignment = 8
+        config.lat_nx, config.lat_ny = 10, 3
+        config.logger = DummyLogger()
+        config.grid = 'D2Q9'
+        config.geometry_slab_size = 0
+        config.trace_iters = 0
+        config.profile_report = ''
+        config.benchmark_sample_from = 2
+        config.benchmark_minibatch = 10
+        config.output = ''
+        self.sim = LBSim(config)
+        self.runner = SubdomainRunner(self.sim, SubdomainSpec2D((0, 0),
+                                                                (10, 3)),
+                                      output=None, backend=DummyBackend(),
+                                      quit_event=None)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_registry(self):
+        prof = self.runner._profile
+        timer = prof.register_timer('custom')
+        self.assertEqual(prof.register_timer('custom'), timer)
+        self.assertEqual(prof.register_timer('step'), prof.STEP)
+        self.assertTrue(timer > prof.STEP)
+        self.assertEqual(prof.event_names()[timer], 'custom')
+
+        for it in range(5):
+            self.sim.iteration = it
+            prof.record_cpu_start(timer)
+            prof.record_cpu_end(timer)
+
+        report = prof.report()
+        # Iterations before benchmark_sample_from are ignored.
+        self.assertEqual(report['custom']['count'], 3)
+        self.assertFalse(report['custom']['gpu'])
+        self.assertFalse('bulk' in report)
+
+    def test_bandwidth(self):
+        runner = self.runner
+        runner._spec.set_actual_size(0)
+        runner._init_shape()
+        traffic = runner._kernel_traffic()
+        # No connections, so the whole domain is handled by the boundary
+        # kernel.
+        self.assertEqual(traffic[0][:2], (profile.TimeProfile.BULK, 0))
+        timer_id, nodes, per_node = traffic[1]
+        self.assertEqual(timer_id, profile.TimeProfile.BOUNDARY)
+        self.assertEqual(nodes, 16 * 3)
+        # D2Q9, single precision: 9 reads, 9 writes and the node type.
+        self.assertEqual(per_node, 2 * 9 * 4 + 4)
+
+        prof = runner._profile
+        prof.timers[prof.BOUNDARY].add(1e-6)
+        prof.timers[prof.BOUNDARY].add(3e-6)
+        report = roofline.bandwidth_report(prof.timers, traffic, 100e9)
+        self.assertEqual(len(report), 1)
+        entry = report[0]
+        self.assertEqual(entry['kernel'], 'boundary')
+        self.assertAlmostEqual(entry['bandwidth'], 48 * 76 / 2e-6)
+        self.assertAlmostEqual(entry['peak_fraction'], 48 * 76 / 2e-6 / 100e9)
+        self.assertAlmostEqual(entry['max_mlups'], 100e9 / 76 * 1e-6)
+        self.assertEqual(len(roofline.format_bandwidth({0: report})), 2)
+
+        fname = os.path.join(self.tmpdir, 'bw.dat')
+        roofline.save_bandwidth(fname, {0: report})
+        with open(fname) as f:
+            lines = f.readlines()
+        self.assertEqual(lines[1].split('\t')[:4], ['0', 'boundary', '48',
+                                                     '76'])
+
+        # Macroscopic fields only count for the measured steps in which they
+        # were written.
+        runner._named_fields = [('rho', None), ('v', [None, None])]
+        runner._sampled_steps = 4
+        runner._macro_steps = 1
+        self.assertEqual(runner._kernel_traffic()[1][2],
+                         2 * 9 * 4 + 4 + 3 * 4 / 4.0)
+
+    def test_report(self):
+        reports = {
+            0: {'step': {'gpu': False, 'count': 10, 'total': 1.0, 'mean': 0.1,
+                         'min': 0.05, 'max': 0.2, 'p50': 0.1, 'p90': 0.15,
+                         'p99': 0.2, 'p99.9': 0.2}},
+            1: {'step': {'gpu': False, 'count': 10, 'total': 2.0, 'mean': 0.2,
+                         'min': 0.1, 'max': 0.4, 'p50': 0.2, 'p90': 0.3,
+                         'p99': 0.4, 'p99.9': 0.4}}}
+        merged = profile.merge_reports(reports)['timers']['step']
+        self.assertEqual(merged['count'], 20)
+        self.assertAlmostEqual(merged['total'], 3.0)
+        self.assertEqual(merged['min'], 0.05)
+        self.assertEqual(merged['p50'], 0.2)
+        self.assertEqual(merged['max'], 0.4)
+        self.assertAlmostEqual(merged['mean'], 0.15)
+        # Inputs are not modified.
+        self.assertEqual(reports[0]['step']['count'], 10)
+
+        fname = os.path.join(self.tmpdir, 'report.json')
+        profile.save_report(fname, reports, {'mlups': 1.5})
+        with open(fname) as f:
+            data = json.load(f)
+        self.assertEqual(sorted(data.keys()), ['mlups', 'subdomains', 'timers'])
+        self.assertEqual(data['subdomains']['1']['step']['max'], 0.4)
+
+    def test_instrument(self):
+        prof = self.runner._profile
+        prof.instrument(self.sim, 'after_step', 'host_after_step')
+        self.sim.iteration = 5
+        self.sim.after_step(self.runner)
+        self.assertEqual(prof.report()['host_after_step']['count'], 1)
+
+    def test_host_overhead(self):
+        def _stats(count, total):
+            return {'gpu': False, 'count': count, 'total': total,
+                    'mean': total / count, 'min': 0.0, 'max': 0.0,
+                    'p50': 0.0, 'p90': 0.0, 'p99': 0.0, 'p99.9': 0.0}
+
+        report = {'step': _stats(10, 1e-3),
+                  'host_step': _stats(10, 6e-4),
+                  'send_dists': _stats(10, 2e-4),
+                  'net_send': _stats(20, 1e-4),
+                  'host_after_step': _stats(10, 1e-4)}
+        lines = profile.format_host_overhead({0: report, 1: report})
+        rows = [l.split() for l in lines[1:]]
+        self.assertEqual([r[0] for r in rows],
+                         ['step', 'host_step', 'send_dists', 'net_send',
+                          'other', 'other', 'other', 'host_after_step'])
+        self.assertEqual(rows[0][1:3], ['100.00', '1.00'])
+        self.assertEqual(rows[3][1:3], ['10.00', '2.00'])
+        # Time not accounted for by send_dists, host_step and step.
+        self.assertEqual([r[1] for r in rows[4:7]], ['10.00', '40.00',
+                                                     '40.00'])
+        self.assertTrue(lines[5].startswith('      other'))
+        self.assertEqual(profile.format_host_overhead({}), [])
+
+
+    def test_overlap(self):
+        config = self.sim.config
+        config.mode = 'benchmark'
+        prof = self.runner._profile
+        prof.record_start()
+        self.runner._calc_stream = None
+        for it in range(2, 4):
+            self.sim.iteration = it
+            prof.start_step()
+            prof.record_gpu_start(prof.BULK, None)
+            prof.record_gpu_end(prof.BULK, None)
+            prof.record_cpu_start(prof.SEND_DISTS)
+            time.sleep(0.001)
+            prof.record_cpu_end(prof.SEND_DISTS)
+            prof.record_cpu_start(prof.NET_RECV)
+            prof.record_cpu_end(prof.NET_RECV, 7)
+            prof.end_step()
+
+        self.assertEqual(prof.overlap.steps, 2)
+        self.assertTrue(prof.overlap.comm >= 0.002)
+        # Dummy events take no time.
+        self.assertEqual(prof.overlap.bulk, 0.0)
+        self.assertEqual(prof.overlap.critical, {7: 2})
+
+
+class TestOverlap(unittest.TestCase):
+    def test_analyzer(self):
+        an = overlap.OverlapAnalyzer()
+        an.add_comm(1.0, 2.0)
+        an.add_comm(1.5, 3.0)
+        an.add_wait(1, 0.2)
+        an.add_wait(2, 0.5)
+        an.add_wait(1, 0.4)
+        an.end_step([(0.5, 2.5)])
+        an.add_comm(1.0, 2.0)
+        an.add_wait(2, 0.1)
+        an.end_step([(3.0, 4.0)])
+        self.assertEqual(an.steps, 2)
+        self.assertAlmostEqual(an.comm, 3.0)
+        self.assertAlmostEqual(an.bulk, 3.0)
+        self.assertAlmostEqual(an.overlap, 1.5)
+        self.assertEqual(an.critical, {1: 1, 2: 1})
+
+        r = an.report(4.0, 2.0, True, 0.5)
+        self.assertAlmostEqual(r['comm'], 1.5)
+        self.assertAlmostEqual(r['overlap'], 0.75)
+        self.assertAlmostEqual(r['exposed'], 0.75)
+        self.assertAlmostEqual(r['overlap_fraction'], 0.5)
+        self.assertAlmostEqual(r['peer_wait'][1], 0.3)
+        self.assertEqual(r['critical_share'], 0.5)
+        self.assertTrue('Keep it' in overlap.recommend(r))
+
+        lines = overlap.format_overlap({0: r})
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[2].startswith('Subdomain 0: '))
+
+    def test_recommend(self):
+        r = overlap.OverlapAnalyzer().report(1e-3, 5e-4, False, 0.5)
+        self.assertTrue(overlap.recommend(r).startswith('No communication'))
+
+        r.update({'steps': 100, 'comm': 2e-4, 'overlap': 1e-6,
+                  'exposed': 2e-4 - 1e-6, 'split': True})
+        self.assertTrue('--nobulk_boundary_split' in overlap.recommend(r))
+
+        # Without the split, the hidden time is limited by the bulk kernel.
+        r.update({'overlap': 0.0, 'exposed': 2e-4, 'split': False})
+        self.assertTrue('up to 200.0 us' in overlap.recommend(r))
+        r['bulk_fraction'] = 0.01
+        self.assertTrue('at most 5.0 us' in overlap.recommend(r))
+        r['bulk_fraction'] = 0.0
+        self.assertTrue('too small' in overlap.recommend(r))
+
+
+class TestInMemoryConnector(unittest.TestCase):
+    def test_exchange(self):
+        c1, c2 = connector.InMemorySubdomainConnector.make_pair(
+            ctypes.c_float, (3, 2), (0, 1))
+        c1.init_runner(None)
+        c2.init_runner(None)
+        quit_event = multiprocessing.Event()
+        c1.send(np.array([1.0, 2.0, 3.0], dtype=np.float32))
+        c2.send(np.array([4.0, 5.0], dtype=np.float32))
+        data = np.zeros(3, dtype=np.float32)
+        self.assertTrue(c2.recv(data, quit_event))
+        np.testing.assert_equal(data, [1.0, 2.0, 3.0])
+        data = np.zeros(2, dtype=np.float32)
+        # Receiving never blocks.
+        self.assertTrue(c1.recv(data, quit_event))
+        self.assertTrue(c1.recv(data, quit_event))
+        np.testing.assert_equal(data, [4.0, 5.0])
+        quit_event.set()
+        self.assertFalse(c1.recv(data, quit_event))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -32,6 +32,50 @@ class TestNodeTypeSetting2D(TestCase2D):
 
         np.testing.assert_equal(sub._type_map[1:4, 12:-1], _NTUnused.id)
 
+    def test_chunked_setting(self):
+        envelope = 1
+        spec = SubdomainSpec2D((0, 0), self.lattice_size,
+                               envelope_size=envelope, id_=0)
+        spec.runner = SubdomainRunner(self.sim, spec, output=None,
+                                      backend=self.backend, quit_event=None)
+        spec.runner._init_shape()
+        sub = SubdomainTest2D(list(reversed(self.lattice_size)), spec, D2Q9)
+        sub.reset()
+        type_map = sub._type_map.base.copy()
+
+        self.config.geometry_slab_size = 7
+        sub_chunked = SubdomainTest2D(list(reversed(self.lattice_size)), spec, D2Q9)
+        sub_chunked.reset()
+        np.testing.assert_equal(sub_chunked._type_map.base, type_map)
+
+        center = 64 / 2
+        for y in range(0, 64):
+            np.testing.assert_array_almost_equal(
+                    np.float64([0.01 * (y - center)**2, 0.0]),
+                    np.float64(sub_chunked._encoder.get_param(
+                        (y + envelope, y + envelope), 2)))
+
+        # Initial conditions are evaluated for every node, with the simulation
+        # fields restricted to the current slab.
+        class Sim(object):
+            pass
+        sim = Sim()
+        sim.rho = spec.runner.make_scalar_field(register=False)
+        sim.v = [spec.runner.make_scalar_field(register=False),
+                 spec.runner.make_scalar_field(register=False)]
+
+        def initial_conditions(sim, hx, hy):
+            self.assertEqual(sim.rho.shape, hx.shape)
+            sim.rho[:] = hx + 100 * hy
+            sim.v[1][hy > 10] = 1.0
+        sub_chunked.initial_conditions = initial_conditions
+        sub_chunked.init_fields(sim)
+
+        hx, hy = sub._get_mgrid()
+        np.testing.assert_equal(sim.rho, hx + 100 * hy)
+        np.testing.assert_equal(sim.v[0], 0.0)
+        np.testing.assert_equal(sim.v[1], hy > 10)
+
 class SubdomainTest3D(Subdomain3D):
     def boundary_conditions(self, hx, hy, hz):
         where = np.logical_and((hx == hy), (hy == hz))
@@ -62,5 +106,21 @@ class TestNodeTypeSetting3D(TestCase3D):
 
         np.testing.assert_equal(sub._type_map[1:6, 1:4, 12:-1], _NTUnused.id)
 
+    def test_chunked_setting(self):
+        envelope = 1
+        spec = SubdomainSpec3D((0, 0, 0), self.lattice_size,
+                               envelope_size=envelope, id_=0)
+        spec.runner = SubdomainRunner(self.sim, spec, output=None,
+                                      backend=self.backend, quit_event=None)
+        spec.runner._init_shape()
+        sub = SubdomainTest3D(list(reversed(self.lattice_size)), spec, D3Q19)
+        sub.reset()
+        type_map = sub._type_map.base.copy()
+
+        self.sim.config.geometry_slab_size = 3
+        sub_chunked = SubdomainTest3D(list(reversed(self.lattice_size)), spec, D3Q19)
+        sub_chunked.reset()
+        np.testing.assert_equal(sub_chunked._type_map.base, type_map)
+
 if __name__ == '__main__':
     unittest.main()
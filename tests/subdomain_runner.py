@@ -13,7 +13,7 @@ from sailfish.backend_dummy import DummyBackend
 from sailfish.subdomain_runner import SubdomainRunner, NNSubdomainRunner
 from sailfish.subdomain import SubdomainSpec2D, SubdomainSpec3D, SubdomainPair
 from sailfish.io import LBOutput
-from sailfish.sym import D2Q9
+from sailfish.sym import D2Q9, D3Q19
 
 from dummy import *
 
@@ -36,6 +36,12 @@ class BasicFunctionalityTest(unittest.TestCase):
         config.lat_nz, config.lat_nx, config.lat_ny = self.size_3d
         config.logger = DummyLogger()
         config.grid = 'D3Q19'
+        config.geometry_slab_size = 0
+        config.trace_iters = 0
+        config.profile_report = ''
+        config.bandwidth_file = ''
+        config.metrics_every = 0
+        config.host_overhead = False
         self.sim = LBSim(config)
         self.backend = DummyBackend()
 
@@ -77,6 +83,57 @@ class BasicFunctionalityTest(unittest.TestCase):
         nodes = runner._get_nodes()
         self.assertEqual(nodes, reduce(operator.mul, real_size))
 
+    def test_partial_dst_indices_3d(self):
+        b1 = SubdomainSpec3D((0, 0, 0), (4, 6, 5), envelope_size=1, id_=0)
+        b2 = SubdomainSpec3D((4, 3, 0), (4, 6, 5), envelope_size=1, id_=1)
+        self.assertTrue(b1.connect(b2, grid=D3Q19))
+        runner = self.get_subdomain_runner(b2)
+        runner._init_shape()
+
+        face, _ = b2.connecting_subdomains()[0]
+        cpair = b2.get_connection(face, b1.id)
+        self.assertTrue(cpair.dst.partial_nodes > 0)
+        idx, sel = runner._get_partial_dst_indices(face, cpair)
+
+        # Build the expected tables node by node.
+        exp_idx = []
+        exp_sel = []
+        for dist_num, locations in sorted(cpair.dst.dst_partial_map.items()):
+            for loc in locations:
+                dst_loc = [x + y + 1 for x, y in zip(cpair.dst.dst_low, loc)]
+                dst_loc = runner._dst_face_loc_to_full_loc(face, dst_loc)
+                exp_idx.append(runner._get_global_idx(dst_loc, dist_num))
+                exp_sel.append([cpair.dst.dists.index(dist_num)] +
+                               list(reversed(loc)))
+
+        np.testing.assert_equal(idx, exp_idx)
+        np.testing.assert_equal(np.array(sel).T, exp_sel)
+
+    def test_check_reduced_output(self):
+        """Invalid values in reduced output arrays filled on the host are
+        detected."""
+        self.sim.config.check_invalid_results_host = True
+        self.sim.config.output = ''
+        block = SubdomainSpec2D(self.location, self.size)
+        output = LBOutput(self.sim.config, 0)
+        runner = SubdomainRunner(self.sim, block, output=output,
+                backend=self.backend, quit_event=None)
+        runner._output_selection = [slice(0, 2), slice(2, 8, 2)]
+        output.set_fluid_map(np.ones((2, 3), dtype=np.bool))
+
+        # Not a float field, so the reduced array is filled on the host.
+        field = np.zeros((3, 10), dtype=np.float64)
+        output.register_field(runner._output_view(field), 'rho')
+        self.assertTrue(runner._check_output())
+
+        field[1, 4] = np.nan
+        self.assertFalse(runner._check_output())
+
+        # Nodes outside of the reduced output are not checked.
+        field[1, 4] = 0.0
+        field[2, 4] = np.nan
+        self.assertTrue(runner._check_output())
+
 
 class NNSubdomainRunnerTest(unittest.TestCase):
 
@@ -91,10 +148,19 @@ class NNSubdomainRunnerTest(unittest.TestCase):
         config.lat_nx, config.lat_ny = 40, 80
         config.logger = DummyLogger()
         config.grid = 'D2Q9'
+        config.geometry_slab_size = 0
+        config.trace_iters = 0
+        config.profile_report = ''
+        config.bandwidth_file = ''
+        config.metrics_every = 0
+        config.host_overhead = False
         config.benchmark_sample_from = 0
         config.benchmark_minibatch = 1
         config.bulk_boundary_split = False
         config.output = ''
+        config.output_region = ''
+        config.output_stride = [1]
+        config.output_fields = []
         self.config = config
         self.backend = DummyBackend()
         self.ctx = zmq.Context()
@@ -0,0 +1,64 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from sailfish import trace
+
+
+class TestTracer(unittest.TestCase):
+    names = {0: 'bulk', 1: 'net_recv'}
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_window(self):
+        tracer = trace.Tracer(3, self.names, 10, 5)
+        tracer.set_iteration(9)
+        self.assertFalse(tracer.active)
+        tracer.set_iteration(10)
+        self.assertTrue(tracer.active)
+        tracer.set_iteration(14)
+        self.assertTrue(tracer.active)
+        tracer.set_iteration(15)
+        self.assertFalse(tracer.active)
+
+    def test_ring_buffer(self):
+        tracer = trace.Tracer(3, self.names, 0, 10, capacity=4)
+        for i in range(6):
+            tracer.set_iteration(i)
+            tracer.record(i % 2, trace.CPU, 100.0 + i, 100.5 + i, peer=i)
+        self.assertEqual(len(tracer), 4)
+        self.assertEqual(tracer.dropped, 2)
+
+        events = [e for e in tracer.events() if e['ph'] == 'X']
+        self.assertEqual([e['args']['iteration'] for e in events], [2, 3, 4, 5])
+        self.assertEqual(events[0]['name'], 'bulk')
+        self.assertEqual(events[1]['args']['peer'], 3)
+        self.assertEqual(events[1]['pid'], 3)
+        self.assertAlmostEqual(events[0]['ts'], 102e6)
+        self.assertAlmostEqual(events[0]['dur'], 0.5e6)
+
+    def test_merge(self):
+        fname = os.path.join(self.tmpdir, 'trace.json')
+        for sid in (0, 1):
+            tracer = trace.Tracer(sid, self.names, 0, 10)
+            tracer.set_iteration(0)
+            tracer.record(0, trace.GPU_CALC, 1.0, 2.0)
+            tracer.save(fname)
+
+        self.assertEqual(trace.merge(fname, [0, 1, 2]), [0, 1])
+        self.assertEqual(os.listdir(self.tmpdir), ['trace.json'])
+        with open(fname) as f:
+            data = json.load(f)
+        events = [e for e in data['traceEvents'] if e['ph'] == 'X']
+        self.assertEqual(sorted(e['pid'] for e in events), [0, 1])
+        self.assertEqual(events[0]['tid'], trace.GPU_CALC)
+
+
+if __name__ == '__main__':
+    unittest.main()
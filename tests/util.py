@@ -3,7 +3,7 @@ import random
 import unittest
 import tempfile
 import numpy as np
-from sailfish import config, util
+from sailfish import config, sym, util
 
 class TestPbsUtils(unittest.TestCase):
     def test_gpufile_processing(self):
@@ -46,6 +46,19 @@ class TestMiscUtils(unittest.TestCase):
         np.testing.assert_array_equal(
                 util.in_anyd(a, b), util.in_anyd_fast(a, b))
 
+    def test_neighbor_bitmask(self):
+        for grid, shape in ((sym.D2Q9, (12, 17)), (sym.D3Q19, (6, 7, 9))):
+            mask = np.random.random(shape) > 0.5
+            halo = util.periodic_halo(mask.astype(np.uint8), range(len(shape)))
+            bits = util.neighbor_bitmask(halo, grid)
+            self.assertEqual(bits.shape, shape)
+
+            for i, vec in enumerate(grid.basis):
+                shifted = mask
+                for axis, shift in enumerate(reversed(list(vec))):
+                    shifted = np.roll(shifted, -int(shift), axis=axis)
+                np.testing.assert_array_equal((bits >> i) & 1, shifted)
+
 
 if __name__ == '__main__':
     unittest.main()
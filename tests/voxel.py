@@ -0,0 +1,74 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+
+from sailfish import voxel
+from sailfish.subdomain import SubdomainSpec3D
+
+
+class TestVoxelGeometry(unittest.TestCase):
+    shape = (10, 12, 21)
+
+    def setUp(self):
+        np.random.seed(1234)
+        self.mask = np.random.random(self.shape) > 0.5
+        self.files = []
+
+    def tearDown(self):
+        for fname in self.files:
+            os.unlink(fname)
+
+    def _tempfile(self, suffix=''):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        os.close(fd)
+        self.files.append(path)
+        return path
+
+    def _check_geometry(self, geo):
+        self.assertEqual(geo.shape, self.shape)
+        np.testing.assert_equal(geo.get_region((0, 0, 0), self.shape),
+                                self.mask)
+        np.testing.assert_equal(geo.get_region((2, 3, 5), (7, 8, 19)),
+                                self.mask[2:7, 3:8, 5:19])
+
+        # Nodes outside of the geometry are set to 0.
+        region = geo.get_region((-1, -1, -1), (3, 3, 3))
+        np.testing.assert_equal(region[1:, 1:, 1:], self.mask[0:3, 0:3, 0:3])
+        self.assertFalse(np.any(region[0, :, :]))
+        self.assertFalse(np.any(region[:, 0, :]))
+        self.assertFalse(np.any(region[:, :, 0]))
+
+        spec = SubdomainSpec3D((4, 2, 1), (10, 5, 9), envelope_size=1)
+        np.testing.assert_equal(geo.get_subdomain_region(spec, envelope=False),
+                                self.mask[1:10, 2:7, 4:14])
+        np.testing.assert_equal(geo.get_subdomain_region(spec)[1:-1, 1:-1, 1:-1],
+                                self.mask[1:10, 2:7, 4:14])
+
+        hz, hy, hx = np.mgrid[3:6, 2:4, 7:15]
+        np.testing.assert_equal(geo.get_mask(hx, hy, hz),
+                                self.mask[3:6, 2:4, 7:15])
+
+    def test_npy(self):
+        fname = self._tempfile('.npy')
+        np.save(fname, self.mask)
+        self._check_geometry(voxel.VoxelGeometry(fname))
+
+    def test_raw(self):
+        fname = self._tempfile()
+        self.mask.tofile(fname)
+        self._check_geometry(voxel.VoxelGeometry(fname, shape=self.shape))
+        self.assertRaises(ValueError, voxel.VoxelGeometry, fname)
+
+    def test_packed(self):
+        fname = self._tempfile()
+        voxel.save_packed(fname, self.mask)
+        self.assertEqual(os.path.getsize(fname), voxel.PACKED_HEADER_SIZE +
+                         self.shape[0] * self.shape[1] * 3)
+        geo = voxel.VoxelGeometry(fname)
+        self.assertTrue(geo.packed)
+        self._check_geometry(geo)
+
+
+if __name__ == '__main__':
+    unittest.main()
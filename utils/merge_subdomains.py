@@ -3,22 +3,54 @@
 A utility to merge subdomain outputs into a single output file.
 
 Usage:
-    ./merge_subdomains.py [--all] file.0.00001.npz
+    ./merge_subdomains.py [--all] [--jobs N] file.0.00001.npz
 where:
     file.0.00001.npz is any output file for any block from the
     output series to be merged.  If --all is specified, all
-    iterations are processed.
+    iterations are processed, using N worker processes.
+
+Global fields are assembled one at a time in memory-mapped temporary files,
+which are then added to the merged .npz file, so the size of the fields is
+not limited by the amount of available RAM.
+
+If the output was limited to a region of the domain (--output_region,
+--output_stride), the merged fields cover the reduced output lattice.
 """
 
 import argparse
 import glob
 import cPickle as pickle
+import multiprocessing
+import os
+import struct
 import sys
+import tempfile
+import zipfile
 
 import numpy as np
 
 from sailfish import io
 
+# Maps output base names to tuples of: (mtime, size) of the .subdomains
+# file, list of subdomain specs.
+_subdomains_cache = {}
+
+
+def load_subdomains(base):
+    """Returns a list of subdomain specs for a simulation.
+
+    The list is cached, and only loaded again from the .subdomains file if
+    the file has changed (e.g. when the same output base name is reused by
+    another simulation).
+    """
+    fname = io.subdomains_filename(base)
+    st = os.stat(fname)
+    stamp = (st.st_mtime, st.st_size)
+    if base not in _subdomains_cache or _subdomains_cache[base][0] != stamp:
+        with open(fname, 'rb') as f:
+            _subdomains_cache[base] = (stamp, pickle.load(f))
+    return _subdomains_cache[base][1]
+
 
 def get_bounding_box(subdomains):
     dim = subdomains[0].dim
@@ -32,42 +64,205 @@ def get_bounding_box(subdomains):
         return gy, gx
 
 
-def merge_subdomains(base, digits, it, save=True):
-    fn_subdomains = io.subdomains_filename(base)
-    subdomains = pickle.load(open(fn_subdomains, 'r'))
-    bb = get_bounding_box(subdomains)
+def _load_field(fname, field):
+    data = np.load(fname)
+    try:
+        return data[field]
+    finally:
+        data.close()
 
-    data = np.load(io.filename(base, digits, subdomains[0].id, it))
-    dtype = data['v'].dtype
-    dim = data['v'].shape[0]
 
-    out = {}
-    for field in data.files:
-        if len(data[field].shape) == dim:
-            shape = bb
-        else:
-            shape = list(data[field].shape)
-            shape[-dim:] = bb
+def _read_header(fname, field):
+    """Returns the shape and dtype of a field stored in a .npz file.
+
+    Only the .npy header is read, so the field is not decompressed.
+    """
+    zipf = zipfile.ZipFile(fname, mode='r')
+    try:
+        f = zipf.open(field + '.npy')
+        try:
+            np.lib.format.read_magic(f)
+            shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+        finally:
+            f.close()
+    finally:
+        zipf.close()
+    return shape, dtype
 
-        out[field] = np.zeros(shape, dtype=dtype)
-        out[field][:] = np.nan
-        # np.ma.masked_all(shape, dtype=dtype)
 
+def _get_tiles(base, digits, it, subdomains):
+    """Returns a list of (file name, location, shape) tuples for all
+    subdomain output files.  Locations and shapes use the numpy convention.
+
+    For output limited to a region of the domain, the locations and shapes
+    are read from the files and are in the reduced output lattice.  Subdomains
+    without any nodes in the output region do not save any files, and are
+    skipped.
+    """
+    ret = []
+    missing = []
+    reduced = False
     for s in subdomains:
-        fn = io.filename(base, digits, s.id, it)
-        data = np.load(fn)
+        fname = io.filename(base, digits, s.id, it)
+        if not os.path.exists(fname):
+            missing.append(fname)
+            continue
+        data = np.load(fname)
+        try:
+            if 'output_location' in data.files:
+                reduced = True
+                field = [f for f in data.files if f not in
+                         io.NPYOutput.SELECTION_KEYS][0]
+                shape, _ = _read_header(fname, field)
+                ret.append((fname, list(reversed(data['output_location'])),
+                            list(shape[-s.dim:])))
+            else:
+                ret.append((fname, list(reversed(s.location)),
+                            list(reversed(s.size))))
+        finally:
+            data.close()
+
+    if missing and not reduced:
+        raise IOError('Missing output file: {0}'.format(missing[0]))
+    return ret
+
+
+def _merge_field(field, tiles, out):
+    """Copies a field from all subdomain files into a global array.
+
+    Only a single subdomain field is held in memory at a time.
+    """
+    dim = len(tiles[0][1])
+    if out.dtype.kind in 'fc':
+        out[:] = np.nan
+    else:
+        out[:] = 0
+
+    for fname, location, shape in tiles:
+        data = _load_field(fname, field)
+        selector = [slice(None)] * (len(data.shape) - dim)
+        selector.extend([slice(i0, i0 + n) for i0, n in zip(location, shape)])
+        out[selector] = data
+        del data
+
+
+def _get_fields(tiles):
+    """Returns a dict mapping field names to (shape, dtype) of the merged
+    field."""
+    dim = len(tiles[0][1])
+    bb = [max(location[i] + shape[i] for _, location, shape in tiles)
+          for i in range(dim)]
+    data = np.load(tiles[0][0])
+    try:
+        ret = {}
         for field in data.files:
-            selector = [slice(None)] * (len(data[field].shape) - dim)
-            selector.extend([slice(i0, i1) for i0, i1 in reversed(zip(s.location, s.end_location))])
-            out[field][selector] = data[field]
+            if field in io.NPYOutput.SELECTION_KEYS:
+                continue
+            shape, dtype = _read_header(tiles[0][0], field)
+            ret[field] = (list(shape[:-dim]) + bb, dtype)
+        return ret
+    finally:
+        data.close()
+
+
+def _open_stored_npz(fname):
+    """Returns a dict of read-only memory-mapped arrays stored in an
+    uncompressed .npz file."""
+    ret = {}
+    zipf = zipfile.ZipFile(fname, mode='r')
+    try:
+        members = zipf.infolist()
+    finally:
+        zipf.close()
+
+    with open(fname, 'rb') as f:
+        for info in members:
+            # Skip the local file header, which has a 30-byte fixed part
+            # followed by the file name and the extra field.
+            f.seek(info.header_offset + 26)
+            name_len, extra_len = struct.unpack('<HH', f.read(4))
+            f.seek(name_len + extra_len, os.SEEK_CUR)
+            np.lib.format.read_magic(f)
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            ret[info.filename[:-len('.npy')]] = np.memmap(
+                fname, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                order='F' if fortran_order else 'C')
+    return ret
+
+
+def merge_subdomains(base, digits, it, save=True, subdomains=None):
+    """Merges per-subdomain output files for a single iteration.
+
+    :param base: output base name
+    :param digits: number of digits used for the iteration number
+    :param it: iteration number
+    :param save: if True, the merged fields are saved to a .npz file, and
+        the returned arrays are read-only memory maps of that file;
+        otherwise, the merged fields are assembled in memory
+    :param subdomains: list of subdomain specs; loaded from the .subdomains
+        file if None
+    :rvalue: dict mapping field names to merged fields
+    """
+    if subdomains is None:
+        subdomains = load_subdomains(base)
+    tiles = _get_tiles(base, digits, it, subdomains)
+    fields = _get_fields(tiles)
+
+    if not save:
+        out = {}
+        for field, (shape, dtype) in fields.iteritems():
+            out[field] = np.zeros(shape, dtype=dtype)
+            _merge_field(field, tiles, out[field])
+        return out
+
+    fname = io.merged_filename(base, digits, it)
+    dirname = os.path.dirname(os.path.abspath(fname))
+    fd, tmpfile = tempfile.mkstemp(suffix='.npy', dir=dirname)
+    os.close(fd)
+    # The archive is built under a temporary name and renamed when
+    # complete, so that a failure does not leave a truncated file behind.
+    fd, tmpzip = tempfile.mkstemp(suffix='.npz', dir=dirname)
+    os.close(fd)
+    try:
+        # This mirrors what np.savez does, but the arrays are assembled
+        # directly in the temporary file.
+        zipf = zipfile.ZipFile(tmpzip, mode='w', compression=zipfile.ZIP_STORED,
+                               allowZip64=True)
+        try:
+            for field, (shape, dtype) in sorted(fields.iteritems()):
+                out = np.lib.format.open_memmap(tmpfile, mode='w+',
+                                                dtype=dtype, shape=tuple(shape))
+                _merge_field(field, tiles, out)
+                out.flush()
+                del out
+                zipf.write(tmpfile, arcname=field + '.npy')
+        finally:
+            zipf.close()
+        # mkstemp() creates files accessible only by the owner.
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmpzip, 0666 & ~umask)
+        os.rename(tmpzip, fname)
+    except:
+        os.remove(tmpzip)
+        raise
+    finally:
+        os.remove(tmpfile)
+
+    return _open_stored_npz(fname)
+
+
+def _merge_iteration(args):
+    base, digits, it = args
+    merge_subdomains(base, digits, it)
+    return it
 
-    if save:
-        np.savez(io.merged_filename(base, digits, it), **out)
-    return out
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--all', action='store_true')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='number of iterations to process in parallel')
     args, remaining = parser.parse_known_args()
 
     if remaining:
@@ -79,9 +274,22 @@ if __name__ == '__main__':
     digits = len(it)
 
     if args.all:
-        for fn in glob.glob('.'.join([base, sub_id, ('[0-9]' * digits), 'npz'])):
+        iters = []
+        for fn in sorted(glob.glob('.'.join([base, sub_id, ('[0-9]' * digits), 'npz']))):
             _, _, it, _ = fn.rsplit('.', 3)
-            print 'Processing {0}'.format(it)
-            merge_subdomains(base, digits, int(it))
+            iters.append((base, digits, int(it)))
+
+        # Load subdomain metadata before forking worker processes.
+        load_subdomains(base)
+        if args.jobs > 1:
+            pool = multiprocessing.Pool(args.jobs)
+            for it in pool.imap_unordered(_merge_iteration, iters):
+                print 'Processed {0}'.format(it)
+            pool.close()
+            pool.join()
+        else:
+            for task in iters:
+                print 'Processing {0}'.format(task[2])
+                _merge_iteration(task)
     else:
         merge_subdomains(base, digits, int(it))
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+"""
+Displays live performance metrics of a running simulation.
+
+Usage:
+    ./monitor.py [--slow F] [--interval T] tcp://host:port
+where:
+    tcp://host:port is the address on which the controller publishes
+    metrics (the simulation has to be run with --metrics_every=N; the port
+    is set with --metrics_port or printed by the controller at startup).
+
+Subdomains whose MLUPS are below F times the median over all subdomains,
+or whose latest snapshot is older than that of most other subdomains, are
+marked as stragglers.
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+import zmq
+
+
+def stragglers(snapshots, slow=0.8):
+    """Returns a dict mapping subdomain IDs to reasons for which the
+    subdomains are considered stragglers.
+
+    :param snapshots: dict mapping subdomain IDs to the latest snapshots
+    :param slow: subdomains with MLUPS below slow * median are stragglers
+    """
+    if not snapshots:
+        return {}
+    median_mlups = np.median([s['mlups'] for s in snapshots.itervalues()])
+    # All subdomains publish snapshots at the same iterations, so a subdomain
+    # whose latest snapshot is older than that of most other subdomains is
+    # lagging behind them.
+    median_iteration = np.median([s['iteration'] for s in
+                                  snapshots.itervalues()])
+    ret = {}
+    for sid, s in snapshots.iteritems():
+        reasons = []
+        if s['mlups'] < slow * median_mlups:
+            reasons.append('slow')
+        if s['iteration'] < median_iteration:
+            reasons.append('behind')
+        if reasons:
+            ret[sid] = ','.join(reasons)
+    return ret
+
+
+def format_table(snapshots, slow=0.8):
+    flagged = stragglers(snapshots, slow)
+    lines = ['{0:>4} {1:<16} {2:>10} {3:>9} {4:>9} {5:>9} {6:>9} {7:>5} '
+             '{8:>9}  {9}'.format('sub', 'host', 'iteration', 'MLUPS',
+                                  'p50 [ms]', 'p99 [ms]', 'net [ms]', 'outq',
+                                  'mem [MB]', '')]
+    for sid in sorted(snapshots):
+        s = snapshots[sid]
+        lines.append('{0:>4} {1:<16} {2:>10} {3:>9.2f} {4:>9.3f} {5:>9.3f} '
+                     '{6:>9.3f} {7:>5} {8:>9.1f}  {9}'.format(
+                         sid, s['host'][:16], s['iteration'], s['mlups'],
+                         s['step_p50'] * 1e3, s['step_p99'] * 1e3,
+                         s['net_wait'] * 1e3, s['output_queue'],
+                         s['device_memory'] / 1048576.0,
+                         flagged.get(sid, '')))
+    total = sum(s['mlups'] for s in snapshots.itervalues())
+    lines.append('Total MLUPS: {0:.2f}'.format(total))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Displays live metrics of a running simulation.')
+    parser.add_argument('addr', help='address on which metrics are published')
+    parser.add_argument('--slow', type=float, default=0.8,
+                        help='MLUPS fraction of the median below which a '
+                        'subdomain is considered slow')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='refresh interval, in seconds')
+    args = parser.parse_args()
+
+    ctx = zmq.Context()
+    sock = ctx.socket(zmq.SUB)
+    sock.setsockopt(zmq.SUBSCRIBE, '')
+    sock.connect(args.addr)
+
+    snapshots = {}
+    last_refresh = 0.0
+    try:
+        while True:
+            if sock.poll(int(args.interval * 1000)):
+                s = sock.recv_json()
+                snapshots[s['subdomain_id']] = s
+            now = time.time()
+            if now - last_refresh >= args.interval:
+                last_refresh = now
+                # Clear the screen and move the cursor to the top.
+                sys.stdout.write('\x1b[2J\x1b[H')
+                sys.stdout.write(time.strftime('%Y-%m-%d %H:%M:%S  ') +
+                                 args.addr + '\n\n')
+                if snapshots:
+                    sys.stdout.write(format_table(snapshots, args.slow) + '\n')
+                else:
+                    sys.stdout.write('Waiting for metrics...\n')
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
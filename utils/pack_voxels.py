@@ -0,0 +1,18 @@
+#!/usr/bin/python
+"""Converts a boolean .npy geometry file into a packed voxel file.
+
+Usage: pack_voxels.py <input.npy> <output>
+"""
+
+import sys
+import numpy as np
+
+from sailfish import voxel
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print 'Usage: %s <input.npy> <output>' % sys.argv[0]
+        sys.exit(1)
+
+    mask = np.load(sys.argv[1], mmap_mode='r')
+    voxel.save_packed(sys.argv[2], mask)